@@ -0,0 +1,327 @@
+import sys
+import csv
+import zmq
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import itertools
+import threading
+import numpy as np
+import amitypes as at
+
+from ami import LogConfig
+from ami.data import MsgTypes, Message, CollectorMessage, Heartbeat, SerializationProtocols, Serializer, Deserializer, \
+    parse_compression
+
+
+logger = logging.getLogger(__name__)
+
+
+Transports = ['inproc', 'ipc', 'tcp']
+
+
+def epics_payload(num_pvs=500):
+    """
+    A datagram of many scalar EPICS process variables.
+    """
+    payload = {}
+    for i in range(num_pvs):
+        payload['XPP:EPICS:PV:%04d' % i] = float(i) if i % 2 else i
+    return Message(MsgTypes.Datagram, 0, payload, 1)
+
+
+def group_payload(num_chans=8, length=1000):
+    """
+    A datagram of a group of waveforms like those of a digitizer.
+    """
+    chans = {'chan%02d' % i: np.random.normal(size=length) for i in range(num_chans)}
+    group = at.Group('digitizer', 'psana', 'hsd', {'waveforms': chans, 'times': np.arange(length, dtype=float)})
+    return Message(MsgTypes.Datagram, 0, {'digitizer': group}, 1)
+
+
+def waveform_payload(length=10000):
+    """
+    A datagram of a single 1d waveform.
+    """
+    return Message(MsgTypes.Datagram, 0, {'acq': np.random.normal(size=length)}, 1)
+
+
+def image_payload(shape=(1024, 1024)):
+    """
+    A datagram of a single 2d image.
+    """
+    return Message(MsgTypes.Datagram, 0, {'cspad': np.random.normal(size=shape).astype(np.float32)}, 1)
+
+
+def reduce_payload(num_bins=1000):
+    """
+    A message from a worker to a collector with the dictionary of a
+    `ReduceByKey` node, as made by the Binning nodes.
+    """
+    bins = {i: (np.random.normal(size=100), i) for i in range(num_bins)}
+    return CollectorMessage(mtype=MsgTypes.Datagram, identity=0, heartbeat=Heartbeat(1, time.time()),
+                            name='graph', version=1, payload={'Binning_reduce_worker': bins})
+
+
+Payloads = {
+    'epics': epics_payload,
+    'group': group_payload,
+    'waveform': waveform_payload,
+    'image': image_payload,
+    'reduce': reduce_payload,
+}
+
+
+class Link:
+    """
+    A PUSH/PULL socket pair like the ones used between the `ZmqHandler` of a
+    worker and the `Collector`.
+
+    Args:
+        ctx (zmq.Context): the zmq context for the sockets.
+        transport (str): the zmq transport to use: inproc, ipc or tcp.
+        ipcdir (str): the directory for ipc sockets.
+    """
+
+    ids = itertools.count()
+
+    def __init__(self, ctx, transport, ipcdir):
+        # each link gets its own address since closed sockets may not release it immediately
+        link_id = next(Link.ids)
+        self.pull = ctx.socket(zmq.PULL)
+        if transport == 'tcp':
+            port = self.pull.bind_to_random_port('tcp://127.0.0.1')
+            addr = 'tcp://127.0.0.1:%d' % port
+        elif transport == 'ipc':
+            addr = 'ipc://%s/benchmark%d' % (ipcdir, link_id)
+            self.pull.bind(addr)
+        else:
+            addr = 'inproc://benchmark%d' % link_id
+            self.pull.bind(addr)
+        self.push = ctx.socket(zmq.PUSH)
+        self.push.connect(addr)
+
+    def close(self):
+        self.push.close(linger=0)
+        self.pull.close(linger=0)
+
+
+def measure(link, protocol, msg, count, compression=None):
+    """
+    Measures the latency and throughput of sending a message over a link.
+
+    Args:
+        link (Link): the sockets to send the message over.
+        protocol (str): the serialization protocol.
+        msg: the message to send.
+        count (int): the number of messages to send for each measurement.
+        compression (str): the optional compression of the messages, as
+            'codec[:level]'.
+
+    Returns:
+        A tuple of the serialized size of the message, the median latency of
+        sending single messages in seconds and the throughput in messages per
+        second.
+    """
+    serializer = Serializer(protocol, parse_compression(compression))
+    deserializer = Deserializer(protocol)
+    size = serializer.sizeof(serializer(msg))
+
+    # latency of serializing, sending and deserializing one message at a time
+    latency = np.zeros(count)
+    for i in range(count):
+        start = time.perf_counter()
+        link.push.send_multipart(serializer(msg), copy=False)
+        link.pull.recv_serialized(deserializer, copy=False)
+        latency[i] = time.perf_counter() - start
+
+    # throughput with the receiver deserializing in another thread
+    def receive():
+        for _ in range(count):
+            link.pull.recv_serialized(deserializer, copy=False)
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    start = time.perf_counter()
+    receiver.start()
+    for _ in range(count):
+        link.push.send_multipart(serializer(msg), copy=False)
+    receiver.join()
+    throughput = count / (time.perf_counter() - start)
+
+    return size, np.median(latency), throughput
+
+
+def available_protocols():
+    """
+    Returns the serialization protocols which are available, with the default
+    protocol listed as 'default'.
+    """
+    protocols = []
+    msg = waveform_payload(10)
+    for protocol in SerializationProtocols:
+        try:
+            Deserializer(protocol)(Serializer(protocol)(msg))
+        except Exception:
+            logger.warning("Skipping unavailable protocol: %s", protocol)
+            continue
+        protocols.append(protocol)
+    return protocols
+
+
+def run_benchmark(protocols, transports, payloads, count, compressions=(None,)):
+    """
+    Runs the benchmark for all combinations of the protocols, transports and
+    payloads. Compression is only benchmarked with the pickle5 protocol.
+
+    Args:
+        protocols (list): the serialization protocols to benchmark.
+        transports (list): the zmq transports to benchmark.
+        payloads (list): the names of the payloads to benchmark.
+        count (int): the number of messages to send for each measurement.
+        compressions (list): the compressions to benchmark, as 'codec[:level]',
+            where None is no compression.
+
+    Returns:
+        A list of dictionaries with the results of each measurement.
+    """
+    results = []
+    messages = {name: Payloads[name]() for name in payloads}
+    ipcdir = tempfile.mkdtemp()
+    ctx = zmq.Context()
+    try:
+        for transport in transports:
+            for protocol, compression in itertools.product(protocols, compressions):
+                if compression is not None and protocol != 'pickle5':
+                    continue
+                for name, msg in messages.items():
+                    link = Link(ctx, transport, ipcdir)
+                    try:
+                        size, latency, throughput = measure(link, protocol, msg, count, compression)
+                    finally:
+                        link.close()
+                    results.append({
+                        'protocol': 'default' if protocol is None else protocol,
+                        'compression': compression or 'none',
+                        'transport': transport,
+                        'payload': name,
+                        'size': size,
+                        'latency_us': 1e6 * latency,
+                        'msgs_per_sec': throughput,
+                        'mb_per_sec': throughput * size / 1024**2,
+                    })
+    finally:
+        ctx.destroy()
+        shutil.rmtree(ipcdir, ignore_errors=True)
+    return results
+
+
+def format_table(results):
+    """
+    Formats the results of the benchmark as a table.
+
+    Args:
+        results (list): the results returned by `run_benchmark`.
+
+    Returns:
+        The table as a string.
+    """
+    lines = ["%-10s %-11s %-9s %-9s %12s %14s %12s %10s" %
+             ('Protocol', 'Compression', 'Transport', 'Payload', 'Size (B)', 'Latency (us)', 'Msgs/s', 'MB/s')]
+    for res in results:
+        lines.append("%-10s %-11s %-9s %-9s %12d %14.1f %12.1f %10.1f" %
+                     (res['protocol'], res['compression'], res['transport'], res['payload'], res['size'],
+                      res['latency_us'], res['msgs_per_sec'], res['mb_per_sec']))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AMII serialization and transport benchmark')
+
+    parser.add_argument(
+        '-p',
+        '--protocol',
+        action='append',
+        help='serialization protocol to benchmark, may be given multiple times (default: all available)'
+    )
+
+    parser.add_argument(
+        '-t',
+        '--transport',
+        action='append',
+        choices=Transports,
+        help='zmq transport to benchmark, may be given multiple times (default: all)'
+    )
+
+    parser.add_argument(
+        '-l',
+        '--payload',
+        action='append',
+        choices=list(Payloads),
+        help='payload to benchmark, may be given multiple times (default: all)'
+    )
+
+    parser.add_argument(
+        '-z',
+        '--compression',
+        action='append',
+        help='compression to benchmark with the pickle5 protocol as codec[:level], may be given multiple times, '
+             'where none is no compression (default: none)'
+    )
+
+    parser.add_argument(
+        '-n',
+        '--count',
+        type=int,
+        default=200,
+        help='number of messages to send for each measurement (default: 200)'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='an optional csv file to write the results to'
+    )
+
+    parser.add_argument(
+        '--log-level',
+        default=LogConfig.Level,
+        help='the logging level of the application (default %s)' % LogConfig.Level
+    )
+
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log_level.upper(), logging.INFO)
+    logging.basicConfig(format=LogConfig.BasicFormat, level=log_level)
+
+    if args.protocol is None:
+        protocols = available_protocols()
+    else:
+        protocols = [None if p == 'default' else p for p in args.protocol]
+    transports = args.transport or Transports
+    payloads = args.payload or list(Payloads)
+    if args.compression is None:
+        compressions = [None]
+    else:
+        compressions = [None if c == 'none' else c for c in args.compression]
+
+    try:
+        results = run_benchmark(protocols, transports, payloads, args.count, compressions)
+    except KeyboardInterrupt:
+        logger.info("Benchmark killed by user...")
+        return 0
+
+    print(format_table(results))
+
+    if args.output is not None:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
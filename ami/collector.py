@@ -9,7 +9,7 @@ import datetime as dt
 import ami.multiproc as mp
 from ami.worker import run_worker, parse_args
 from ami import LogConfig, Defaults
-from ami.comm import Ports, Colors, Node, Collector, TransitionBuilder, EventBuilder
+from ami.comm import Ports, Colors, Node, Collector, TransitionBuilder, EventBuilder, SharedMemoryMapper
 from ami.data import MsgTypes, Transitions
 
 
@@ -18,14 +18,25 @@ logger = logging.getLogger(__name__)
 
 class GraphCollector(Node, Collector):
     def __init__(self, node, base_name, num_workers, color, collector_addr, downstream_addr, graph_addr,
-                 msg_addr, prometheus_dir, hutch):
+                 msg_addr, prometheus_dir, hutch, compression=None, deadline=0, sender=None):
         Node.__init__(self, node, graph_addr, msg_addr, prometheus_dir=prometheus_dir, hutch=hutch)
         Collector.__init__(self, collector_addr, ctx=self.ctx, hutch=hutch)
         self.base_name = base_name
         self.num_workers = num_workers
-        self.transitions = TransitionBuilder(self.num_workers, downstream_addr, self.ctx)
-        self.store = EventBuilder(self.num_workers, 10, color, downstream_addr, self.ctx)
-        self.sender = 'worker%03d' if color == 'localCollector' else 'localCollector%03d'
+        self.transitions = TransitionBuilder(self.num_workers, downstream_addr, self.ctx, compression)
+        self.store = EventBuilder(self.num_workers, 10, color, downstream_addr, self.ctx, compression,
+                                  deadline if deadline > 0 else None)
+        if deadline > 0:
+            # check the deadlines of the pending heartbeats four times per deadline
+            self.poll_timeout = max(1, int(250 * deadline))
+        if self.store.compression is not None:
+            self.metrics.add_gauge('Compression Ratio', 'ami_compression_ratio', 'Compression Ratio of Sent Data')
+            self.metrics.add_gauge('Compression Time', 'ami_compression_time_secs', 'Compression Time')
+        if sender is None:
+            sender = 'worker%03d' if color == 'localCollector' else 'localCollector%03d'
+        self.sender = sender
+        # workers on the same host may send large arrays through shared memory
+        self.mapper = SharedMemoryMapper() if color == 'localCollector' else None
         self.pickers = {}
         self.strategies = {}
         self.heartbeat_time = collections.defaultdict(lambda: 0)
@@ -56,7 +67,9 @@ class GraphCollector(Node, Collector):
             self.report("error", e)
 
     def eb_id(self, identity):
-        return identity - (self.node * self.num_workers)
+        # the contributors of a collector have consecutive identities, but the last collector of a level of
+        # intermediate collectors may have fewer contributors than the others
+        return identity % self.num_workers
 
     def report_times(self, times, name, heartbeat):
         if times:
@@ -85,6 +98,13 @@ class GraphCollector(Node, Collector):
         self.store.destroy(name)
         self.report("purge", name)
 
+    def graph_failure(self, name, exc):
+        logger.exception("%s: Failure encountered while executing graph %s:", self.name, name)
+        self.report("error", exc)
+        logger.error("%s: Purging graph (%s v%d)", self.name, name, self.store.version(name))
+        self.store.destroy(name)
+        self.report("purge", name)
+
     def process_msg(self, msg):
         if msg.mtype == MsgTypes.Transition:
             self.transitions.update(msg.payload.ttype, self.eb_id(msg.identity), msg.payload.payload)
@@ -95,51 +115,78 @@ class GraphCollector(Node, Collector):
                 elif msg.payload.ttype == Transitions.Unconfigure:
                     self.flush(False)
 
-            self.event_counter.labels(self.hutch, 'Transition', self.name).inc()
+            self.metrics.count('Transition')
+            self.metrics.flush()
         elif msg.mtype == MsgTypes.Datagram:
             latency = dt.datetime.now() - dt.datetime.fromtimestamp(msg.heartbeat.timestamp)
-            self.event_latency.labels(self.hutch, self.sender % msg.identity,
-                                      self.name).set(latency.total_seconds())
+            self.metrics.latency(self.sender % msg.identity, latency.total_seconds())
             datagram_start = time.time()
-            self.store.update(msg.name, msg.heartbeat, self.eb_id(msg.identity), msg.version, msg.payload)
+            payload = msg.payload if self.mapper is None else self.mapper.map(msg.payload)
+            try:
+                # the graph is executed on the contribution as soon as it arrives
+                self.store.update(msg.name, msg.heartbeat, self.eb_id(msg.identity), msg.version, payload,
+                                  msg.missing, msg.skipped)
+            except Exception as e:
+                self.graph_failure(msg.name, e)
+                return
             if self.store.ready(msg.name, msg.heartbeat):
                 try:
                     # prune entries older than the current heartbeat
                     pruned_times, pruned_size = self.store.prune(msg.name, self.node, msg.heartbeat)
                     if pruned_size:
-                        self.event_counter.labels(self.hutch, 'Pruned Heartbeat', self.name).inc()
-                        self.event_size.labels(self.hutch, self.name).set(pruned_size)
+                        self.metrics.count('Pruned Heartbeat')
+                        self.metrics.set_size(pruned_size)
                     # complete the current heartbeat
                     times, size = self.store.complete(msg.name, msg.heartbeat, self.node)
 
                     # times = self.store.complete(msg.name, msg.heartbeat, self.node)
                     # self.report_times(times, msg.name, msg.heartbeat)
 
-                    self.event_counter.labels(self.hutch, 'Heartbeat', self.name).inc()
+                    self.metrics.count('Heartbeat')
                     self.heartbeat_time[msg.heartbeat.identity] += time.time() - datagram_start
                     heartbeat_time = self.heartbeat_time.pop(msg.heartbeat.identity, 0)
-                    self.event_time.labels(self.hutch, 'Heartbeat', self.name).set(heartbeat_time)
-                    self.event_size.labels(self.hutch, self.name).set(size)
+                    self.metrics.time('Heartbeat', heartbeat_time)
+                    self.metrics.set_size(size)
+                    if self.store.compression is not None:
+                        stats = self.store.compression.stats()
+                        if stats is not None:
+                            self.metrics.set('Compression Ratio', stats[0])
+                            self.metrics.set('Compression Time', stats[1])
+                    self.metrics.flush()
                 except Exception as e:
-                    logger.exception("%s: Failure encountered while executing graph %s:", self.name, msg.name)
-                    self.report("error", e)
-                    logger.error("%s: Purging graph (%s v%d)", self.name, msg.name, self.store.version(msg.name))
-                    self.store.destroy(msg.name)
-                    self.report("purge", msg.name)
+                    self.graph_failure(msg.name, e)
             else:
                 # prune older entries from the event builder
-                pruned_times, pruned_size = self.store.prune(msg.name, self.node)
+                try:
+                    pruned_times, pruned_size = self.store.prune(msg.name, self.node)
+                except Exception as e:
+                    self.graph_failure(msg.name, e)
+                    return
                 if pruned_size:
-                    self.event_counter.labels(self.hutch, 'Pruned Heartbeat', self.name).inc()
-                    self.event_size.labels(self.hutch, self.name).set(pruned_size)
+                    self.metrics.count('Pruned Heartbeat')
+                    self.metrics.set_size(pruned_size)
+                    self.metrics.flush()
                     self.heartbeat_time.pop(msg.heartbeat.identity, 0)
 
             self.heartbeat_time[msg.heartbeat.identity] += time.time() - datagram_start
 
+    def process_timeout(self):
+        # complete the heartbeats whose deadline has passed with the contributions received so far
+        for name in list(self.store.builders):
+            try:
+                times, size = self.store.expire(name, self.node)
+            except Exception as e:
+                self.graph_failure(name, e)
+                continue
+            if size:
+                self.metrics.count('Expired Heartbeat')
+                self.metrics.set_size(size)
+                self.metrics.flush()
+
 
 def run_collector(node_num, base_name, num_contribs, color,
                   collector_addr, upstream_addr, graph_addr, msg_addr,
-                  prometheus_dir, hutch):
+                  prometheus_dir, hutch, compression=None, deadline=0, sender=None):
     logger.info('Starting collector on node # %d PID: %d', node_num, os.getpid())
     with GraphCollector(
             node_num,
@@ -150,14 +197,15 @@ def run_collector(node_num, base_name, num_contribs, color,
             upstream_addr,
             graph_addr,
             msg_addr,
-            prometheus_dir, hutch) as collector:
+            prometheus_dir, hutch,
+            compression, deadline, sender) as collector:
         collector.start_prometheus()
         return collector.run()
 
 
 def run_node_collector(node_num, num_contribs,
                        collector_addr, upstream_addr, graph_addr, msg_addr,
-                       prometheus_dir, hutch):
+                       prometheus_dir, hutch, compression=None, deadline=0):
     return run_collector(node_num,
                          "localCollector%03d",
                          num_contribs,
@@ -167,12 +215,43 @@ def run_node_collector(node_num, num_contribs,
                          graph_addr,
                          msg_addr,
                          prometheus_dir,
-                         hutch)
+                         hutch,
+                         compression,
+                         deadline)
+
+
+def intermediate_base_name(level):
+    """
+    Returns the base name of the collectors of a level of intermediate
+    collectors, where the level of the local collectors is zero.
+    """
+    if level == 0:
+        return "localCollector%03d"
+    else:
+        return "%s%d_%%03d" % (Colors.IntermediateCollector, level)
+
+
+def run_intermediate_collector(level, node_num, num_contribs,
+                               collector_addr, upstream_addr, graph_addr, msg_addr,
+                               prometheus_dir, hutch, compression=None, deadline=0):
+    return run_collector(node_num,
+                         intermediate_base_name(level),
+                         num_contribs,
+                         "%s%d" % (Colors.IntermediateCollector, level),
+                         collector_addr,
+                         upstream_addr,
+                         graph_addr,
+                         msg_addr,
+                         prometheus_dir,
+                         hutch,
+                         compression,
+                         deadline,
+                         intermediate_base_name(level - 1))
 
 
 def run_global_collector(node_num, num_contribs,
                          collector_addr, upstream_addr, graph_addr, msg_addr,
-                         prometheus_dir, hutch):
+                         prometheus_dir, hutch, compression=None, deadline=0, intermediate_levels=0):
     return run_collector(node_num,
                          "globalCollector%03d",
                          num_contribs,
@@ -182,7 +261,10 @@ def run_global_collector(node_num, num_contribs,
                          graph_addr,
                          msg_addr,
                          prometheus_dir,
-                         hutch)
+                         hutch,
+                         compression,
+                         deadline,
+                         intermediate_base_name(intermediate_levels))
 
 
 def main(color, upstream_port, downstream_port):
@@ -208,7 +290,12 @@ def main(color, upstream_port, downstream_port):
         '--downstream',
         type=int,
         default=downstream_port,
-        help='port for global collector (default: %d)' % downstream_port
+        help='port for downstream collector (default: %d)' % downstream_port
+    )
+
+    parser.add_argument(
+        '--downstream-host',
+        help='hostname of the downstream collector, e.g. an intermediate collector (default: the manager host)'
     )
 
     parser.add_argument(
@@ -243,6 +330,24 @@ def main(color, upstream_port, downstream_port):
         help='node identification number (default: 0)'
     )
 
+    if color == Colors.IntermediateCollector:
+        parser.add_argument(
+            '-l',
+            '--level',
+            type=int,
+            default=1,
+            help='level of the intermediate collector in the tree of collectors, where the node collectors are '
+                 'level zero (default: 1)'
+        )
+    elif color == Colors.GlobalCollector:
+        parser.add_argument(
+            '--intermediate-levels',
+            type=int,
+            default=0,
+            help='number of levels of intermediate collectors between the node collectors and the global collector '
+                 '(default: 0)'
+        )
+
     parser.add_argument(
         '--log-level',
         default=LogConfig.Level,
@@ -266,6 +371,20 @@ def main(color, upstream_port, downstream_port):
         default=None
     )
 
+    parser.add_argument(
+        '--deadline',
+        type=float,
+        default=0,
+        help='time in seconds after its first contribution that a heartbeat is completed with the contributions '
+             'received so far, zero waits for all the contributions (default: 0)'
+    )
+
+    parser.add_argument(
+        '--compression',
+        help='compress the large arrays sent downstream with this codec, as codec[:level] where codec is one '
+             'of zlib, lzma, lz4 or zstd (default: no compression)'
+    )
+
     subparsers = parser.add_subparsers(help='spawn workers', dest='worker')
     worker_subparser = subparsers.add_parser('worker', help='worker arguments')
 
@@ -300,10 +419,76 @@ def main(color, upstream_port, downstream_port):
         help='extra flags as key=value pairs that are passed to the data source'
     )
 
+    worker_subparser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        help='the max number of events to buffer and execute the graph over at once (default: 1)'
+    )
+
+    worker_subparser.add_argument(
+        '--prefetch',
+        type=int,
+        default=0,
+        help='the number of messages to prefetch from the data source in the background (default: 0)'
+    )
+
+    worker_subparser.add_argument(
+        '--graph-threads',
+        type=int,
+        default=0,
+        help='the number of threads to use for executing different graphs concurrently (default: 0)'
+    )
+
+    worker_subparser.add_argument(
+        '--node-threads',
+        type=int,
+        default=0,
+        help='the number of threads each graph uses for executing independent nodes concurrently (default: 0)'
+    )
+
+    worker_subparser.add_argument(
+        '--profile-sample',
+        type=int,
+        default=1,
+        help='profile one in every N graph executions, zero disables profiling (default: 1)'
+    )
+
+    worker_subparser.add_argument(
+        '--time-budget',
+        type=float,
+        default=0,
+        help='time budget in seconds for processing a heartbeat, beyond which events are skipped, '
+             'zero disables skipping (default: 0)'
+    )
+
+    worker_subparser.add_argument(
+        '--shmem-size',
+        type=int,
+        default=0,
+        help='size in MB of the shared memory ring for sending large arrays to the local collector, '
+             'zero disables it (default: 0)'
+    )
+
+    worker_subparser.add_argument(
+        '--record',
+        help='record the messages from the data source of each worker to this file with the worker id appended '
+             'for replaying them with the replay source'
+    )
+
+    worker_subparser.add_argument(
+        '--compression',
+        dest='worker_compression',
+        help='compress the large arrays the workers send to the collector with this codec, as codec[:level] '
+             'where codec is one of zlib, lzma, lz4 or zstd (default: no compression)'
+    )
+
     args = parser.parse_args()
+    if color == Colors.IntermediateCollector and args.level < 1:
+        parser.error('the level of an intermediate collector must be at least 1')
 
     collector_addr = "tcp://*:%d" % (args.collector)
-    downstream_addr = "tcp://%s:%d" % (args.host, args.downstream)
+    downstream_addr = "tcp://%s:%d" % (args.downstream_host or args.host, args.downstream)
     graph_addr = "tcp://%s:%d" % (args.host, args.graph)
     msg_addr = "tcp://%s:%d" % (args.host, args.message)
 
@@ -334,7 +519,16 @@ def main(color, upstream_port, downstream_port):
                                               export_addr,
                                               flags,
                                               args.prometheus_dir,
-                                              args.hutch),
+                                              args.hutch,
+                                              args.batch_size,
+                                              args.prefetch,
+                                              args.graph_threads,
+                                              args.node_threads,
+                                              args.profile_sample,
+                                              args.time_budget,
+                                              args.shmem_size,
+                                              args.record,
+                                              args.worker_compression),
                                         daemon=True)
                     worker.start()
 
@@ -345,7 +539,21 @@ def main(color, upstream_port, downstream_port):
                                       graph_addr,
                                       msg_addr,
                                       args.prometheus_dir,
-                                      args.hutch)
+                                      args.hutch,
+                                      args.compression,
+                                      args.deadline)
+        elif color == Colors.IntermediateCollector:
+            return run_intermediate_collector(args.level,
+                                              args.node_num,
+                                              args.num_contribs,
+                                              collector_addr,
+                                              downstream_addr,
+                                              graph_addr,
+                                              msg_addr,
+                                              args.prometheus_dir,
+                                              args.hutch,
+                                              args.compression,
+                                              args.deadline)
         elif color == Colors.GlobalCollector:
             return run_global_collector(args.node_num,
                                         args.num_contribs,
@@ -354,7 +562,10 @@ def main(color, upstream_port, downstream_port):
                                         graph_addr,
                                         msg_addr,
                                         args.prometheus_dir,
-                                        args.hutch)
+                                        args.hutch,
+                                        args.compression,
+                                        args.deadline,
+                                        args.intermediate_levels)
         else:
             logger.critical("Invalid option collector color '%s' chosen!", color)
             return 1
@@ -368,6 +579,10 @@ def node_main():
     return main(Colors.LocalCollector, Ports.NodeCollector, Ports.FinalCollector)
 
 
+def intermediate_main():
+    return main(Colors.IntermediateCollector, Ports.IntermediateCollector, Ports.FinalCollector)
+
+
 def global_main():
     return main(Colors.GlobalCollector, Ports.FinalCollector, Ports.Results)
 
@@ -7,17 +7,25 @@ import zmq
 import dill
 import json
 import asyncio
+import heapq
+import bisect
 import logging
+import weakref
 import functools
+import collections
 import numpy as np
 import zmq.asyncio
 import prometheus_client as pc
 import amitypes as at
 import ami.graph_nodes as gn
-from ami.graphkit_wrapper import Graph
+from ami.graphkit_wrapper import Graph, collector_tree
 from ami.data import MsgTypes, Message, Transition, CollectorMessage, Datagram, Serializer, Deserializer, \
-    Heartbeat
+    Heartbeat, SharedArray, parse_compression
 from enum import IntEnum
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
 
 
 logger = logging.getLogger(__name__)
@@ -27,6 +35,7 @@ ZMQ_TOPIC_DELIM = '\0'
 class Colors:
     Worker = "worker"
     LocalCollector = "localCollector"
+    IntermediateCollector = "intermediateCollector"
     GlobalCollector = "globalCollector"
 
 
@@ -41,6 +50,7 @@ class Ports(IntEnum):
     Info = 5562
     View = 5563
     Profile = 5564
+    IntermediateCollector = 5565
     Sync = 5600
     Prometheus = 9200
 
@@ -327,14 +337,15 @@ class Store:
 
 
 class ZmqHandler:
-    def __init__(self, addr, ctx=None):
+    def __init__(self, addr, ctx=None, compression=None):
         if ctx is None:
             self.ctx = zmq.Context()
         else:
             self.ctx = ctx
         self.collector = self.ctx.socket(zmq.PUSH)
         self.collector.connect(addr)
-        self.serializer = Serializer()
+        self.compression = parse_compression(compression)
+        self.serializer = Serializer(compression=self.compression)
 
     def send(self, msg):
         msg = self.serializer(msg)
@@ -345,9 +356,9 @@ class ZmqHandler:
         msg = Message(mtype=mtype, identity=identity, payload=payload)
         return self.send(msg)
 
-    def collector_message(self, identity, heartbeat, name, version, payload):
+    def collector_message(self, identity, heartbeat, name, version, payload, skipped=0.0, missing=0):
         msg = CollectorMessage(mtype=MsgTypes.Datagram, identity=identity, heartbeat=heartbeat,
-                               name=name, version=version, payload=payload)
+                               name=name, version=version, payload=payload, skipped=skipped, missing=missing)
         return self.send(msg)
 
 
@@ -359,9 +370,10 @@ class ResultStore(ZmqHandler):
     a Collector object.
     """
 
-    def __init__(self, addr, ctx=None):
-        super().__init__(addr, ctx)
+    def __init__(self, addr, ctx=None, ring=None, compression=None):
+        super().__init__(addr, ctx, compression)
         self.stores = {}
+        self.ring = ring
 
     def __bool__(self):
         if self.stores:
@@ -384,10 +396,13 @@ class ResultStore(ZmqHandler):
     def update(self, name, updates):
         self.stores[name].update(updates)
 
-    def collect(self, identity, heartbeat):
+    def collect(self, identity, heartbeat, skipped=0.0):
         size = 0
         for name, store in self.stores.items():
-            size += self.collector_message(identity, heartbeat, name, store.version, store.namespace)
+            namespace = store.namespace
+            if self.ring is not None:
+                namespace = self.ring.export(namespace)
+            size += self.collector_message(identity, heartbeat, name, store.version, namespace, skipped)
         return size
 
     def version(self, name):
@@ -401,6 +416,289 @@ class ResultStore(ZmqHandler):
                 store.clear()
 
 
+class SharedMemoryRing:
+    """Ring buffer in a POSIX shared memory segment for sending arrays.
+
+    Large arrays are copied once into the ring and replaced by `SharedArray`
+    descriptors, so only the descriptors need to be serialized and sent to a
+    collector on the same host. The collector maps the arrays directly from
+    the segment with a `SharedMemoryMapper`.
+
+    The first bytes of the segment hold a counter of the allocations released
+    by the collector, which is used to reclaim space in the ring. If there is
+    not enough free space for an array it is sent inline instead.
+
+    Args:
+        name (str): the name of the shared memory segment to create.
+        size (int): the size of the ring in bytes.
+        threshold (int): the minimum size in bytes of arrays to put in the
+            ring.
+    """
+
+    Header = 64
+    Alignment = 64
+
+    def __init__(self, name, size, threshold=65536):
+        if shared_memory is None:
+            raise NotImplementedError("shared memory is not available!")
+        self.size = size
+        self.threshold = threshold
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=SharedMemoryRing.Header + size)
+        self.released = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf)
+        self.released[0] = 0
+        self.seq = 0
+        self.head = 0
+        self.allocations = collections.deque()
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        """
+        Closes and removes the shared memory segment.
+        """
+        self.released = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def allocate(self, nbytes):
+        """
+        Allocates space in the ring.
+
+        Args:
+            nbytes (int): the number of bytes to allocate.
+
+        Returns:
+            A tuple of the sequence number and offset of the allocation, or
+            None if there is not enough free space in the ring.
+        """
+        # reclaim the space of the allocations released by the collector
+        released = int(self.released[0])
+        while self.allocations and self.allocations[0][0] < released:
+            self.allocations.popleft()
+
+        nbytes = -(-nbytes // SharedMemoryRing.Alignment) * SharedMemoryRing.Alignment
+        if not self.allocations:
+            start = 0
+        else:
+            tail = self.allocations[0][1]
+            if self.head > tail:
+                if self.head + nbytes <= self.size:
+                    start = self.head
+                elif nbytes < tail:
+                    start = 0
+                else:
+                    return None
+            elif self.head + nbytes < tail:
+                start = self.head
+            else:
+                return None
+
+        if start + nbytes > self.size:
+            return None
+
+        seq = self.seq
+        self.seq += 1
+        self.head = start + nbytes
+        self.allocations.append((seq, start))
+        return seq, SharedMemoryRing.Header + start
+
+    def put(self, value):
+        """
+        Copies an array into the ring.
+
+        Args:
+            value (np.ndarray): the array to copy.
+
+        Returns:
+            A `SharedArray` describing where the array was copied to, or the
+            array itself if it was not put in the ring.
+        """
+        if value.dtype.hasobject or value.nbytes < self.threshold:
+            return value
+
+        allocation = self.allocate(value.nbytes)
+        if allocation is None:
+            return value
+
+        seq, offset = allocation
+        np.ndarray(value.shape, dtype=value.dtype, buffer=self.shm.buf, offset=offset)[...] = value
+        return SharedArray(self.shm.name, seq, offset, value.shape, value.dtype.str)
+
+    def export(self, value):
+        """
+        Replaces the large arrays in a collector payload with descriptors of
+        copies of them in the ring.
+
+        Args:
+            value: the payload, which can contain nested dicts, lists and tuples.
+
+        Returns:
+            A copy of the payload with the arrays replaced.
+        """
+        if isinstance(value, np.ndarray):
+            return self.put(value)
+        elif type(value) is dict:
+            return {k: self.export(v) for k, v in value.items()}
+        elif type(value) in (list, tuple):
+            return type(value)(self.export(v) for v in value)
+        else:
+            return value
+
+
+class SharedMemoryMapper:
+    """Maps the arrays described by `SharedArray` descriptors from the rings
+    of the senders.
+
+    The arrays are mapped without copying. An allocation is released back
+    to its ring only once the mapped array has been garbage collected, so
+    the data stays valid for as long as anything still refers to it.
+    """
+
+    def __init__(self):
+        self.segments = {}
+
+    def _attach(self, name):
+        if name not in self.segments:
+            shm = shared_memory.SharedMemory(name=name)
+            # the segment belongs to the sender so don't let the resource tracker remove it on exit
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            released = np.ndarray((1,), dtype=np.uint64, buffer=shm.buf)
+            self.segments[name] = (shm, released, set())
+        return self.segments[name]
+
+    def _release(self, name, seq):
+        if name not in self.segments:
+            return
+        shm, released, done = self.segments[name]
+        done.add(seq)
+        # the counter only advances past allocations that have all been released
+        count = int(released[0])
+        while count in done:
+            done.remove(count)
+            count += 1
+        released[0] = count
+
+    def map(self, value):
+        """
+        Replaces any `SharedArray` descriptors in a collector payload with
+        the arrays they describe.
+
+        Args:
+            value: the payload, which can contain nested dicts, lists and tuples.
+
+        Returns:
+            A copy of the payload with the descriptors replaced.
+        """
+        if isinstance(value, SharedArray):
+            shm, _, _ = self._attach(value.segment)
+            array = np.ndarray(tuple(value.shape), dtype=np.dtype(value.dtype), buffer=shm.buf, offset=value.offset)
+            weakref.finalize(array, self._release, value.segment, value.seq)
+            return array
+        elif type(value) is dict:
+            return {k: self.map(v) for k, v in value.items()}
+        elif type(value) in (list, tuple):
+            return type(value)(self.map(v) for v in value)
+        else:
+            return value
+
+
+class Profile:
+    """Class for accumulating graph execution times into histograms.
+
+    The execution time of the graph and of each of its nodes are accumulated
+    into histograms with fixed buckets, so the memory used does not depend on
+    the number of events. Optionally only one in every N executions is timed.
+
+    Args:
+        sample (int): time one in every `sample` executions of the graph.
+        edges (list): the edges of the histogram buckets in seconds. The
+            histograms have one extra bucket on each end for the underflow
+            and overflow. Defaults to `Profile.Edges`.
+    """
+
+    Edges = list(np.logspace(-6, 1, 29))
+
+    def __init__(self, sample=1, edges=None):
+        self.sample = max(sample, 1)
+        self.edges = Profile.Edges if edges is None else list(edges)
+        self.count = 0
+        self.clear()
+
+    def __bool__(self):
+        return self.sampled > 0
+
+    def clear(self):
+        """
+        Resets all the accumulated histograms.
+        """
+        self.events = 0
+        self.sampled = 0
+        self.start = None
+        self.stop = None
+        self.total = [0] * (len(self.edges) + 1)
+        self.nodes = {}
+        self.sums = {}
+
+    def sampling(self):
+        """
+        Counts an execution of the graph and checks if it should be timed.
+
+        Returns:
+            True if the execution should be timed, False otherwise.
+        """
+        sampled = (self.count % self.sample) == 0
+        self.count += 1
+        self.events += 1
+        return sampled
+
+    def update(self, start, stop, times):
+        """
+        Adds the times of an execution of the graph to the histograms.
+
+        Args:
+            start (float): the start time of the graph execution.
+            stop (float): the stop time of the graph execution.
+            times (dict): the execution time of each node of the graph.
+        """
+        if self.start is None:
+            self.start = start
+        self.stop = stop
+        self.sampled += 1
+        self.total[bisect.bisect(self.edges, stop - start)] += 1
+        for node, exec_time in times.items():
+            if node not in self.nodes:
+                self.nodes[node] = [0] * (len(self.edges) + 1)
+                self.sums[node] = 0.0
+            self.nodes[node][bisect.bisect(self.edges, exec_time)] += 1
+            self.sums[node] += exec_time
+
+    def collect(self):
+        """
+        Returns the accumulated histograms and then resets them.
+
+        Returns:
+            A dictionary with the histograms, or None if nothing was timed.
+        """
+        if not self:
+            self.clear()
+            return None
+
+        profile = {
+            'edges': self.edges,
+            'events': self.events,
+            'sampled': self.sampled,
+            'start': self.start,
+            'stop': self.stop,
+            'total': self.total,
+            'nodes': self.nodes,
+            'sums': self.sums,
+        }
+        self.clear()
+        return profile
+
+
 class ContributionBuilder(abc.ABC):
     def __init__(self, num_contribs):
         self.num_contribs = num_contribs
@@ -447,7 +745,7 @@ class ContributionBuilder(abc.ABC):
 
 
 class GraphBuilder(ContributionBuilder):
-    def __init__(self, num_contribs, depth, color, completion):
+    def __init__(self, num_contribs, depth, color, completion, deadline=None):
         super().__init__(num_contribs)
         self.depth = depth
         self.color = color
@@ -456,6 +754,25 @@ class GraphBuilder(ContributionBuilder):
         self.pending_graphs = {}
         self.version = None
         self.completion = completion
+        # min-heap of the pending heartbeats, completed heartbeats are removed lazily
+        self.order = []
+        # the time in seconds after its first contribution that a heartbeat is completed regardless
+        self.deadline = deadline
+        self.deadlines = {}
+        self.expired = None
+        # the number of workers each contributor stands for and the workers missing from each heartbeat
+        self.workers = 1
+        self.missing = {}
+        # the sum of the fractions of events skipped by the worker prescalers of the contributions to each heartbeat
+        self.skipped = {}
+        # when the state of the graph only holds the current heartbeat the contributions are reduced as
+        # they arrive, with the state of each pending heartbeat swapped into the graph as needed. Otherwise
+        # the contributions are buffered and reduced in order as the heartbeats are completed.
+        self.scoped = False
+        self.active = None
+        self.states = {}
+        self.buffered = {}
+        self.times = {}
 
     def _init(self, name):
         if self.graph is None:
@@ -471,6 +788,11 @@ class GraphBuilder(ContributionBuilder):
                 self.graph.remove(node)
 
     def _compile(self, args):
+        levels = collector_tree(args.get('num_workers', 1), args.get('num_local_collectors', 1), args.get('fan_in'))
+        colors = [color for color, _ in levels]
+        if self.color in colors[1:]:
+            # the number of workers whose results each contributor has reduced
+            self.workers = max(args.get('num_workers', 1) // levels[colors.index(self.color)-1][1], 1)
         if self.graph:
             self.graph.compile(**args)
 
@@ -486,18 +808,73 @@ class GraphBuilder(ContributionBuilder):
         else:
             depth = 1
 
-        if len(self.pending) > depth:
-            for eb_key in reversed(sorted(self.pending.keys(), reverse=True)[depth:]):
-                logger.debug("Pruned uncompleted key %d", eb_key)
+        # the oldest pending heartbeat is always at the front of the heap
+        while len(self.pending) > depth:
+            eb_key = self.order[0]
+            logger.debug("Pruned uncompleted key %d", eb_key)
+            times, size = self.complete(eb_key, identity, drop)
+
+        return times, size
+
+    def complete(self, eb_key, identity, drop=False):
+        result = super().complete(eb_key, identity, drop)
+        self.deadlines.pop(eb_key, None)
+        self.missing.pop(eb_key, None)
+        self.skipped.pop(eb_key, None)
+        while self.order and self.order[0] not in self.pending:
+            heapq.heappop(self.order)
+        return result
+
+    def expire(self, identity, now=None, drop=False):
+        """
+        Completes the pending heartbeats whose deadline has passed with the
+        contributions received so far. Any older pending heartbeats are
+        completed first.
+
+        Args:
+            identity (int): the identity of the node completing the heartbeats.
+            now (float): the current monotonic time, or None to use the clock.
+            drop (bool): drop the heartbeats instead of sending them.
+
+        Returns:
+            The times and size of the last completed heartbeat.
+        """
+        times = []
+        size = 0
+        if self.deadline is None:
+            return times, size
+
+        if now is None:
+            now = time.monotonic()
+        # the deadlines are in the order of the first contributions, so the expired ones come first
+        expired = []
+        for eb_key, deadline in self.deadlines.items():
+            if deadline > now:
+                break
+            expired.append(eb_key)
+
+        for eb_key in sorted(expired):
+            if eb_key in self.pending:
+                logger.debug("Expired uncompleted key %d", eb_key)
+                self.prune(identity, eb_key, drop)
                 times, size = self.complete(eb_key, identity, drop)
+                self.expired = eb_key
 
         return times, size
 
+    def update(self, eb_key, eb_id, *args, **kwargs):
+        # everything up to the last expired heartbeat has been completed already
+        if self.expired is not None and eb_key <= self.expired:
+            logger.debug("Dropped late contribution to expired key %d from id %s", eb_key, eb_id)
+            return
+        super().update(eb_key, eb_id, *args, **kwargs)
+
     def flush(self, identity, drop=False):
         size = self.prune(identity, self.latest.identity + 1, drop)
         if drop and self.graph:
             self.graph.reset()
         self.latest = Heartbeat(0, 0)
+        self.expired = None
         return size
 
     def set_graph(self, name, ver_key, args, graph):
@@ -511,6 +888,8 @@ class GraphBuilder(ContributionBuilder):
 
     def apply_graph(self, ver_key):
         if self.version is None or ver_key > self.version:
+            if ver_key not in self.pending_graphs:
+                return False
             versions = [ver for ver in sorted(self.pending_graphs) if ver <= ver_key]
             if ver_key in versions:
                 for version in versions:
@@ -528,47 +907,124 @@ class GraphBuilder(ContributionBuilder):
         else:
             return False
 
-    def _complete(self, eb_key, identity, drop):
-        times = []
-        if self.apply_graph(self.pending[eb_key].version):
-            contribs = self.pending[eb_key].namespace
-            self.pending[eb_key].clear()
-            if self.graph:
-                for data in contribs.values():
-                    start = time.time()
-                    res = self.graph(data, color=self.color)
-                    stop = time.time()
-                    self.pending[eb_key].update(res)
-                    exec_time = self.graph.times()
-                    if exec_time:
-                        times.append((start, stop, exec_time))
-        else:
-            self.pending[eb_key].clear()
+    def _apply(self, eb_key):
+        """
+        Applies the graph version of a heartbeat if it is available.
+
+        Args:
+            eb_key (Heartbeat): the heartbeat.
+
+        Returns:
+            True if the graph of the heartbeat is available.
+        """
+        version = self.version
+        if not self.apply_graph(self.pending[eb_key].version):
+            return False
+        if self.version != version:
+            # the states of the pending heartbeats belong to the nodes of the previous version
+            self.scoped = bool(self.graph) and self.graph.heartbeat_scoped(self.color)
+            self.states.clear()
+            self.active = None
+        return True
+
+    def _switch(self, eb_key):
+        """
+        Swaps the state of a heartbeat into the graph if the state of the
+        graph only holds the current heartbeat, and reduces the contributions
+        to it which were buffered so far.
+
+        Args:
+            eb_key (Heartbeat): the heartbeat.
 
-        size = self.completion(eb_key, identity, self.pending[eb_key], drop)
+        Returns:
+            True if the contributions to the heartbeat can be reduced as they
+            arrive.
+        """
+        if not self.scoped:
+            return False
+        if self.active != eb_key:
+            state = self.graph.swap_state(self.color, self.states.pop(eb_key, None))
+            if self.active is not None:
+                self.states[self.active] = state
+            self.active = eb_key
+            for data in self.buffered.pop(eb_key, {}).values():
+                self._execute(eb_key, data)
+        return True
 
+    def _execute(self, eb_key, data):
+        """
+        Executes the graph on a contribution to the heartbeat whose state is
+        in the graph. Only the results of the graph are kept, which hold the
+        reduced state of all the contributions so far.
+
+        Args:
+            eb_key (Heartbeat): the heartbeat.
+            data (dict): the contribution to the heartbeat.
+        """
         if self.graph:
+            start = time.time()
+            res = self.graph(data, color=self.color)
+            stop = time.time()
+            self.pending[eb_key].update(res)
+            exec_time = self.graph.times()
+            if exec_time:
+                self.times.setdefault(eb_key, []).append((start, stop, exec_time))
+
+    def _complete(self, eb_key, identity, drop):
+        executed = self._apply(eb_key)
+        if executed:
+            self._switch(eb_key)
+            # the contributions which could not be reduced as they arrived
+            for data in self.buffered.pop(eb_key, {}).values():
+                self._execute(eb_key, data)
+        else:
+            # the graph version of the heartbeat is not available
+            self.pending[eb_key].clear()
+            self.buffered.pop(eb_key, None)
+            self.states.pop(eb_key, None)
+        times = self.times.pop(eb_key, [])
+
+        received = bin(self.contribs[eb_key]).count('1')
+        missing = self.missing.get(eb_key, 0) + (self.num_contribs - received) * self.workers
+        skipped = self.skipped.get(eb_key, 0.0) / received if received else 0.0
+        size = self.completion(eb_key, identity, self.pending[eb_key], drop, missing, skipped)
+
+        if self.active == eb_key:
+            self.active = None
+        if executed and self.graph:
             self.graph.heartbeat_finished()
 
         return times, size
 
-    def _update(self, eb_key, eb_id, ver_key, data):
+    def _update(self, eb_key, eb_id, ver_key, data, missing=0, skipped=0.0):
         if eb_key not in self.pending:
             self.pending[eb_key] = Store(version=ver_key)
             self.contribs[eb_key] = 0
+            heapq.heappush(self.order, eb_key)
+            if self.deadline is not None:
+                self.deadlines[eb_key] = time.monotonic() + self.deadline
+        if missing:
+            self.missing[eb_key] = self.missing.get(eb_key, 0) + missing
+        if skipped:
+            self.skipped[eb_key] = self.skipped.get(eb_key, 0.0) + skipped
         if eb_key > self.latest:
             self.latest = eb_key
         if ver_key != self.pending[eb_key].version:
             logger.error("Graph version mismatch: heartbeat %s from id %s has version %s when %s was expected",
                          eb_key, eb_id, ver_key, self.pending[eb_key].version)
+        elif self.contribs[eb_key] & (1 << eb_id):
+            logger.error("Duplicate contribution: heartbeat %s already has a contribution from id %s",
+                         eb_key, eb_id)
+        elif self._apply(eb_key) and self._switch(eb_key):
+            self._execute(eb_key, data)
         else:
-            self.pending[eb_key].put(eb_id, data)
+            self.buffered.setdefault(eb_key, {})[eb_id] = data
 
 
 class TransitionBuilder(ContributionBuilder, ZmqHandler):
-    def __init__(self, num_contribs, addr, ctx=None):
+    def __init__(self, num_contribs, addr, ctx=None, compression=None):
         ContributionBuilder.__init__(self, num_contribs)
-        ZmqHandler.__init__(self, addr, ctx)
+        ZmqHandler.__init__(self, addr, ctx, compression)
 
     def _complete(self, eb_key, identity, drop):
         if not drop:
@@ -585,18 +1041,20 @@ class TransitionBuilder(ContributionBuilder, ZmqHandler):
 
 class EventBuilder(ZmqHandler):
 
-    def __init__(self, num_contribs, depth, color, addr, ctx=None):
-        super().__init__(addr, ctx)
+    def __init__(self, num_contribs, depth, color, addr, ctx=None, compression=None, deadline=None):
+        super().__init__(addr, ctx, compression)
         self.num_contribs = num_contribs
         self.depth = depth
         self.color = color
+        self.deadline = deadline
         self.builders = {}
 
     def create(self, name):
         self.builders[name] = GraphBuilder(self.num_contribs,
                                            self.depth,
                                            self.color,
-                                           functools.partial(self.completion, name))
+                                           functools.partial(self.completion, name),
+                                           self.deadline)
 
     def destroy(self, name):
         del self.builders[name]
@@ -604,6 +1062,9 @@ class EventBuilder(ZmqHandler):
     def prune(self, name, identity, prune_key=None, drop=False):
         return self.builders[name].prune(identity, prune_key, drop)
 
+    def expire(self, name, identity, now=None, drop=False):
+        return self.builders[name].expire(identity, now, drop)
+
     def flush(self, identity, drop=False):
         pruned_heartbeats = []
         for name, builder in self.builders.items():
@@ -632,14 +1093,15 @@ class EventBuilder(ZmqHandler):
     def complete(self, name, eb_key, identity, drop=False):
         return self.builders[name].complete(eb_key, identity, drop)
 
-    def completion(self, name, eb_key, identity, payload, drop):
+    def completion(self, name, eb_key, identity, payload, drop, missing=0, skipped=0.0):
         if not drop:
-            return self.collector_message(identity, eb_key, name, payload.version, payload.namespace)
+            return self.collector_message(identity, eb_key, name, payload.version, payload.namespace,
+                                          skipped=skipped, missing=missing)
 
-    def update(self, name, eb_key, eb_id, ver_key, data):
+    def update(self, name, eb_key, eb_id, ver_key, data, missing=0, skipped=0.0):
         if name not in self.builders:
             self.create(name)
-        self.builders[name].update(eb_key, eb_id, ver_key, data)
+        self.builders[name].update(eb_key, eb_id, ver_key, data, missing=missing, skipped=skipped)
 
     def contribs(self, name):
         return self.builders[name].contribs
@@ -869,6 +1331,127 @@ class Node(abc.ABC):
         return port
 
 
+class Metrics:
+    """Low overhead facade over the prometheus metrics of an AMI process.
+
+    Looking up the labelled child of a prometheus metric hashes the label
+    values and takes a lock, which is too expensive to do for every event.
+    Instead the counts, times and sizes are accumulated in plain dictionaries
+    and only pushed to prometheus when `flush` is called, which is done once
+    per heartbeat. The labelled children are looked up once and then cached.
+
+    Args:
+        hutch (str): the hutch label of the metrics.
+        name (str): the process label of the metrics.
+    """
+
+    def __init__(self, hutch, name):
+        self.hutch = hutch
+        self.name = name
+        self.event_counter = pc.Counter('ami_event_count', 'Event Counter', ['hutch', 'type', 'process'])
+        self.event_time = pc.Gauge('ami_event_time_secs', 'Event Time', ['hutch', 'type', 'process'])
+        self.event_size = pc.Gauge('ami_event_size_bytes', 'Event Size', ['hutch', 'process'])
+        self.event_latency = pc.Gauge('ami_event_latency_secs', 'Event Latency', ['hutch', 'sender', 'process'])
+        self.gauges = {}
+        self.children = {}
+        self.counts = {}
+        self.times = {}
+        self.latencies = {}
+        self.values = {}
+        self.size = None
+
+    def add_gauge(self, key, name, documentation):
+        """
+        Adds an extra gauge labelled with the hutch and process.
+
+        Args:
+            key (str): the key used to set the value of the gauge.
+            name (str): the prometheus name of the gauge.
+            documentation (str): the description of the gauge.
+        """
+        self.gauges[key] = pc.Gauge(name, documentation, ['hutch', 'process']).labels(self.hutch, self.name)
+
+    def count(self, mtype, value=1):
+        """
+        Increments the event counter of the passed type.
+
+        Args:
+            mtype (str): the type label of the counter.
+            value (int): the amount to increment the counter by.
+        """
+        self.counts[mtype] = self.counts.get(mtype, 0) + value
+
+    def time(self, mtype, value):
+        """
+        Sets the event time of the passed type.
+
+        Args:
+            mtype (str): the type label of the time.
+            value (float): the time in seconds.
+        """
+        self.times[mtype] = value
+
+    def latency(self, sender, value):
+        """
+        Sets the event latency of messages from the passed sender.
+
+        Args:
+            sender (str): the name of the sender of the messages.
+            value (float): the latency in seconds.
+        """
+        self.latencies[sender] = value
+
+    def set(self, key, value):
+        """
+        Sets the value of a gauge added with `add_gauge`.
+
+        Args:
+            key (str): the key of the gauge.
+            value (float): the value of the gauge.
+        """
+        self.values[key] = value
+
+    def set_size(self, value):
+        """
+        Sets the event size.
+
+        Args:
+            value (int): the size in bytes.
+        """
+        self.size = value
+
+    def _child(self, metric, label):
+        key = (metric, label)
+        child = self.children.get(key)
+        if child is None:
+            child = getattr(self, metric).labels(self.hutch, label, self.name)
+            self.children[key] = child
+        return child
+
+    def flush(self):
+        """
+        Pushes all the accumulated values to prometheus.
+        """
+        for mtype, value in self.counts.items():
+            self._child('event_counter', mtype).inc(value)
+        for mtype, value in self.times.items():
+            self._child('event_time', mtype).set(value)
+        for sender, value in self.latencies.items():
+            self._child('event_latency', sender).set(value)
+        for key, value in self.values.items():
+            self.gauges[key].set(value)
+        if self.size is not None:
+            if 'event_size' not in self.children:
+                self.children['event_size'] = self.event_size.labels(self.hutch, self.name)
+            self.children['event_size'].set(self.size)
+
+        self.counts.clear()
+        self.times.clear()
+        self.latencies.clear()
+        self.values.clear()
+        self.size = None
+
+
 class Collector(abc.ABC):
     """Abstract base class for collecting (via zeromq) results from many
     node's ResultStores.
@@ -901,11 +1484,10 @@ class Collector(abc.ABC):
         self.exitcode = 0
         self.deserializer = Deserializer()
         self.hutch = hutch
+        # the timeout in milliseconds of polling the sockets, after which `process_timeout` is called
+        self.poll_timeout = None
 
-        self.event_counter = pc.Counter('ami_event_count', 'Event Counter', ['hutch', 'type', 'process'])
-        self.event_time = pc.Gauge('ami_event_time_secs', 'Event Time', ['hutch', 'type', 'process'])
-        self.event_size = pc.Gauge('ami_event_size_bytes', 'Event Size', ['hutch', 'process'])
-        self.event_latency = pc.Gauge('ami_event_latency_secs', 'Event Latency', ['hutch', 'sender', 'process'])
+        self.metrics = Metrics(hutch, self.name)
 
     def register(self, sock, handler):
         """
@@ -945,6 +1527,14 @@ class Collector(abc.ABC):
         """
         pass
 
+    def process_timeout(self):
+        """
+        A method that subclasses can override which is called after each poll
+        of the sockets when `poll_timeout` is set, including polls which timed
+        out without any data.
+        """
+        pass
+
     def run(self):
         """
         The main collector loop runs forever polling the collector socket
@@ -958,11 +1548,11 @@ class Collector(abc.ABC):
         idle_start = time.time()
         reset_idle = False
         while self.running:
-            for sock, flag in self.poller.poll():
+            for sock, flag in self.poller.poll(self.poll_timeout):
                 if flag != zmq.POLLIN:
                     continue
 
-                self.event_time.labels(self.hutch, 'Idle', self.name).set(time.time() - idle_start)
+                self.metrics.time('Idle', time.time() - idle_start)
                 reset_idle = True
 
                 if sock is self.collector:
@@ -971,6 +1561,9 @@ class Collector(abc.ABC):
                 elif sock in self.handlers:
                     self.handlers[sock]()
 
+            if self.poll_timeout is not None:
+                self.process_timeout()
+
             if reset_idle:
                 reset_idle = False
                 idle_start = time.time()
@@ -1428,6 +2021,30 @@ class CommHandler(abc.ABC):
         """
         return self._request('get_heartbeat')
 
+    @property
+    def missing(self):
+        """
+        Fetches the number of workers whose results are missing from the
+        latest heartbeat for which the graph manager has received results from
+        the graph, because the heartbeat was completed before they arrived.
+
+        Returns:
+            The number of workers missing from the latest heartbeat.
+        """
+        return self._request('get_missing')
+
+    @property
+    def skipped(self):
+        """
+        Fetches the fraction of the events of the latest heartbeat for which
+        the graph manager has received results from the graph that the
+        workers skipped to stay within their time budget.
+
+        Returns:
+            The fraction of the events skipped in the latest heartbeat.
+        """
+        return self._request('get_skipped')
+
     @property
     def graph(self):
         """
@@ -1,13 +1,24 @@
+import os
+import re
 import sys
 import abc
 import zmq
 import time
 import dill
+import mmap
+import struct
 import typing
 import inspect
 import logging
 import datetime
+import itertools
 import pickle
+import zlib
+import lzma
+import queue
+import functools
+import threading
+import collections.abc
 try:
     import h5py
 except ImportError:
@@ -20,10 +31,18 @@ try:
     import pyarrow as pa
 except ImportError:
     pa = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 import numpy as np
 import amitypes as at
 from enum import Enum
-from dataclasses import dataclass, asdict, field
+from dataclasses import dataclass, field
 
 
 logger = logging.getLogger(__name__)
@@ -62,7 +81,7 @@ class Transition:
     payload: dict
 
     def _serialize(self):
-        return asdict(self)
+        return self.__dict__
 
     @classmethod
     def _deserialize(cls, data):
@@ -103,7 +122,7 @@ class Heartbeat:
         return self.identity >= other
 
     def _serialize(self):
-        return asdict(self)
+        return self.__dict__
 
     @classmethod
     def _deserialize(cls, data):
@@ -142,10 +161,11 @@ class Message:
     timestamp: int = 0
 
     def _serialize(self):
-        return asdict(self)
+        # the fields are passed as is, since asdict would deep copy the payload
+        return self.__dict__
 
     def _deserialize(data):
-        if data['mtype'] == MsgTypes.Transition:
+        if data['mtype'] == MsgTypes.Transition and isinstance(data['payload'], dict):
             data['payload'] = Transition(**data['payload'])
         return Message(**data)
 
@@ -161,10 +181,47 @@ class CollectorMessage(Message):
         name (str): name
 
         version (int): version
+
+        skipped (float): fraction of the events skipped by the worker prescaler
+
+        missing (int): number of workers whose contributions are missing from
+            the heartbeat because it was completed before they arrived
     """
     heartbeat: Heartbeat = Heartbeat()
     name: str = ""
     version: int = 0
+    skipped: float = 0.0
+    missing: int = 0
+
+    def _serialize(self):
+        return self.__dict__
+
+    @classmethod
+    def _deserialize(cls, data):
+        return cls(**data)
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    """
+    Descriptor of an array stored in a shared memory segment
+
+    Args:
+        segment (str): name of the shared memory segment
+
+        seq (int): sequence number of the allocation in the segment
+
+        offset (int): byte offset of the array in the segment
+
+        shape (tuple): shape of the array
+
+        dtype (str): numpy type string of the array
+    """
+    segment: str
+    seq: int
+    offset: int
+    shape: tuple
+    dtype: str
 
     def _serialize(self):
         return self.__dict__
@@ -182,7 +239,7 @@ def build_serialization_context():
 
     context = pa.SerializationContext()
     for cls in [MsgTypes, Transitions, Heartbeat, Message,
-                CollectorMessage, Transition, Datagram]:
+                CollectorMessage, Transition, Datagram, SharedArray]:
         register(context, cls)
     for cls in at.PyArrowTypes:
         register(context, cls)
@@ -242,31 +299,378 @@ class ArrowSerializer:
 
 
 class ArrowDeserializer:
+    """
+    Deserializes messages serialized by `ArrowSerializer`. Messages from links
+    with compression, which always use the pickle5 protocol, are deserialized
+    as well, since arrow may be the default protocol of the receiving end.
+    """
 
     def __init__(self):
         self.context = build_serialization_context()
 
     def __call__(self, data):
-        components = pickle.loads(data[0])
+        if Compressor.compressed(data):
+            return Pickle5Deserializer()(data)
+        components = pickle.loads(data[0], buffers=data[1:])
+        if not isinstance(components, dict) or 'num_buffers' not in components:
+            # an uncompressed pickle5 message
+            return components
         data = list(map(pa.py_buffer, data[1:]))
         components['data'] = data
         return pa.deserialize_components(components, context=self.context)
 
 
+class DillWrapper:
+    """
+    Wraps an object which the pickle module cannot serialize, like a lambda,
+    so that it is serialized with dill instead. The pickled wrapper unpickles
+    as the original object.
+
+    Args:
+        obj: the object to wrap.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __reduce__(self):
+        return dill.loads, (dill.dumps(self.obj),)
+
+
+class ZlibCodec:
+    """
+    Compresses data with zlib from the standard library.
+
+    Args:
+        level (int): the compression level from 0 to 9 (default: 1).
+    """
+
+    ident = 1
+
+    def __init__(self, level=None):
+        self.level = 1 if level is None else level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    @staticmethod
+    def decompress(data):
+        return zlib.decompress(data)
+
+
+class LzmaCodec:
+    """
+    Compresses data with lzma from the standard library, which compresses
+    better than zlib but is much slower.
+
+    Args:
+        level (int): the compression preset from 0 to 9 (default: 0).
+    """
+
+    ident = 2
+
+    def __init__(self, level=None):
+        self.level = 0 if level is None else level
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.level)
+
+    @staticmethod
+    def decompress(data):
+        return lzma.decompress(data)
+
+
+class Lz4Codec:
+    """
+    Compresses data with lz4, which is much faster than zlib. Requires the
+    lz4 package.
+
+    Args:
+        level (int): the compression level from 0 to 16 (default: 0).
+    """
+
+    ident = 3
+
+    def __init__(self, level=None):
+        if lz4 is None:
+            raise NotImplementedError("lz4 compression is not avaliable!")
+        self.level = 0 if level is None else level
+
+    def compress(self, data):
+        return lz4.frame.compress(data, compression_level=self.level)
+
+    @staticmethod
+    def decompress(data):
+        return lz4.frame.decompress(data)
+
+
+class ZstdCodec:
+    """
+    Compresses data with zstandard, which is faster than zlib and compresses
+    better. Requires the zstandard package.
+
+    Args:
+        level (int): the compression level from 1 to 22 (default: 1).
+    """
+
+    ident = 4
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise NotImplementedError("zstd compression is not avaliable!")
+        self.compressor = zstandard.ZstdCompressor(level=1 if level is None else level)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    @staticmethod
+    def decompress(data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CompressionCodecs = {
+    'zlib': ZlibCodec,
+    'lzma': LzmaCodec,
+    'lz4': Lz4Codec,
+    'zstd': ZstdCodec,
+}
+
+
+class Compressor:
+    """
+    Compresses the frames of messages serialized by `Pickle5Serializer`.
+
+    Frames at least as large as the threshold are compressed with the codec,
+    and a header frame describing how to decompress each of the frames is
+    prepended to the message. The buffers of arrays with multibyte elements
+    can be byte shuffled first, which groups the similar exponent bytes of
+    floats together and makes them compress much better. Frames which do not
+    get smaller are sent uncompressed.
+
+    Args:
+        codec (str): the name of the compression codec in `CompressionCodecs`.
+        level (int): the compression level of the codec, or None for its
+            default level.
+        threshold (int): the minimum size in bytes of the frames to compress.
+        shuffle (bool): byte shuffle the buffers of arrays before compressing.
+    """
+
+    Magic = b'AMIZ'
+    Frame = struct.Struct('<BBQ')
+
+    def __init__(self, codec='zlib', level=None, threshold=zmq.COPY_THRESHOLD, shuffle=True):
+        if codec not in CompressionCodecs:
+            raise ValueError("Unknown compression codec: %s" % codec)
+        self.codec = CompressionCodecs[codec](level)
+        self.threshold = threshold
+        self.shuffle = shuffle
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.elapsed = 0.0
+
+    def compress(self, frames):
+        """
+        Compresses the frames of a serialized message.
+
+        Args:
+            frames (list): the pickled data followed by the `PickleBuffer`
+                objects of the out-of-band buffers.
+
+        Returns:
+            The list of frames to send, which starts with a header frame if
+            any of the frames were compressed.
+        """
+        start = time.perf_counter()
+        header = [self.Magic]
+        compressed = []
+        any_compressed = False
+        for frame in frames:
+            view = memoryview(frame)
+            raw = frame.raw() if isinstance(frame, pickle.PickleBuffer) else view
+            itemsize = view.itemsize if self.shuffle else 1
+            if raw.nbytes < self.threshold:
+                header.append(self.Frame.pack(0, 0, raw.nbytes))
+                compressed.append(raw)
+                continue
+
+            if itemsize > 1:
+                data = np.frombuffer(raw, dtype=np.uint8).reshape(-1, itemsize).T.copy()
+            else:
+                data = raw
+            out = self.codec.compress(data)
+            self.raw_bytes += raw.nbytes
+            if len(out) < raw.nbytes:
+                self.compressed_bytes += len(out)
+                any_compressed = True
+                header.append(self.Frame.pack(self.codec.ident, itemsize, raw.nbytes))
+                compressed.append(memoryview(out))
+            else:
+                self.compressed_bytes += raw.nbytes
+                header.append(self.Frame.pack(0, 0, raw.nbytes))
+                compressed.append(raw)
+        self.elapsed += time.perf_counter() - start
+
+        if not any_compressed:
+            return [frames[0]] + compressed[1:]
+        return [b''.join(header)] + compressed
+
+    @classmethod
+    def decompress(cls, frames):
+        """
+        Decompresses the frames of a message serialized with compression.
+
+        Args:
+            frames (list): the received frames, starting with the header.
+
+        Returns:
+            The list of the decompressed frames.
+        """
+        header = memoryview(frames[0])[len(cls.Magic):]
+        decompressed = []
+        for i, frame in enumerate(frames[1:]):
+            ident, itemsize, nbytes = cls.Frame.unpack_from(header, i * cls.Frame.size)
+            if ident == 0:
+                decompressed.append(frame)
+                continue
+
+            data = np.frombuffer(CompressionIdents[ident].decompress(frame), dtype=np.uint8)
+            if itemsize > 1:
+                # unshuffling copies the data into a new writable array
+                out = np.empty(nbytes, dtype=np.uint8)
+                out.reshape(-1, itemsize)[:] = data.reshape(itemsize, -1).T
+            else:
+                out = data.copy()
+            decompressed.append(out)
+        return decompressed
+
+    @classmethod
+    def compressed(cls, frames):
+        """
+        Checks whether the frames of a message start with a compression header.
+        """
+        return len(frames) > 1 and memoryview(frames[0])[:len(cls.Magic)] == cls.Magic
+
+    def stats(self):
+        """
+        Returns the compression ratio and the time in seconds spent compressing
+        since the last call, or None if nothing was compressed.
+        """
+        if self.raw_bytes == 0:
+            return None
+        stats = (self.raw_bytes / self.compressed_bytes, self.elapsed)
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.elapsed = 0.0
+        return stats
+
+
+CompressionIdents = {cls.ident: cls for cls in CompressionCodecs.values()}
+
+
+def parse_compression(spec):
+    """
+    Creates the compressor described by a string of the form 'codec[:level]',
+    e.g. 'zlib' or 'zstd:3'.
+
+    Args:
+        spec (str): the description of the compression, or None for no
+            compression.
+
+    Returns:
+        A `Compressor` or None.
+    """
+    if not spec:
+        return None
+    codec, _, level = spec.partition(':')
+    try:
+        level = int(level) if level else None
+    except ValueError:
+        raise ValueError("Invalid compression level in %s" % spec) from None
+    return Compressor(codec, level)
+
+
+class Pickle5Serializer:
+    """
+    Serializes messages with pickle protocol 5. The buffers of arrays are
+    sent out-of-band as separate frames after the pickled message, so they
+    are never copied into the pickled data. Buffers smaller than
+    `zmq.COPY_THRESHOLD` are kept in the pickled data, since zmq copies
+    small frames anyway and each extra frame has its own overhead. Messages
+    which cannot be pickled are serialized with dill in a single frame
+    instead.
+
+    Args:
+        compression (Compressor): an optional compressor for the large frames
+            of the messages.
+    """
+
+    def __init__(self, compression=None):
+        self.compression = compression
+
+    def __call__(self, msg):
+        buffers = []
+
+        def out_of_band(buf):
+            # returning True serializes the buffer in-band
+            if buf.raw().nbytes < zmq.COPY_THRESHOLD:
+                return True
+            buffers.append(buf)
+
+        try:
+            data = pickle.dumps(msg, protocol=5, buffer_callback=out_of_band)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            buffers = []
+            data = pickle.dumps(DillWrapper(msg), protocol=5)
+        if self.compression is not None:
+            return self.compression.compress([data] + buffers)
+        return [data] + [buf.raw() for buf in buffers]
+
+    def sizeof(self, msg):
+        assert type(msg) is list and type(msg[0]) is bytes, "Excepts serialized message!"
+        size = sys.getsizeof(msg[0])
+        for c in msg[1:]:
+            size += c.nbytes
+        return size
+
+
+class Pickle5Deserializer:
+    """
+    Deserializes messages serialized by `Pickle5Serializer`. Arrays are
+    created as views of the frames of their buffers without copying them,
+    unless the frames were compressed.
+    """
+
+    def __call__(self, data):
+        if len(data) == 0:
+            return None
+        if Compressor.compressed(data):
+            data = Compressor.decompress(data)
+        return pickle.loads(data[0], buffers=data[1:])
+
+
 SerializationProtocols = {
     'pickle': (ModuleSerializer, ModuleDeserializer, {'module': pickle}),
+    'pickle5': (Pickle5Serializer, Pickle5Deserializer, {}),
     'dill': (ModuleSerializer, ModuleDeserializer, {'module': dill}),
     'arrow': (ArrowSerializer, ArrowDeserializer, {}),
+    # pyarrow removed its serialization functions in version 2.0
     None:
         (ArrowSerializer, ArrowDeserializer, {})
-        if pa is not None else
-        (ModuleSerializer, ModuleDeserializer, {'module': dill}),
+        if pa is not None and hasattr(pa, 'serialize') else
+        (Pickle5Serializer, Pickle5Deserializer, {}),
 }
 
 
-def Serializer(protocol=None):
+def Serializer(protocol=None, compression=None):
+    # compression is only available with the pickle5 protocol, which may not be the default one
+    if protocol is None and compression is not None:
+        protocol = 'pickle5'
     if protocol in SerializationProtocols:
         cls, _, kwargs = SerializationProtocols[protocol]
+        if compression is not None:
+            if cls is not Pickle5Serializer:
+                raise NotImplementedError("compression is only avaliable with the pickle5 protocol!")
+            kwargs = dict(kwargs, compression=compression)
         return cls(**kwargs)
     else:
         raise NotImplementedError("%s protocol is not avaliable!" % protocol)
@@ -280,6 +684,51 @@ def Deserializer(protocol=None):
         raise NotImplementedError("%s protocol is not avaliable!" % protocol)
 
 
+SelectionPattern = re.compile(r'^(?P<name>.+)\[(?P<selection>-?\d*:-?\d*(,-?\d*:-?\d*)*)\]$')
+
+
+def selection_name(name, selection):
+    """
+    Generates the name used for requesting a selection of the data of a
+    source, e.g. 'cspad[0:10,5:20]'.
+
+    Args:
+        name (str): the name of the data.
+        selection (tuple): a tuple of slices, one for each of the leading
+            dimensions of the data.
+
+    Returns:
+        The name of the selection of the data.
+    """
+    def bound(value):
+        return '' if value is None else '%d' % value
+
+    return '%s[%s]' % (name, ','.join('%s:%s' % (bound(s.start), bound(s.stop)) for s in selection))
+
+
+def parse_selection(name):
+    """
+    Parses a name generated by `selection_name`.
+
+    Args:
+        name (str): the name to parse.
+
+    Returns:
+        A tuple of the name of the data and the tuple of slices of the
+        selection. If the name is not a selection, the name and None are
+        returned.
+    """
+    match = SelectionPattern.match(name)
+    if match is None:
+        return name, None
+
+    def bound(value):
+        return int(value) if value else None
+
+    selection = tuple(slice(*map(bound, dim.split(':'))) for dim in match.group('selection').split(','))
+    return match.group('name'), selection
+
+
 class TimestampConverter:
     def __init__(self, shift=32, heartbeat=1000):
         self.shift = shift
@@ -308,6 +757,64 @@ class TimestampConverter:
         return timestamp, int(timestamp * self.heartbeat), unix_ts
 
 
+class LazyPayload(collections.abc.MutableMapping):
+    """Event payload which only reads the data from the source when needed.
+
+    Each requested name is mapped to a function which reads the data for the
+    name from the event. The function is called the first time the name is
+    accessed and the result is cached. Anything which iterates over the
+    values of the payload causes all of the data to be read.
+
+    Args:
+        loaders (dict): a dictionary of names to functions, taking no
+            arguments, which return the data for that name.
+    """
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.values = {}
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            self.values[name] = self.loaders.pop(name)()
+        return self.values[name]
+
+    def __setitem__(self, name, value):
+        self.loaders.pop(name, None)
+        self.values[name] = value
+
+    def __delitem__(self, name):
+        if name in self.values:
+            del self.values[name]
+        else:
+            del self.loaders[name]
+
+    def __contains__(self, name):
+        return name in self.values or name in self.loaders
+
+    def __iter__(self):
+        yield from list(self.values)
+        yield from list(self.loaders)
+
+    def __len__(self):
+        return len(self.values) + len(self.loaders)
+
+    def __repr__(self):
+        return "LazyPayload(loaded=%s, pending=%s)" % (list(self.values), list(self.loaders))
+
+    def load(self, skip=()):
+        """
+        Reads all the data of the payload, except for any skipped names.
+
+        Args:
+            skip (set): names which should not be read.
+
+        Returns:
+            A dictionary of the data that was read.
+        """
+        return {name: self[name] for name in list(self) if name not in skip}
+
+
 class Source(abc.ABC):
     def __init__(self, idnum, num_workers, heartbeat_period, src_cfg, flags=None, ts_type=None):
         """
@@ -328,6 +835,7 @@ class Source(abc.ABC):
         self.requested_names = set()
         self.requested_data = set()
         self.requested_special = {}
+        self.requested_selections = {}
         self.config = src_cfg
         self.flags = flags or {}
         self.source = at.DataSource(self.config)
@@ -340,6 +848,10 @@ class Source(abc.ABC):
         self._flag_types = {
             'interval': float,
             'init_time': float,
+            'rate': float,
+            'block': int,
+            'pool': int,
+            'lease': int,
             'bound': int,
             'repeat': lambda s: s.lower() == 'true',
             'counting': lambda s: s.lower() == 'true',
@@ -555,6 +1067,8 @@ class Source(abc.ABC):
         Returns:
             An object of type `Message` which includes the data for the event.
         """
+        if self.requested_selections:
+            self._select(data)
         base = [
             ('timestamp', timestamp),
             ('heartbeat', self.heartbeat.identity if self.heartbeat is not None else None),
@@ -564,10 +1078,37 @@ class Source(abc.ABC):
         msg = Message(mtype=MsgTypes.Datagram, identity=self.idnum, payload=data, timestamp=timestamp)
         yield msg
 
+    def _select(self, data):
+        """
+        Adds the requested selections to the data of an event which the source
+        has not already read itself, by slicing them from the full data. The
+        full data is then removed unless it was requested too.
+
+        Args:
+            data (dict): the data of the event
+        """
+        for name, (base, selection) in self.requested_selections.items():
+            if name in data or base not in data:
+                continue
+            if isinstance(data, LazyPayload):
+                data.loaders[name] = functools.partial(Source._crop, data, base, selection)
+            else:
+                data[name] = Source._crop(data, base, selection)
+        if not isinstance(data, LazyPayload):
+            for base, _ in self.requested_selections.values():
+                if base not in self.requested_names:
+                    data.pop(base, None)
+
+    @staticmethod
+    def _crop(data, name, selection):
+        value = data[name]
+        return None if value is None else value[selection]
+
     def request(self, names):
         """
         Request that the source includes the specified data from its list of
-        available data when it emits event messages.
+        available data when it emits event messages. Names generated by
+        `selection_name` request only a selection of the data.
 
         Args:
             names (list): names of the data being requested
@@ -575,6 +1116,7 @@ class Source(abc.ABC):
         self.requested_names = set(names)
         self.requested_data = set()
         self.requested_special = {}
+        self.requested_selections = {}
         for name in self.requested_names:
             if name in self.special_names:
                 sub_name, info = self.special_names[name]
@@ -582,8 +1124,12 @@ class Source(abc.ABC):
                     self.requested_special[sub_name] = {}
                 self.requested_special[sub_name][name] = info
             elif name not in self._base_names:
+                base, selection = parse_selection(name)
                 if name in self.names:
                     self.requested_data.add(name)
+                elif selection is not None and base in self.names:
+                    self.requested_selections[name] = (base, selection)
+                    self.requested_data.add(base)
                 else:
                     logger.debug("DataSrc: requested source \'%s\' is not available", name)
 
@@ -676,6 +1222,28 @@ class HierarchicalDataSource(Source):
     def counting_mode(self):
         return self.config.get('counting', True)
 
+    @property
+    def lazy_mode(self):
+        return self.config.get('lazy', False)
+
+    def _payload(self, loaders):
+        """
+        Builds the payload of an event from functions which read its data. In
+        lazy mode the data is only read when the payload is accessed, otherwise
+        all of it is read immediately.
+
+        Args:
+            loaders (dict): a dictionary of names to functions, taking no
+                arguments, which return the data for that name.
+
+        Returns:
+            The payload of the event.
+        """
+        if self.lazy_mode:
+            return LazyPayload(loaders)
+        else:
+            return {name: loader() for name, loader in loaders.items()}
+
     @property
     def repeat(self):
         if self.loop_count and not self.repeat_mode:
@@ -747,6 +1315,8 @@ class PsanaSource(HierarchicalDataSource):
     def __init__(self, idnum, num_workers, heartbeat_period, src_cfg, flags=None):
         super().__init__(idnum, num_workers, heartbeat_period, src_cfg, flags, float)
         self.ts_converter = TimestampConverter()
+        self.accessors = None
+        self.special_accessors = []
         self.ds_keys = {
             'exp', 'dir', 'files', 'shmem', 'filter', 'batch_size', 'max_events', 'sel_det_ids', 'det_name', 'run'
         }
@@ -857,6 +1427,7 @@ class PsanaSource(HierarchicalDataSource):
         self.detectors = {}
         self.env_detectors = set()
         self.special_names = {}
+        self.accessors = None
         for detname, det_xface_name, det_attr_list, is_env_det in self._detinfo(run):
             # make & cache the psana Detector object
             det_interface = self._update_dets(run, detname, is_env_det)
@@ -894,65 +1465,119 @@ class PsanaSource(HierarchicalDataSource):
             # if the det interface has more than one attr make a grouped source
             self._update_group(detname, det_xface_name, det_attr_list, is_env_det)
 
-    def _process(self, evt):
-        event = {}
+    def _det_attr(self, detname, tokens):
+        # loop to the bottom level of the Det obj
+        obj = self.detectors[detname].det
+        for token in tokens:
+            obj = getattr(obj, token)
+        return obj
 
-        for name in self.requested_data:
-            # check if it is a special type like calibconst
-            if name in self.special_types:
-                obj = self.special_types[name]
-                # check if the object is callable or not before adding to the event
-                event[name] = obj() if callable(obj) else obj
-            elif name in self.detectors and name not in self.env_detectors:
-                event[name] = self.detectors[name]
+    @staticmethod
+    def _const_accessor(value):
+        return lambda evt: value
+
+    @staticmethod
+    def _call_accessor(obj):
+        return lambda evt: obj()
+
+    def _group_accessor(self, name, obj, attrs):
+        methods = [(attr, getattr(obj, attr)) for attr in attrs]
+        obj_type = type(obj).__name__
+
+        def accessor(evt):
+            return at.Group(name, self.src_type, obj_type, {attr: meth(evt) for attr, meth in methods})
+
+        return accessor
+
+    def _accessor(self, name):
+        """
+        Compiles the function used to read the data for a requested name
+        from an event.
+
+        Args:
+            name (str): the requested name.
+
+        Returns:
+            A function which takes the event and returns its data.
+        """
+        # check if it is a special type like calibconst
+        if name in self.special_types:
+            obj = self.special_types[name]
+            # check if the object is callable or not before adding to the event
+            return self._call_accessor(obj) if callable(obj) else self._const_accessor(obj)
+        elif name in self.detectors and name not in self.env_detectors:
+            return self._const_accessor(self.detectors[name])
+        elif name in self.env_detectors:
+            return self._det_attr(name, [])
+        else:
+            # each name is like "detname:drp_class_name:attrN"
+            namesplit = name.split(':')
+            obj = self._det_attr(namesplit[0], namesplit[1:])
+            if name in self.grouped_types:
+                return self._group_accessor(name, obj, self.grouped_types[name])
             else:
-                if name in self.env_detectors:
-                    namesplit = []
-                    detname = name
-                else:
-                    # each name is like "detname:drp_class_name:attrN"
-                    namesplit = name.split(':')
-                    detname = namesplit[0]
-
-                if name in self.grouped_types:
-                    obj = self.detectors[detname].det
-                    for token in namesplit[1:]:
-                        obj = getattr(obj, token)
-                    grouped = {}
-                    for attr in self.grouped_types[name]:
-                        grouped[attr] = getattr(obj, attr)(evt)
-                    event[name] = at.Group(name, self.src_type, type(obj).__name__, grouped)
-                else:
-                    # loop to the bottom level of the Det obj and get data
-                    obj = self.detectors[detname].det
-                    for token in namesplit[1:]:
-                        obj = getattr(obj, token)
-                    event[name] = obj(evt)
+                return obj
 
+    def _compile(self):
+        """
+        Compiles the requested names into flat lists of the functions used to
+        read their data from an event, so that processing an event does no
+        parsing of names or lookups of detector attributes.
+        """
+        self.accessors = [(name, self._accessor(name)) for name in self.requested_data]
+        self.special_accessors = []
         for name, sub_names in self.requested_special.items():
             namesplit = name.split(':')
-            detname = namesplit[0]
+            read = self._det_attr(namesplit[0], namesplit[1:])
+            accesses = [(sub_name, meth, args, kwargs) for sub_name, (meth, args, kwargs) in sub_names.items()]
+            self.special_accessors.append((read, accesses))
+
+    def request(self, names):
+        super().request(names)
+        self.accessors = None
 
-            # loop to the bottom level of the Det obj and get data
-            obj = self.detectors[detname].det
-            for token in namesplit[1:]:
-                obj = getattr(obj, token)
-            data = obj(evt)
+    @staticmethod
+    def _access_special(read, meth, args, kwargs):
+        data = read()
+        if data is None:
+            return None
+        else:
+            return meth(data, *args, **kwargs)
+
+    def _process(self, evt):
+        if self.accessors is None:
+            self._compile()
+
+        if self.lazy_mode:
+            loaders = {name: functools.partial(read, evt) for name, read in self.accessors}
+            for read, accesses in self.special_accessors:
+                # the data returned by the det interface is shared by all the sub names
+                cached = functools.lru_cache(maxsize=None)(functools.partial(read, evt))
+                for sub_name, meth, args, kwargs in accesses:
+                    loaders[sub_name] = functools.partial(self._access_special, cached, meth, args, kwargs)
+            return LazyPayload(loaders)
+
+        event = {name: read(evt) for name, read in self.accessors}
+        for read, accesses in self.special_accessors:
+            data = read(evt)
             # access the requested methods of the object returned by the det interface
-            for sub_name, (meth, args, kwargs) in sub_names.items():
-                if data is None:
-                    event[sub_name] = None
-                else:
-                    event[sub_name] = meth(data, *args, **kwargs)
+            for sub_name, meth, args, kwargs in accesses:
+                event[sub_name] = None if data is None else meth(data, *args, **kwargs)
 
         return event
 
     def _cleanup(self):
         # clear the references to the detector interface
         self.detectors.clear()
+        self.accessors = None
 
 
 class Hdf5Source(HierarchicalDataSource):
+
+    DefaultBlockSize = 1024
+    DefaultBlockBytes = 64 * 1024 * 1024
+    ShardModes = (None, 'files', 'ranges')
+
     def __init__(self, idnum, num_workers, heartbeat_period, src_cfg, flags=None):
         super().__init__(idnum, num_workers, heartbeat_period, src_cfg, flags)
         self.hdf5_delim = "/"
@@ -961,6 +1586,12 @@ class Hdf5Source(HierarchicalDataSource):
         self.hdf5_idx = None
         self.hdf5_max_idx = self.hdf5_idx
         self.ts_converter = TimestampConverter()
+        self.datasets = {}
+        self.blocks = {}
+        self.block_size = None
+        self.shard = None
+        if self.shard_mode not in Hdf5Source.ShardModes:
+            raise ValueError("unknown shard mode for hdf5 source: %s" % self.shard_mode)
         if h5py is None:
             raise NotImplementedError("h5py is not available!")
 
@@ -992,26 +1623,160 @@ class Hdf5Source(HierarchicalDataSource):
     def repeat_mode(self):
         return self.config.get('repeat', False)
 
+    @property
+    def block_mode(self):
+        return self.config.get('blocks', False)
+
+    @property
+    def shard_mode(self):
+        """
+        Getter for the shard value set in the source configuration. This sets
+        how the events are distributed between the workers. By default the
+        workers take turns reading single events (or blocks of events in block
+        mode) from every file. If set to 'files' each worker reads all the
+        events of its share of the files, and if set to 'ranges' each worker
+        reads a contiguous range of the events of every file.
+
+        Returns:
+            The shard value set in the source configuration.
+        """
+        return self.config.get('shard')
+
+    def _block_size(self):
+        if 'block_size' in self.config:
+            return int(self.config['block_size'])
+        # align the blocks to the largest chunks of the datasets
+        chunks = [dset.chunks[0] for dset in self.datasets.values() if dset.chunks]
+        return max(chunks) if chunks else Hdf5Source.DefaultBlockSize
+
+    def _read_size(self, dset, dtype=None):
+        """
+        Finds the number of events to read at once from a dataset in block
+        mode. This is the chunk size of the dataset, if it is chunked, limited
+        to the block size and to the number of events which fit in the byte
+        budget for a block set in the source configuration.
+
+        Args:
+            dset (h5py.Dataset): the dataset to read from.
+            dtype (type): optional type to read the data as.
+
+        Returns:
+            The number of events to read at once.
+        """
+        size = min(dset.chunks[0], self.block_size) if dset.chunks else self.block_size
+        event_bytes = np.dtype(dset.dtype if dtype is None else dtype).itemsize * int(np.prod(dset.shape[1:]))
+        budget = int(self.config.get('block_bytes', Hdf5Source.DefaultBlockBytes))
+        return max(1, min(size, budget // max(event_bytes, 1)))
+
+    def _fetch(self, dset, index, dtype=None, selection=()):
+        """
+        Reads the data for an event from a dataset. In block mode the events
+        of the dataset are read into memory in pieces sized by its own
+        chunking the first time they are needed and the data is sliced from
+        them. Otherwise only the selection of the data is read from the file.
+
+        Args:
+            dset (h5py.Dataset): the dataset to read from.
+            index (int): the index of the event in the dataset.
+            dtype (type): optional type to read the data as.
+            selection (tuple): optional tuple of slices selecting part of the
+                data of the event.
+
+        Returns:
+            The data for the event.
+        """
+        if self.block_mode:
+            start, block = self.blocks.get(dset.name, (0, None))
+            if block is None or not (start <= index < start + len(block)):
+                # the pieces are aligned within the block of events containing the index
+                block_start = index - (index % self.block_size)
+                read_size = self._read_size(dset, dtype)
+                start = index - ((index - block_start) % read_size)
+                stop = min(start + read_size, block_start + self.block_size, len(dset))
+                if dtype is None:
+                    block = dset[start:stop]
+                else:
+                    with dset.astype(dtype):
+                        block = dset[start:stop]
+                self.blocks[dset.name] = (start, block)
+            return block[index - start][selection]
+        elif dtype is None:
+            return dset[(index,) + selection]
+        else:
+            with dset.astype(dtype):
+                return dset[(index,) + selection]
+
     def _timestamp(self, evt):
         if self.hdf5_ts is None:
             return None, None, None
         else:
             index, run = evt
-            return self.ts_converter(run[self.hdf5_ts][index])
+            dset = self.datasets.get(self.encode(self.hdf5_ts.strip(self.hdf5_delim)))
+            if dset is None:
+                dset = run[self.hdf5_ts]
+            return self.ts_converter(self._fetch(dset, index))
 
     def _runs(self):
-        for filename in self.files:
-            with h5py.File(filename, 'r') as hdf5_file:
+        if self.shard_mode == 'files':
+            yield from self._file_shards()
+        else:
+            for filename in self.files:
+                with h5py.File(filename, 'r') as hdf5_file:
+                    yield hdf5_file
+
+    def _file_shards(self):
+        # the files are dealt out to the workers in rounds, and a worker left
+        # without a file in the last round still opens one of the files of
+        # the round so that its transitions line up with the other workers
+        for start in range(0, len(self.files), self.num_workers):
+            files = self.files[start:start + self.num_workers]
+            owner = self.idnum < len(files)
+            with h5py.File(files[self.idnum if owner else 0], 'r') as hdf5_file:
+                self.shard = owner
                 yield hdf5_file
+        self.shard = None
+
+    def _shard_range(self):
+        num_events = self.hdf5_max_idx or 0
+        if self.shard_mode == 'files':
+            return 0, num_events if self.shard else 0
+        else:
+            return (self.idnum * num_events // self.num_workers,
+                    (self.idnum + 1) * num_events // self.num_workers)
+
+    def _shard_events(self, run):
+        # each worker reads its shard of the events sequentially
+        if self.block_mode:
+            self.block_size = self._block_size()
+        for index in range(*self._shard_range()):
+            yield (index, run)
+        self.hdf5_max_idx = None
+        self.blocks = {}
 
     def _events(self, run):
-        while True:
-            try:
-                yield (self.index, run)
-            except IndexError:
-                self.hdf5_idx = None
-                self.hdf5_max_idx = self.hdf5_idx
-                break
+        if self.shard_mode is not None:
+            yield from self._shard_events(run)
+        elif self.block_mode:
+            yield from self._block_events(run)
+        else:
+            while True:
+                try:
+                    yield (self.index, run)
+                except IndexError:
+                    self.hdf5_idx = None
+                    self.hdf5_max_idx = self.hdf5_idx
+                    break
+
+    def _block_events(self, run):
+        # each worker is assigned contiguous blocks of events in turn
+        self.block_size = self._block_size()
+        num_events = self.hdf5_max_idx or 0
+        stride = self.num_workers * self.block_size
+        for block_start in range(self.idnum * self.block_size, num_events, stride):
+            for index in range(block_start, min(block_start + self.block_size, num_events)):
+                yield (index, run)
+        self.hdf5_max_idx = None
+        self.blocks = {}
 
     def _update_data_names(self, name, obj):
         if isinstance(obj, h5py.Group):
@@ -1023,6 +1788,8 @@ class Hdf5Source(HierarchicalDataSource):
                 logger.debug("DataSrc: ignoring empty dataset %s", name)
             else:
                 self.check_max_index(obj.shape[0])
+                # cache the dataset handle to avoid looking up its path for every event
+                self.datasets[self.encode(name)] = obj
                 # pytables bool needs special handling when using h5py
                 h5_native_type = obj.id.get_type()
                 if isinstance(h5_native_type, h5py.h5t.TypeBitfieldID):
@@ -1043,6 +1810,8 @@ class Hdf5Source(HierarchicalDataSource):
                     self.data_types[self.encode(name)] = typing.Any
 
     def _update(self, run):
+        self.datasets = {}
+        self.blocks = {}
         groups = [run]
         while groups:
             grp = groups.pop()
@@ -1055,42 +1824,88 @@ class Hdf5Source(HierarchicalDataSource):
                 else:
                     logger.warn("DataSrc: hdf5 node %s has unsupported type: %s", obj.name, type(obj))
 
+    def _read(self, index, run, name, selection=()):
+        if name in self.special_types:
+            return self._fetch(self.datasets[name], index, self.special_types[name], selection)
+        elif name in self.grouped_types:
+            grouped = {}
+            groups = [(self.grouped_types[name], grouped)]
+            while groups:
+                grp, dset = groups.pop()
+                for oname, obj in grp.items():
+                    if isinstance(obj, h5py.Group):
+                        dset[oname] = {}
+                        groups.append((obj, dset[oname]))
+                    elif isinstance(obj, h5py.Dataset):
+                        dset[oname] = self._fetch(obj, index)
+            return at.Group(name, self.src_type, type(self.grouped_types[name]).__name__, grouped)
+        else:
+            return self._fetch(self.datasets[name], index, selection=selection)
+
     def _process(self, evt):
         index, run = evt
 
-        event = {}
-
+        loaders = {}
         for name in self.requested_data:
-            if name in self.special_types:
-                dset = run[self.decode(name)]
-                with dset.astype(self.special_types[name]):
-                    event[name] = dset[index]
-            elif name in self.grouped_types:
-                grouped = {}
-                groups = [(self.grouped_types[name], grouped)]
-                while groups:
-                    grp, dset = groups.pop()
-                    for oname, obj in grp.items():
-                        if isinstance(obj, h5py.Group):
-                            dset[oname] = {}
-                            groups.append((obj, dset[oname]))
-                        elif isinstance(obj, h5py.Dataset):
-                            dset[oname] = obj[index]
-                event[name] = at.Group(name, self.src_type, type(self.grouped_types[name]).__name__, grouped)
-            else:
-                event[name] = run[self.decode(name)][index]
+            # data only needed for selections of datasets is not read in full
+            if name in self.requested_names or name not in self.datasets:
+                loaders[name] = functools.partial(self._read, index, run, name)
+        for name, (base, selection) in self.requested_selections.items():
+            if base not in loaders:
+                loaders[name] = functools.partial(self._read, index, run, base, selection)
 
-        return event
+        return self._payload(loaders)
 
     def _cleanup(self):
-        pass
+        # clear the references to the datasets of the run
+        self.datasets = {}
+        self.blocks = {}
+
+
+class RateLimiter:
+    """
+    Token bucket for pacing a source at a target event rate. Tokens are
+    added at the target rate up to the size of the bucket, and each event
+    takes one token. This lets the source catch up after short stalls and
+    only sleep once it is ahead of the target rate, instead of sleeping a
+    fixed interval for every event.
+
+    Args:
+        rate (float): the target event rate in Hz.
+        burst (float): the size of the bucket. Defaults to 10 ms of events.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(1.0, rate / 100) if burst is None else burst
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def wait(self):
+        """
+        Takes a token from the bucket, sleeping until one is available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+        self.tokens -= 1
 
 
 class SimSource(Source):
+
+    DefaultLease = 1000
+
     def __init__(self, idnum, num_workers, heartbeat_period, src_cfg, flags=None):
         super().__init__(idnum, num_workers, heartbeat_period, src_cfg, flags)
         self.count = 0
         self.synced = False
+        self.limiter = None
+        self.leased = iter(())
         if 'sync' in self.config:
             self.ctx = zmq.Context()
             self.ts_src = self.ctx.socket(zmq.REQ)
@@ -1116,28 +1931,130 @@ class SimSource(Source):
     def _types(self):
         return {name: self._map_dtype(config) for name, config in self.simulated.items()}
 
+    @staticmethod
+    def _shape(config):
+        shape = config['shape']
+        return (shape,) if isinstance(shape, int) else tuple(shape)
+
     @property
     def simulated(self):
         return self.config.get('config', {})
 
+    @property
+    def rate(self):
+        """
+        Getter for the rate value set in the source configuration. If set the
+        source is paced at this event rate (in Hz) instead of waiting the
+        interval between events.
+
+        Returns:
+            The rate value set in the source configuration.
+        """
+        return self.config.get('rate', 0)
+
+    @property
+    def pool_size(self):
+        """
+        Getter for the pool value set in the source configuration. If set the
+        arrays of the source are taken from a pool of pre-generated read-only
+        arrays of this size instead of being generated for each event.
+
+        Returns:
+            The pool value set in the source configuration.
+        """
+        return self.config.get('pool', 0)
+
+    @property
+    def lease_size(self):
+        """
+        Getter for the lease value set in the source configuration. When the
+        source gets its timestamps from a timestamp syncer it leases blocks of
+        up to this many timestamps at once. The syncer limits the blocks to
+        the share of a heartbeat of each source, so that the heartbeats of
+        the sources stay aligned.
+
+        Returns:
+            The lease value set in the source configuration.
+        """
+        return self.config.get('lease', SimSource.DefaultLease)
+
     @property
     def timestamp(self):
         if self.synced:
-            self.ts_src.send_string("ts")
-            return self.ts_src.recv_pyobj()
+            timestamp = next(self.leased, None)
+            if timestamp is None:
+                self.ts_src.send_string("lease %d %d" % (self.lease_size, self.heartbeat_period))
+                start, count = self.ts_src.recv_pyobj()
+                self.leased = iter(range(start, start + count))
+                timestamp = next(self.leased)
+            return timestamp
         else:
             self.count += 1
             return self.num_workers * self.count + self.idnum
 
+    def start_pacing(self):
+        """
+        Resets the pacing of the source before it starts emitting events.
+        """
+        self.limiter = RateLimiter(self.rate) if self.rate > 0 else None
+
+    def pace(self):
+        """
+        Waits until the source should emit its next event.
+        """
+        if self.limiter is None:
+            time.sleep(self.interval)
+        else:
+            self.limiter.wait()
+
 
 class RandomSource(SimSource):
     def __init__(self, idnum, num_workers, heartbeat_period, src_cfg, flags=None):
         super().__init__(idnum, num_workers, heartbeat_period, src_cfg, flags)
-        np.random.seed([idnum])
+        self.rng = np.random.default_rng(idnum)
+        self.scalars = {}
+        self.pools = {}
+
+    @property
+    def block_size(self):
+        """
+        Getter for the block value set in the source configuration. This is
+        the number of events the scalar values of the source are generated
+        for at once.
+
+        Returns:
+            The block value set in the source configuration.
+        """
+        return self.config.get('block', 1024)
+
+    def _scalar(self, name, config):
+        values = self.scalars.get(name)
+        if not values:
+            low, high = config['range']
+            block = low + (high - low) * self.rng.random(self.block_size)
+            if config.get('integer', False):
+                block = block.astype(int)
+            # the values are popped off the end of the list
+            values = block.tolist()
+            values.reverse()
+            self.scalars[name] = values
+        return values.pop()
+
+    def _array(self, name, config):
+        if self.pool_size > 0:
+            if name not in self.pools:
+                pool = self.rng.normal(config['pedestal'], config['width'], (self.pool_size,) + self._shape(config))
+                # the arrays are reused so make sure nothing modifies them
+                pool.flags.writeable = False
+                self.pools[name] = itertools.cycle(pool)
+            return next(self.pools[name])
+        else:
+            return self.rng.normal(config['pedestal'], config['width'], self._shape(config))
 
     def events(self):
         time.sleep(self.init_time)
         yield self.configure()
+        self.start_pacing()
         while True:
             event = {}
             # get the timestamp and check heartbeat
@@ -1147,17 +2064,13 @@ class RandomSource(SimSource):
             for name, config in self.simulated.items():
                 if name in self.requested_data:
                     if config['dtype'] == 'Scalar':
-                        value = config['range'][0] + (config['range'][1] - config['range'][0]) * np.random.rand(1)[0]
-                        if config.get('integer', False):
-                            event[name] = int(value)
-                        else:
-                            event[name] = value
+                        event[name] = self._scalar(name, config)
                     elif config['dtype'] == 'Waveform' or config['dtype'] == 'Image':
-                        event[name] = np.random.normal(config['pedestal'], config['width'], config['shape'])
+                        event[name] = self._array(name, config)
                     else:
                         logger.warn("DataSrc: %s has unknown type %s", name, config['dtype'])
             yield from self.event(timestamp, event)
-            time.sleep(self.interval)
+            self.pace()
         # signal source has finished
         yield self.unconfigure()
 
@@ -1166,11 +2079,24 @@ class StaticSource(SimSource):
     def __init__(self, idnum, num_workers, heartbeat_period, src_cfg, flags=None):
         super().__init__(idnum, num_workers, heartbeat_period, src_cfg, flags)
         self.bound = self.config.get('bound', np.inf)
+        self.pools = {}
+
+    def _array(self, name, config):
+        if self.pool_size > 0:
+            if name not in self.pools:
+                # the array is reused so make sure nothing modifies it
+                array = np.ones(self._shape(config))
+                array.flags.writeable = False
+                self.pools[name] = array
+            return self.pools[name]
+        else:
+            return np.ones(self._shape(config))
 
     def events(self):
         count = 0
         time.sleep(self.init_time)
         yield self.configure()
+        self.start_pacing()
         while True:
             event = {}
             # get the timestamp and check heartbeat
@@ -1182,13 +2108,402 @@ class StaticSource(SimSource):
                     if config['dtype'] == 'Scalar':
                         event[name] = 1
                     elif config['dtype'] == 'Waveform' or config['dtype'] == 'Image':
-                        event[name] = np.ones(config['shape'])
+                        event[name] = self._array(name, config)
                     else:
                         logger.warn("DataSrc: %s has unknown type %s", name, config['dtype'])
             count += 1
             yield from self.event(timestamp, event)
             if count >= self.bound:
                 break
-            time.sleep(self.interval)
+            self.pace()
         # signal source has finished
         yield self.unconfigure()
+
+
+class Recorder:
+    """
+    Records the `Message` stream seen by a worker to a file, so that it can
+    be replayed later by a `ReplaySource`. Each message is written as a
+    record consisting of a small header, the pickled message and the raw
+    buffers of its arrays. The array buffers are written out-of-band and
+    aligned, which lets the replay map them straight from the file without
+    copying them.
+
+    Args:
+        path (str): the path of the file to write the recording to.
+    """
+
+    Magic = b'AMIREC01'
+    Header = struct.Struct('<dII')
+    Length = struct.Struct('<Q')
+    Alignment = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(Recorder.Magic)
+        self.dropped = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def padding(offset):
+        """
+        The number of bytes needed to align an offset in the file.
+
+        Args:
+            offset (int): the offset in the file.
+
+        Returns:
+            The number of padding bytes.
+        """
+        return -offset % Recorder.Alignment
+
+    def _dumps(self, record):
+        buffers = []
+        data = pickle.dumps(record, protocol=5, buffer_callback=buffers.append)
+        return data, [buf.raw() for buf in buffers]
+
+    def _picklable(self, payload):
+        data = {}
+        for name, value in payload.items():
+            try:
+                pickle.dumps(value, protocol=5, buffer_callback=lambda buf: None)
+                data[name] = value
+            except Exception:
+                if name not in self.dropped:
+                    logger.warning("Recorder: dropping data for %s which cannot be recorded", name)
+                    self.dropped.add(name)
+        return data
+
+    def write(self, msg, heartbeat=None):
+        """
+        Writes a message to the recording.
+
+        Args:
+            msg (Message): the message to record.
+            heartbeat (Heartbeat): the current heartbeat of the source when it
+                emitted the message.
+        """
+        if msg.mtype == MsgTypes.Datagram:
+            # the source object refers to the live run of the source and is
+            # replaced with the one of the replay source
+            payload = {k: v for k, v in msg.payload.items() if k != 'source'}
+            msg = Message(msg.mtype, msg.identity, payload, msg.timestamp)
+        try:
+            data, buffers = self._dumps((heartbeat, msg))
+        except Exception:
+            msg = Message(msg.mtype, msg.identity, self._picklable(msg.payload), msg.timestamp)
+            data, buffers = self._dumps((heartbeat, msg))
+
+        self.file.write(Recorder.Header.pack(time.time(), len(data), len(buffers)))
+        for buf in buffers:
+            self.file.write(Recorder.Length.pack(buf.nbytes))
+        self.file.write(data)
+        for buf in buffers:
+            self.file.write(b'\0' * Recorder.padding(self.file.tell()))
+            self.file.write(buf)
+
+    def close(self):
+        """
+        Closes the file of the recording.
+        """
+        self.file.close()
+
+
+class ReplaySource(Source):
+    """
+    Replays a recording of the messages of a worker made by a `Recorder`. The
+    recording is memory-mapped and the arrays of the replayed events are
+    read-only views of the file.
+
+    If a recording made by the worker with the same id exists (the file name
+    with the worker id appended as '.NNN') it is replayed as is. Otherwise
+    the datagrams of the recording are split between the workers, while each
+    of them replays all of the transitions and heartbeats.
+
+    The messages are replayed with their original timing, unless the 'rate'
+    or the 'timing' (set to 'fast' to replay as fast as possible) values are
+    set in the source configuration.
+    """
+
+    def __init__(self, idnum, num_workers, heartbeat_period, src_cfg, flags=None):
+        super().__init__(idnum, num_workers, heartbeat_period, src_cfg, flags)
+        self.records = []
+        self.recorded_types = {}
+        path = self.config['file']
+        worker_path = '%s.%03d' % (path, self.idnum)
+        if os.path.exists(worker_path):
+            self.path = worker_path
+            self.stride = 1
+        else:
+            self.path = path
+            self.stride = self.num_workers
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index()
+        # the types are known before replaying from the first configure
+        for _, heartbeat, msg in self.replay():
+            if msg.mtype == MsgTypes.Transition and msg.payload.ttype == Transitions.Configure:
+                self._update(msg.payload.payload)
+                break
+
+    def _index(self):
+        """
+        Scans the headers of the records of the recording and builds an index
+        of the offsets of their pickled messages and array buffers.
+        """
+        if self.mm[:len(Recorder.Magic)] != Recorder.Magic:
+            raise ValueError("%s is not a recording" % self.path)
+        offset = len(Recorder.Magic)
+        size = len(self.mm)
+        while offset + Recorder.Header.size <= size:
+            timestamp, length, nbufs = Recorder.Header.unpack_from(self.mm, offset)
+            offset += Recorder.Header.size
+            lengths = [Recorder.Length.unpack_from(self.mm, offset + i * Recorder.Length.size)[0]
+                       for i in range(nbufs)]
+            offset += nbufs * Recorder.Length.size
+            data = (offset, offset + length)
+            offset += length
+            buffers = []
+            for buflen in lengths:
+                offset += Recorder.padding(offset)
+                buffers.append((offset, offset + buflen))
+                offset += buflen
+            if offset > size:
+                logger.warning("DataSrc: dropping truncated record at the end of %s", self.path)
+                break
+            self.records.append((timestamp, data, buffers))
+
+    def replay(self):
+        """
+        Generator which reads the records of the recording.
+
+        Returns:
+            Tuples of the time the message was recorded, the heartbeat of the
+            source and the message.
+        """
+        view = memoryview(self.mm)
+        for timestamp, (start, stop), buffers in self.records:
+            heartbeat, msg = pickle.loads(view[start:stop], buffers=[view[a:b] for a, b in buffers])
+            yield timestamp, heartbeat, msg
+
+    def _update(self, types):
+        self.recorded_types = {name: at.loads(dtype) for name, dtype in types.items()
+                               if name not in self._base_names}
+        self.request(self.requested_names)
+
+    def _names(self):
+        return set(self.recorded_types)
+
+    def _types(self):
+        return dict(self.recorded_types)
+
+    @property
+    def timing(self):
+        """
+        Getter for the timing value set in the source configuration. The
+        recording is replayed with its original timing unless this is set to
+        'fast'.
+
+        Returns:
+            The timing value set in the source configuration.
+        """
+        return self.config.get('timing', 'original')
+
+    def events(self):
+        time.sleep(self.init_time)
+        limiter = None
+        if self.config.get('rate', 0) > 0:
+            limiter = RateLimiter(self.config['rate'])
+        count = 0
+        start = None
+        for timestamp, heartbeat, msg in self.replay():
+            if limiter is None and self.timing != 'fast':
+                now = time.time()
+                if start is None:
+                    start = now - timestamp
+                elif timestamp + start > now:
+                    time.sleep(timestamp + start - now)
+            self.heartbeat = heartbeat
+            if msg.mtype == MsgTypes.Datagram:
+                count += 1
+                if (count - 1) % self.stride != self.idnum % self.stride:
+                    continue
+                if limiter is not None:
+                    limiter.wait()
+                event = {name: value for name, value in msg.payload.items() if name in self.requested_data}
+                yield from self.event(msg.timestamp, event)
+            else:
+                if msg.mtype == MsgTypes.Transition and msg.payload.ttype == Transitions.Configure:
+                    self._update(msg.payload.payload)
+                elif msg.mtype == MsgTypes.Heartbeat:
+                    self.old_heartbeat = msg.payload
+                yield Message(msg.mtype, self.idnum, msg.payload, msg.timestamp)
+
+    def close(self):
+        """
+        Closes the memory-map of the recording.
+        """
+        try:
+            self.mm.close()
+        except BufferError:
+            # arrays of replayed events still refer to the recording
+            pass
+
+
+class Prefetcher:
+    """
+    Runs the events generator of a `Source` in a background thread which
+    fills a bounded queue with ready `Message` objects. This lets the I/O and
+    processing done by the source overlap with the graph execution of the
+    consumer.
+
+    While the background thread is running the data requested from the source
+    has to be changed with `request`, so that the source is never changed
+    while it is producing a message.
+
+    Args:
+        src (Source): the source to prefetch messages from.
+        depth (int): the maximum number of messages held in the queue.
+    """
+
+    def __init__(self, src, depth):
+        self.src = src
+        self.depth = depth
+        self.heartbeat = None
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.cancelled = threading.Event()
+        self.thread = None
+        # guards the counters and the pending request shared with the background thread
+        self.lock = threading.Lock()
+        self.pending = None
+        self.num_empty = 0
+        self.num_full = 0
+
+    @property
+    def qsize(self):
+        """
+        The current number of messages waiting in the queue.
+
+        Returns:
+            The approximate number of messages in the queue.
+        """
+        return self.queue.qsize()
+
+    def stats(self):
+        """
+        Returns the number of times the consumer found the queue empty and the
+        number of times the producer found it full since the last call and
+        then resets both counts.
+
+        Returns:
+            A tuple of the empty and full counts
+        """
+        with self.lock:
+            empty, full = self.num_empty, self.num_full
+            self.num_empty = 0
+            self.num_full = 0
+        return empty, full
+
+    def request(self, names):
+        """
+        Requests the data to include in the messages of the source. If the
+        background thread is running the request is applied by it before it
+        reads the next event, and the messages already in the queue keep the
+        data of the previous request.
+
+        Args:
+            names (list): names of the data being requested
+        """
+        with self.lock:
+            if self.thread is not None:
+                self.pending = set(names)
+                return
+        self.src.request(names)
+
+    def _update_request(self):
+        with self.lock:
+            names, self.pending = self.pending, None
+        if names is not None:
+            self.src.request(names)
+
+    def _put(self, item):
+        if self.queue.full():
+            with self.lock:
+                self.num_full += 1
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fill(self):
+        events = self.src.events()
+        try:
+            for msg in events:
+                # lazy payloads have to be read before the source moves on to
+                # the next event, so the prefetcher reads all of their data
+                if isinstance(msg.payload, LazyPayload):
+                    msg.payload = msg.payload.load()
+                # the heartbeat of the source is recorded with each message
+                # since the source may be several messages ahead of the consumer
+                if not self._put((msg, self.src.heartbeat)):
+                    break
+                self._update_request()
+        except Exception as e:
+            logger.exception("DataSrc: Failure encountered while prefetching events:")
+            self._put((e, None))
+        finally:
+            events.close()
+            self._put((None, None))
+
+    def start(self):
+        """
+        Starts the background thread which prefetches messages from the
+        source, if it is not already running.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.cancelled.clear()
+            self.queue = queue.Queue(maxsize=self.depth)
+            self._update_request()
+            with self.lock:
+                self.thread = threading.Thread(target=self._fill, name='prefetch', daemon=True)
+            self.thread.start()
+
+    def cancel(self):
+        """
+        Stops the background thread and discards any messages which have
+        already been prefetched.
+        """
+        self.cancelled.set()
+        if self.thread is not None:
+            self.thread.join()
+            with self.lock:
+                self.thread = None
+            self._update_request()
+        self.queue = queue.Queue(maxsize=self.depth)
+
+    def events(self):
+        """
+        Generator which yields the `Message` objects prefetched from the
+        source in the order they were produced.
+        """
+        self.start()
+        while True:
+            if self.queue.empty():
+                with self.lock:
+                    self.num_empty += 1
+            msg, heartbeat = self.queue.get()
+            if msg is None:
+                break
+            elif isinstance(msg, Exception):
+                raise msg
+            self.heartbeat = heartbeat
+            yield msg
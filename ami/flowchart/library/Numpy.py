@@ -77,14 +77,18 @@ class Binning(CtrlNode):
 
         def reduction(res, *rest):
             res[0] = rest[0]
-            res[1] = res[1] + rest[1]
+            if res[1] is None:
+                res[1] = np.array(rest[1])
+            else:
+                np.add(res[1], rest[1], out=res[1])
             return res
 
         node = [gn.Map(name=self.name()+"_map",
                        condition_needs=conditions, inputs=inputs,
                        outputs=map_outputs, func=bin, parent=self.name()),
                 gn.Accumulator(name=self.name()+"_accumulated", inputs=map_outputs, outputs=outputs,
-                               res_factory=lambda: [None, 0], reduction=reduction, parent=self.name())]
+                               res_factory=lambda: [None, None], reduction=reduction, inplace=True,
+                               parent=self.name())]
         return node
 
 
@@ -146,14 +150,18 @@ class Binning2D(CtrlNode):
         def reduction(res, *rest):
             res[0] = rest[0]
             res[1] = rest[1]
-            res[2] = res[2] + rest[2]
+            if res[2] is None:
+                res[2] = np.array(rest[2])
+            else:
+                np.add(res[2], rest[2], out=res[2])
             return res
 
         node = [gn.Map(name=self.name()+"_map",
                        condition_needs=conditions, inputs=inputs,
                        outputs=map_outputs, func=bin, parent=self.name()),
                 gn.Accumulator(name=self.name()+"_accumulated", inputs=map_outputs, outputs=outputs,
-                               res_factory=lambda: [None, None, 0], reduction=reduction, parent=self.name())]
+                               res_factory=lambda: [None, None, None], reduction=reduction, inplace=True,
+                               parent=self.name())]
         return node
 
 
@@ -471,11 +479,15 @@ class Average1D(CtrlNode):
         if self.values['infinite']:
             def reduction(res, *rest):
                 if type(rest[0]) is list:
-                    res[0] = np.sum([res[0], rest[0][0]], axis=axis)
-                    res[1] += rest[0][1]
+                    total, count = rest[0]
                 else:
-                    res[0] = np.sum([res[0], rest[0]], axis=axis)
-                    res[1] = res[1] + 1
+                    total, count = rest[0], 1
+                if res[0] is None:
+                    # integer data is summed exactly and anything else in double precision
+                    res[0] = np.array(total, dtype=np.result_type(total, np.int64))
+                else:
+                    np.add(res[0], total, out=res[0])
+                res[1] += count
                 return res
 
             def avg(*args, **kwargs):
@@ -483,7 +495,8 @@ class Average1D(CtrlNode):
 
             nodes = [gn.Accumulator(name=self.name()+"_accumulated",
                                     inputs=inputs, outputs=accumulated_outputs, condition_needs=conditions,
-                                    res_factory=lambda: [0, 0], reduction=reduction, parent=self.name()),
+                                    res_factory=lambda: [None, 0], reduction=reduction, inplace=True,
+                                    parent=self.name()),
                      gn.Map(name=self.name()+"_map",
                             inputs=accumulated_outputs, outputs=outputs,
                             func=avg, parent=self.name())]
@@ -526,11 +539,15 @@ class Average2D(CtrlNode):
         if self.values['infinite']:
             def reduction(res, *rest):
                 if type(rest[0]) is list:
-                    res[0] = np.sum([res[0], rest[0][0]], axis=axis)
-                    res[1] += rest[0][1]
+                    total, count = rest[0]
                 else:
-                    res[0] = np.sum([res[0], rest[0]], axis=axis)
-                    res[1] = res[1] + 1
+                    total, count = rest[0], 1
+                if res[0] is None:
+                    # integer data is summed exactly and anything else in double precision
+                    res[0] = np.array(total, dtype=np.result_type(total, np.int64))
+                else:
+                    np.add(res[0], total, out=res[0])
+                res[1] += count
                 return res
 
             def avg(*args, **kwargs):
@@ -538,7 +555,8 @@ class Average2D(CtrlNode):
 
             nodes = [gn.Accumulator(name=self.name()+"_accumulated",
                                     inputs=inputs, outputs=accumulated_outputs, condition_needs=conditions,
-                                    res_factory=lambda: [0, 0], reduction=reduction, parent=self.name()),
+                                    res_factory=lambda: [None, 0], reduction=reduction, inplace=True,
+                                    parent=self.name()),
                      gn.Map(name=self.name()+"_map",
                             inputs=accumulated_outputs, outputs=outputs,
                             func=avg, parent=self.name())]
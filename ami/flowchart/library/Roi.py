@@ -77,7 +77,7 @@ class Roi2D(CtrlNode):
 
         node = gn.Map(name=self.name()+"_operation",
                       condition_needs=conditions, inputs=inputs, outputs=outputs,
-                      func=func,
+                      func=func, selection=(slice(ox, ox+ex), slice(oy, oy+ey)),
                       parent=self.name())
         return node
 
@@ -143,7 +143,7 @@ class Roi1D(CtrlNode):
 
         node = gn.Map(name=self.name()+"_operation",
                       condition_needs=conditions, inputs=inputs, outputs=outputs,
-                      func=func,
+                      func=func, selection=(slice(*size),),
                       parent=self.name())
         return node
 
@@ -1,4 +1,5 @@
 import abc
+import copy
 import operator
 import numpy as np
 from networkfox import operation, If
@@ -65,6 +66,18 @@ class Transformation(abc.ABC):
         return operation(name=self.name, needs=self.inputs, provides=self.outputs, color=self.color,
                          metadata={'parent': self.parent})(self.func)
 
+    def batch(self, *args):
+        """
+        Executes the node over a batch of events by looping over them.
+
+        Args:
+            args (list): One list of per-event values for each input
+
+        Returns:
+            A list of the per-event results of the node
+        """
+        return [self.func(*event) for event in zip(*args)]
+
 
 class Map(Transformation):
 
@@ -76,8 +89,54 @@ class Map(Transformation):
             outputs (list): List of outputs
             func (function): Function node will call
             condition_needs (list): List of condition needs
+            is_batch_aware (bool): Indicates func can be called once with
+                the inputs of a batch of events stacked along a new first axis
+            selection (tuple): Indicates func only returns this tuple of
+                slices of its single input, so that the selection can be
+                read directly from the source instead
         """
+        is_batch_aware = kwargs.pop('is_batch_aware', False)
+        selection = kwargs.pop('selection', None)
         super().__init__(**kwargs)
+        self.is_batch_aware = is_batch_aware
+        self.selection = selection
+
+    @staticmethod
+    def _selected(arr):
+        return arr
+
+    def select(self, name):
+        """
+        Switches the node to take the selection of its input from the source
+        instead of slicing it itself.
+
+        Args:
+            name (str): the name of the selection of the input.
+        """
+        self.inputs = [name]
+        self.func = Map._selected
+        self.is_batch_aware = False
+
+    def batch(self, *args):
+        """
+        Executes the node over a batch of events. If the node is batch-aware
+        its function is called once with the stacked inputs, otherwise it is
+        called once per event.
+
+        Args:
+            args (list): One list of per-event values for each input
+
+        Returns:
+            A list of the per-event results of the node
+        """
+        if not self.is_batch_aware:
+            return super().batch(*args)
+
+        results = self.func(*[np.stack(arg) for arg in args])
+        if len(self.outputs) == 1:
+            return list(results)
+        else:
+            return list(zip(*results))
 
 
 class Filter(abc.ABC):
@@ -114,6 +173,19 @@ class Filter(abc.ABC):
     def to_operation(self):
         return
 
+    def batch(self, *args):
+        """
+        Evaluates the condition of the filter over a batch of events.
+
+        Args:
+            args (list): One list of per-event values for each condition need
+
+        Returns:
+            A list with True for each event passing the filter and None
+            for each event that does not
+        """
+        return [True if self.condition(*event) else None for event in zip(*args)]
+
     def __hash__(self):
         return hash(self.name)
 
@@ -208,6 +280,40 @@ class StatefulTransformation(Transformation):
         """
         return
 
+    def heartbeat_scoped(self):
+        """
+        Returns True if the state of the node only holds the current heartbeat,
+        since it is reset when the heartbeat is finished.
+        """
+        return False
+
+    def swap_state(self, state=None):
+        """
+        Replaces the state of a node whose state is heartbeat scoped, so that
+        several heartbeats can be reduced at once each with its own state.
+
+        Args:
+            state: a state returned by an earlier call, or None for a new state.
+
+        Returns:
+            The replaced state of the node.
+        """
+        raise NotImplementedError("%s does not support swapping its state" % type(self).__name__)
+
+    def batch(self, *args):
+        """
+        Executes the node over a batch of events. Stateful nodes are always
+        called once per event in order so their state evolves exactly as it
+        would when executing the events one at a time.
+
+        Args:
+            args (list): One list of per-event values for each input
+
+        Returns:
+            A list of the per-event results of the node
+        """
+        return [self(*event) for event in zip(*args)]
+
     def to_operation(self):
         return operation(name=self.name, needs=self.inputs, provides=self.outputs,
                          color=self.color, metadata={'parent': self.parent})(self)
@@ -281,13 +387,32 @@ class ReduceByKey(GlobalTransformation):
         if self.color != 'globalCollector':
             self.reset()
 
+    def heartbeat_scoped(self):
+        return self.color != 'globalCollector'
+
+    def swap_state(self, state=None):
+        res = self.res
+        if state is None:
+            self.reset()
+        else:
+            self.res = state
+        return res
+
 
 class Accumulator(GlobalTransformation):
 
     def __init__(self, **kwargs):
+        """
+        Keyword Arguments:
+            res_factory (function): Returns the initial result of the reduction
+            inplace (bool): Indicates the reduction updates the result from
+                res_factory in place, e.g. with np.add(res, arg, out=res),
+                instead of returning a new one (default False)
+        """
         super().__init__(**kwargs)
         self.res_factory = kwargs.pop('res_factory', lambda: 0)
         assert hasattr(self.res_factory, '__call__'), 'res_factory is not callable'
+        self.inplace = kwargs.pop('inplace', False)
         self.res = self.res_factory()
 
     def __call__(self, *args, **kwargs):
@@ -300,9 +425,24 @@ class Accumulator(GlobalTransformation):
     def heartbeat_finished(self):
         if self.color != 'globalCollector':
             self.reset()
+        elif self.inplace:
+            # the result of the heartbeat has been sent without a copy, so keep
+            # accumulating into a new one instead of updating it under the receiver
+            self.res = copy.deepcopy(self.res)
+
+    def heartbeat_scoped(self):
+        return self.color != 'globalCollector'
+
+    def swap_state(self, state=None):
+        res = self.res
+        if state is None:
+            self.reset()
+        else:
+            self.res = state
+        return res
 
     def on_expand(self):
-        return {'parent': self.parent, 'res_factory': self.res_factory}
+        return {'parent': self.parent, 'res_factory': self.res_factory, 'inplace': self.inplace}
 
 
 class PickN(GlobalTransformation):
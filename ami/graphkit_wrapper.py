@@ -1,10 +1,42 @@
+import re
+import time
 import networkx as nx
 import itertools as it
 import collections
+import concurrent.futures
 import ami.graph_nodes as gn
+from ami.data import LazyPayload, selection_name, parse_selection
 from networkfox import compose
 
 
+INTERMEDIATE_NAME = re.compile(r"_intermediateCollector\d+$")
+
+
+def collector_tree(num_workers=1, num_local_collectors=1, fan_in=None):
+    """
+    Returns the levels of the tree of processes which reduce the results of the
+    graph, from the workers to the global collector. Each level of intermediate
+    collectors reduces the results of the previous level in groups of its
+    fan-in, so the last collector of a level may have fewer contributors.
+
+    Args:
+        num_workers (int): Total number of workers.
+        num_local_collectors (int): Total number of local collectors.
+        fan_in (list): Number of contributors of the collectors of each level
+            of intermediate collectors, or None if there are none.
+
+    Returns:
+        A list of tuples of the color and the number of processes of each level.
+    """
+    levels = [('worker', num_workers), ('localCollector', num_local_collectors)]
+    for level, contribs in enumerate(fan_in or [], start=1):
+        if contribs < 1:
+            raise ValueError("The fan-in of intermediate collector level %d must be positive: %s" % (level, contribs))
+        levels.append(('intermediateCollector%d' % level, -(-levels[-1][1] // contribs)))
+    levels.append(('globalCollector', 1))
+    return levels
+
+
 class Graph():
 
     def __init__(self, name):
@@ -21,6 +53,18 @@ class Graph():
         self.children_of_global_operations = {}
         self.inputs = collections.defaultdict(set)
         self.outputs = collections.defaultdict(set)
+        self.execution_order = {}
+        self.dependencies = {}
+        self.lazy_inputs = {}
+        self.exec_times = None
+        self.num_threads = 0
+        self.executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # thread pools cannot be pickled, so a new one is created when needed
+        state['executor'] = None
+        return state
 
     def __bool__(self):
         return self.graph.size() != 0
@@ -40,7 +84,8 @@ class Graph():
             True if the name is valid, False otherwise.
         """
         if isinstance(name, str):
-            return not name.endswith(('_worker', '_localCollector', '_globalCollector'))
+            return not name.endswith(('_worker', '_localCollector', '_globalCollector')) and \
+                INTERMEDIATE_NAME.search(name) is None
         else:
             return False
 
@@ -216,6 +261,36 @@ class Graph():
                             self.graph.nodes))
         list(map(lambda node: node.heartbeat_finished(), nodes))
 
+    def heartbeat_scoped(self, color):
+        """
+        Returns True if the state of all the stateful nodes of the given color
+        only holds the current heartbeat, so that several heartbeats can be
+        reduced at once by swapping their states with `swap_state`.
+
+        Args:
+            color (str): the color of the nodes.
+        """
+        return all(node.heartbeat_scoped() for node in self._execution_order(color)
+                   if isinstance(node, gn.StatefulTransformation))
+
+    def swap_state(self, color, state=None):
+        """
+        Replaces the state of the stateful nodes of the given color, which
+        must be heartbeat scoped.
+
+        Args:
+            color (str): the color of the nodes.
+            state (list): a state returned by an earlier call, or None for a
+                new state.
+
+        Returns:
+            The replaced state of the nodes.
+        """
+        nodes = [node for node in self._execution_order(color) if isinstance(node, gn.StatefulTransformation)]
+        if state is None:
+            state = [None]*len(nodes)
+        return [node.swap_state(node_state) for node, node_state in zip(nodes, state)]
+
     def _color_nodes(self):
         """
         Generate all paths from inputs to outputs, for each path look for nodes which have the ``is_global_operation``
@@ -255,20 +330,24 @@ class Graph():
             if node.color == '':
                 node.color = 'worker'
 
-    def _expand_global_operations(self, num_workers, num_local_collectors):
+    def _expand_global_operations(self, num_workers, num_local_collectors, fan_in=None):
         """
-        Expand the nodes found in color_nodes into three nodes which execute on the worker, local collector, and
-        global collector respectively. The number of workers and number of local collectors must be known in order to
-        properly expand PickN operations.
+        Expand the nodes found in color_nodes into one node for each level of the tree of processes reducing the
+        results, which execute on the worker, local collector, any intermediate collectors, and global collector
+        respectively. The number of processes at each level must be known in order to properly expand PickN
+        operations.
 
         Args:
             num_workers (int): Total number of workers.
             num_local_collectors (int): Total number of local collectors.
+            fan_in (list): Number of contributors of the collectors of each level of intermediate collectors.
         """
 
         inputs = [n for n, d in self.graph.in_degree() if d == 0]
         self.inputs['worker'].update(inputs)
 
+        levels = collector_tree(num_workers, num_local_collectors, fan_in)
+
         for node in self.global_operations:
             inputs = node.inputs
             outputs = node.outputs
@@ -278,12 +357,9 @@ class Graph():
             self.graph.remove_node(node)
             NewNode = getattr(gn, node.__class__.__name__)
 
-            color_order = ['worker', 'localCollector', 'globalCollector']
-            worker_outputs = None
-            local_collector_outputs = None
             extras = node.on_expand()
 
-            for color in color_order:
+            for idx, (color, count) in enumerate(levels):
 
                 if color == 'worker':
                     worker_outputs = list(map(lambda o: o+'_worker', node.outputs))
@@ -305,45 +381,48 @@ class Graph():
                         self.graph.add_edge(worker_node, o)
                     for n in condition_needs:
                         self.graph.add_edge(n, worker_node)
+                    contrib_outputs = worker_outputs
 
-                elif color == 'localCollector':
-                    self.inputs[color].update(worker_outputs)
-                    local_collector_outputs = list(map(lambda o: o+'_localCollector', node.outputs))
+                elif color != 'globalCollector':
+                    # the local collectors and any levels of intermediate collectors
+                    self.inputs[color].update(contrib_outputs)
+                    collector_outputs = list(map(lambda o: o+'_'+color, node.outputs))
 
-                    local_collector_N = 1
-                    workers_per_local_collector = None
+                    collector_N = 1
+                    contribs_per_collector = None
                     if hasattr(node, 'N'):
-                        local_collector_N = max(node.N // num_local_collectors, 1)
-                        workers_per_local_collector = max(num_workers // num_local_collectors, 1)
-
-                    local_collector_node = NewNode(name=node.name+'_localCollector', inputs=worker_outputs,
-                                                   outputs=local_collector_outputs, reduction=node.reduction,
-                                                   N=local_collector_N, is_expanded=True,
-                                                   num_contributors=workers_per_local_collector, **extras)
-                    local_collector_node.color = color
-                    local_collector_node.is_global_operation = False
-                    self.children_of_global_operations[node.parent].add(local_collector_node)
-                    self.outputs[color].update(local_collector_outputs)
-                    for i in worker_outputs:
-                        self.graph.add_edge(i, local_collector_node)
-                    for o in local_collector_outputs:
-                        self.graph.add_edge(local_collector_node, o)
-
-                elif color == 'globalCollector':
-                    self.inputs[color].update(local_collector_outputs)
+                        collector_N = max(node.N // count, 1)
+                        contribs_per_collector = max(levels[idx-1][1] // count, 1)
+
+                    collector_node = NewNode(name=node.name+'_'+color, inputs=contrib_outputs,
+                                             outputs=collector_outputs, reduction=node.reduction,
+                                             N=collector_N, is_expanded=True,
+                                             num_contributors=contribs_per_collector, **extras)
+                    collector_node.color = color
+                    collector_node.is_global_operation = False
+                    self.children_of_global_operations[node.parent].add(collector_node)
+                    self.outputs[color].update(collector_outputs)
+                    for i in contrib_outputs:
+                        self.graph.add_edge(i, collector_node)
+                    for o in collector_outputs:
+                        self.graph.add_edge(collector_node, o)
+                    contrib_outputs = collector_outputs
+
+                else:
+                    self.inputs[color].update(contrib_outputs)
 
                     N = getattr(node, 'N', 1)
                     N = max((N // num_workers)*num_workers, 1)
 
                     global_collector_node = NewNode(name=node.name+'_globalCollector',
-                                                    inputs=local_collector_outputs,
+                                                    inputs=contrib_outputs,
                                                     outputs=outputs, reduction=node.reduction, N=N,
                                                     is_expanded=True,
-                                                    num_contributors=num_local_collectors, **extras)
+                                                    num_contributors=levels[idx-1][1], **extras)
                     global_collector_node.color = color
                     self.children_of_global_operations[node.parent].add(global_collector_node)
                     self.expanded_global_operations.add(global_collector_node)
-                    for i in local_collector_outputs:
+                    for i in contrib_outputs:
                         self.graph.add_edge(i, global_collector_node)
                     for o in outputs:
                         self.graph.add_edge(global_collector_node, o)
@@ -409,6 +488,32 @@ class Graph():
                 node.inputs = new_inputs
             self.add(node)
 
+    def _push_down_selections(self):
+        """
+        Switches Map nodes on the worker which only take a selection of an input of the graph to inputs for just that
+        selection, so that the source can read the selection directly instead of the full data. If other nodes need
+        the full data the source still reads it and slices the selection from it.
+        """
+        # drop selections which are no longer used since nodes were replaced
+        for name in list(self.graph.nodes):
+            if type(name) is str and self.graph.degree(name) == 0 and parse_selection(name)[1] is not None:
+                self.graph.remove_node(name)
+
+        inputs = {n for n, d in self.graph.in_degree() if d == 0 and type(n) is str}
+
+        selected = list(filter(lambda node: isinstance(node, gn.Map) and node.selection is not None and
+                               node.color == 'worker' and len(node.inputs) == 1 and node.inputs[0] in inputs and
+                               parse_selection(node.inputs[0])[1] is None,
+                               self.graph.nodes))
+
+        for node in selected:
+            name = node.inputs[0]
+            self.graph.remove_node(node)
+            node.select(selection_name(name, node.selection))
+            self.add(node)
+            if self.graph.degree(name) == 0:
+                self.graph.remove_node(name)
+
     def _find_intersecting_path(self, filters_targets, path):
         diffs = set()
 
@@ -421,7 +526,7 @@ class Graph():
 
         return diffs
 
-    def compile(self, num_workers=1, num_local_collectors=1):
+    def compile(self, num_workers=1, num_local_collectors=1, num_threads=0, fan_in=None):
         """
         Convert an AMI graph to a networkfox graph. This function must be called after any function which modifies the
         graph, ie add, insert, remove, or replace.
@@ -432,11 +537,24 @@ class Graph():
         Args:
             num_workers (int): Total number of workers.
             num_local_collectors (int): Total number of local collectors.
+            num_threads (int): Number of threads used to execute independent nodes of the graph concurrently. If zero
+                the graph is executed sequentially by networkfox.
+            fan_in (list): Number of contributors of the collectors of each level of intermediate collectors between
+                the local collectors and the global collector. If None the local collectors contribute directly to
+                the global collector.
         """
         self.inputs = collections.defaultdict(set)
+        self.execution_order = {}
+        self.dependencies = {}
+        self.lazy_inputs = {}
+        if num_threads != self.num_threads and self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.num_threads = num_threads
         self._color_nodes()
+        self._push_down_selections()
         self._collect_global_inputs()
-        self._expand_global_operations(num_workers, num_local_collectors)
+        self._expand_global_operations(num_workers, num_local_collectors, fan_in)
 
         seen = set()
         branch_merge_candidates = [n for n, d in self.graph.in_degree() if d >= 2 and type(n) is str]
@@ -509,26 +627,305 @@ class Graph():
 
         :param args: args[0] should be dictionary of arguments required to execute graph nodes.
         :param kwargs: Should contain a key called color with a valid color, either worker, localCollector,
-                       or globalCollector.
+                       intermediateCollector followed by its level, or globalCollector.
         :raises AssertionError: if compile() has not been falled first or if color is None.
         """
+        assert self.graphkit is not None, "call compile first"
+        color = kwargs.get('color', None)
+        assert color is not None
+
+        args = (self.load(args[0], color),) + args[1:]
         missing_inputs = [k for k, v in args[0].items() if v is None]
 
         for missed_inputs in missing_inputs:
             args[0].pop(missed_inputs)
 
-        assert self.graphkit is not None, "call compile first"
-        color = kwargs.get('color', None)
-        assert color is not None
-        result = self.graphkit(*args, **kwargs)
+        if self.num_threads > 0:
+            result = self._execute_parallel(args[0], color)
+        else:
+            self.exec_times = None
+            result = self.graphkit(*args, **kwargs)
         outputs = self.outputs[color]
         return {k: result[k] for k in outputs if k in result}
 
+    def _execution_order(self, color):
+        """
+        Returns the operation nodes of the given color in topological order.
+        The order is cached until the graph is next compiled.
+
+        Args:
+            color (str): the color of the nodes to return.
+
+        Returns:
+            A list of the operation nodes of the given color.
+        """
+        if color not in self.execution_order:
+            self.execution_order[color] = [node for node in nx.algorithms.topological_sort(self.graph)
+                                           if type(node) is not str and node.color == color]
+        return self.execution_order[color]
+
+    def _lazy_inputs(self, color):
+        """
+        Finds the filters whose conditions only depend on inputs of the graph,
+        so they can be evaluated before reading the rest of the event. The
+        result is cached until the graph is next compiled.
+
+        Args:
+            color (str): the color of the nodes to check.
+
+        Returns:
+            A tuple of the filters which can be evaluated directly from the
+            inputs of the graph and a dictionary, filled in as events are
+            loaded, of the sets of rejecting filters to the inputs of the graph
+            which do not need to be read.
+        """
+        if color not in self.lazy_inputs:
+            inputs = {n for n, d in self.graph.in_degree() if d == 0 and type(n) is str}
+            filters = [node for node in self._execution_order(color)
+                       if isinstance(node, gn.Filter) and inputs.issuperset(node.condition_needs)]
+            self.lazy_inputs[color] = (filters, {})
+        return self.lazy_inputs[color]
+
+    def _skipped_inputs(self, color, rejected):
+        """
+        Finds the inputs of the graph which are not needed when the given
+        filters reject an event. A node can only run if all of its inputs and
+        condition needs are produced, and an output produced by several nodes,
+        like one merging the branches of a filter, is produced if any of them
+        runs, while a rejected filter produces nothing. An input is not needed
+        if none of the nodes of the given color consuming it can run.
+
+        Args:
+            color (str): the color of the nodes being executed.
+            rejected (frozenset): the filters rejecting the event.
+
+        Returns:
+            The set of inputs of the graph which do not need to be read.
+        """
+        inputs = {n for n, d in self.graph.in_degree() if d == 0 and type(n) is str}
+        available = set(inputs)
+        runs = set()
+        for node in nx.algorithms.topological_sort(self.graph):
+            if type(node) is str:
+                continue
+            if node in rejected:
+                # the condition of a rejected filter has already been read
+                runs.add(node)
+            elif available.issuperset(node.inputs) and available.issuperset(node.condition_needs):
+                runs.add(node)
+                available.update(node.outputs)
+
+        skip = set()
+        for name in inputs:
+            consumers = [node for node in self.graph.successors(name) if node.color == color]
+            if consumers and not runs.intersection(consumers):
+                skip.add(name)
+        return skip
+
+    def load(self, event, color):
+        """
+        Reads the data from a lazy event payload that is needed to execute the
+        graph. The filters which only depend on inputs of the graph are
+        evaluated first, and inputs only needed by nodes which cannot run when
+        those filters reject the event are not read. Data requested by other
+        graphs is not read either.
+
+        Args:
+            event (dict): the event to execute the graph on.
+            color (str): the color of the nodes being executed.
+
+        Returns:
+            A dictionary of the event data to pass to the graph.
+        """
+        if not isinstance(event, LazyPayload):
+            return event
+
+        filters, skipped = self._lazy_inputs(color)
+
+        rejected = set()
+        for f in filters:
+            needs = [event.get(name) for name in f.condition_needs]
+            if any(need is None for need in needs) or not f.condition(*needs):
+                rejected.add(f)
+
+        rejected = frozenset(rejected)
+        if rejected not in skipped:
+            skipped[rejected] = self._skipped_inputs(color, rejected) if rejected else set()
+        skip = skipped[rejected]
+        return {name: event[name] for name in list(event) if name in self.graph and name not in skip}
+
+    def _dependencies(self, color):
+        """
+        Returns the dependency structure between the operation nodes of the
+        given color. The structure is cached until the graph is next compiled.
+
+        Args:
+            color (str): the color of the nodes.
+
+        Returns:
+            A tuple of two dictionaries. The first gives the number of nodes
+            each node depends on and the second the nodes that depend on each
+            node.
+        """
+        if color not in self.dependencies:
+            nodes = self._execution_order(color)
+            # an output can be written by several nodes, e.g. in the branches of a filter
+            producers = {}
+            for node in nodes:
+                for output in node.outputs:
+                    producers.setdefault(output, set()).add(node)
+            num_deps = {}
+            dependents = {node: [] for node in nodes}
+            for node in nodes:
+                deps = set()
+                for name in it.chain(node.inputs, node.condition_needs):
+                    deps.update(producers.get(name, ()))
+                num_deps[node] = len(deps)
+                for dep in deps:
+                    dependents[dep].append(node)
+            self.dependencies[color] = (num_deps, dependents)
+        return self.dependencies[color]
+
+    @staticmethod
+    def _run_node(node, values):
+        """
+        Executes a single operation node if all of its inputs are available.
+
+        Args:
+            node (Transformation or Filter): the node to execute.
+            values (dict): the values available in the graph so far.
+
+        Returns:
+            A tuple of the result of the node (None if it was not executed) and
+            the time it took.
+        """
+        start = time.time()
+        result = None
+        if all(name in values for name in it.chain(node.inputs, node.condition_needs)):
+            if isinstance(node, gn.Filter):
+                result = True if node.condition(*[values[name] for name in node.condition_needs]) else None
+            elif isinstance(node, gn.StatefulTransformation):
+                result = node(*[values[name] for name in node.inputs])
+            else:
+                result = node.func(*[values[name] for name in node.inputs])
+        return result, time.time() - start
+
+    def _execute_parallel(self, inputs, color):
+        """
+        Executes the operation nodes of the given color on a thread pool. Each
+        node is submitted to the pool as soon as all of the nodes it depends
+        on have finished, so independent nodes run concurrently.
+
+        Args:
+            inputs (dict): dictionary of arguments required to execute the
+                graph nodes.
+            color (str): the color of the nodes to execute.
+
+        Returns:
+            A dictionary of all the values in the graph after execution.
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads,
+                                                                  thread_name_prefix=self.name)
+
+        num_deps, dependents = self._dependencies(color)
+        waiting = dict(num_deps)
+        values = dict(inputs)
+        self.exec_times = {}
+
+        futures = {self.executor.submit(self._run_node, node, values): node
+                   for node, count in waiting.items() if count == 0}
+        try:
+            while futures:
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node = futures.pop(future)
+                    result, exec_time = future.result()
+                    self.exec_times[node.name] = exec_time
+                    if result is not None:
+                        if len(node.outputs) == 1:
+                            result = (result,)
+                        for name, value in zip(node.outputs, result):
+                            if value is not None:
+                                values[name] = value
+                    for dependent in dependents[node]:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            futures[self.executor.submit(self._run_node, dependent, values)] = dependent
+        except Exception:
+            # let any nodes which are still running finish before raising
+            concurrent.futures.wait(futures)
+            raise
+
+        return values
+
+    def batch(self, events, color=None):
+        """
+        Executes the graph once over a batch of events. Each node is executed
+        for all the events in the batch that provide its inputs, using the
+        ``batch`` method of the node. Batch-aware Map nodes receive their
+        inputs stacked into arrays, while all other nodes are looped over.
+
+        The returned dictionary has the same form as the one returned by
+        calling the graph and contains, for each output, the value from the
+        last event in the batch that produced it.
+
+        Args:
+            events (list): list of dictionaries of arguments required to
+                execute the graph nodes, one per event.
+            color (str): a valid color, either worker, localCollector, or
+                globalCollector.
+
+        Raises:
+            AssertionError: if compile() has not been called first or if
+                color is None.
+        """
+        assert self.graphkit is not None, "call compile first"
+        assert color is not None
+
+        events = [self.load(event, color) for event in events]
+        nevents = len(events)
+        values = {}
+        for idx, event in enumerate(events):
+            for name, value in event.items():
+                if value is not None:
+                    values.setdefault(name, [None]*nevents)[idx] = value
+
+        self.exec_times = {}
+        for node in self._execution_order(color):
+            start = time.time()
+            columns = [values.get(name) for name in it.chain(node.inputs, node.condition_needs)]
+            if all(column is not None for column in columns):
+                rows = [idx for idx in range(nevents) if all(column[idx] is not None for column in columns)]
+                if rows:
+                    # filters are passed their condition needs, other nodes only their inputs
+                    needs = node.condition_needs if isinstance(node, gn.Filter) else node.inputs
+                    results = node.batch(*[[values[name][idx] for idx in rows] for name in needs])
+                    for idx, result in zip(rows, results):
+                        if result is None:
+                            continue
+                        if len(node.outputs) == 1:
+                            result = (result,)
+                        for name, value in zip(node.outputs, result):
+                            if value is not None:
+                                values.setdefault(name, [None]*nevents)[idx] = value
+            self.exec_times[node.name] = time.time() - start
+
+        result = {}
+        for name in self.outputs[color]:
+            for value in reversed(values.get(name, ())):
+                if value is not None:
+                    result[name] = value
+                    break
+        return result
+
     def times(self):
         """
         Return time per execution of graphkit node.
         """
         assert self.graphkit is not None, "call compile first"
+        if self.exec_times is not None:
+            return self.exec_times
         return self.graphkit.times()
 
     def metadata(self):
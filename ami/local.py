@@ -101,6 +101,77 @@ def build_parser():
         help='extra flags as key=value pairs that are passed to the data source of the worker'
     )
 
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        help='the max number of events the workers buffer and execute the graph over at once (default: 1)'
+    )
+
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=0,
+        help='the number of messages the workers prefetch from the data source in the background (default: 0)'
+    )
+
+    parser.add_argument(
+        '--graph-threads',
+        type=int,
+        default=0,
+        help='the number of threads the workers use for executing different graphs concurrently (default: 0)'
+    )
+
+    parser.add_argument(
+        '--node-threads',
+        type=int,
+        default=0,
+        help='the number of threads each worker graph uses for executing independent nodes concurrently (default: 0)'
+    )
+
+    parser.add_argument(
+        '--profile-sample',
+        type=int,
+        default=1,
+        help='the workers profile one in every N graph executions, zero disables profiling (default: 1)'
+    )
+
+    parser.add_argument(
+        '--time-budget',
+        type=float,
+        default=0,
+        help='time budget in seconds for the workers to process a heartbeat, beyond which events are skipped, '
+             'zero disables skipping (default: 0)'
+    )
+
+    parser.add_argument(
+        '--shmem-size',
+        type=int,
+        default=0,
+        help='size in MB of the shared memory ring each worker uses for sending large arrays to the collector, '
+             'zero disables it (default: 0)'
+    )
+
+    parser.add_argument(
+        '--record',
+        help='record the messages from the data source of each worker to this file with the worker id appended '
+             'for replaying them with the replay source'
+    )
+
+    parser.add_argument(
+        '--deadline',
+        type=float,
+        default=0,
+        help='time in seconds after its first contribution that the collectors complete a heartbeat with the '
+             'contributions received so far, zero waits for all the contributions (default: 0)'
+    )
+
+    parser.add_argument(
+        '--compression',
+        help='compress the large arrays sent between the workers and collectors with this codec, as codec[:level] '
+             'where codec is one of zlib, lzma, lz4 or zstd (default: no compression)'
+    )
+
     parser.add_argument(
         '-g',
         '--graph-name',
@@ -145,7 +216,7 @@ def build_parser():
         'source',
         nargs='?',
         metavar='SOURCE',
-        help='data source configuration (exampes: static://test.json, psana://exp=xcsdaq13:run=14)'
+        help='data source configuration (exampes: static://test.json, psana://exp=xcsdaq13:run=14, replay://test.rec)'
     )
 
     parser.add_argument(
@@ -265,7 +336,9 @@ def run_ami(args, queue=None):
                 name='worker%03d-n0' % i,
                 target=functools.partial(_sys_exit, run_worker),
                 args=(i, args.num_workers, args.heartbeat, src_cfg,
-                      collector_addr, graph_addr, msg_addr, export_addr, flags, args.prometheus_dir, args.hutch)
+                      collector_addr, graph_addr, msg_addr, export_addr, flags, args.prometheus_dir, args.hutch,
+                      args.batch_size, args.prefetch, args.graph_threads, args.node_threads,
+                      args.profile_sample, args.time_budget, args.shmem_size, args.record, args.compression)
             )
             proc.daemon = True
             proc.start()
@@ -275,7 +348,7 @@ def run_ami(args, queue=None):
             name='nodecol-n0',
             target=functools.partial(_sys_exit, run_node_collector),
             args=(0, args.num_workers, collector_addr, globalcol_addr, graph_addr, msg_addr,
-                  args.prometheus_dir, args.hutch)
+                  args.prometheus_dir, args.hutch, args.compression, args.deadline)
         )
         collector_proc.daemon = True
         collector_proc.start()
@@ -285,7 +358,7 @@ def run_ami(args, queue=None):
             name='globalcol',
             target=functools.partial(_sys_exit, run_global_collector),
             args=(0, 1, globalcol_addr, results_addr, graph_addr, msg_addr,
-                  args.prometheus_dir, args.hutch)
+                  args.prometheus_dir, args.hutch, args.compression, args.deadline)
         )
         globalcol_proc.daemon = True
         globalcol_proc.start()
@@ -42,15 +42,19 @@ class Manager(Collector):
                  view_addr,
                  profile_addr,
                  prometheus_dir,
-                 hutch):
+                 hutch,
+                 fan_in=None):
         """
         protocol right now only tells you how to communicate with workers
         """
-        super().__init__(results_addr, hutch=hutch)
         self.name = "manager"
+        super().__init__(results_addr, hutch=hutch)
         self.num_workers = num_workers
         self.num_nodes = num_nodes
+        self.fan_in = fan_in
         self.heartbeats = {}
+        self.missing = {}
+        self.skipped = {}
         self.partition = {}
         self.feature_stores = {}
         self.feature_req = re.compile(r"(?P<type>fetch):(?P<name>.*)")
@@ -110,8 +114,7 @@ class Manager(Collector):
     def process_msg(self, msg):
         if msg.mtype == MsgTypes.Datagram:
             latency = dt.datetime.now() - dt.datetime.fromtimestamp(msg.heartbeat.timestamp)
-            self.event_latency.labels(self.hutch, 'globalCollector%03d' % msg.identity,
-                                      self.name).set(latency.total_seconds())
+            self.metrics.latency('globalCollector%03d' % msg.identity, latency.total_seconds())
             datagram_start = time.time()
             if msg.name not in self.feature_stores:
                 if msg.name in self.purged:
@@ -136,13 +139,18 @@ class Manager(Collector):
                 self.export_data(msg.name, msg.payload)
                 # update the latest heartbeat indicator
                 self.heartbeats[msg.name] = msg.heartbeat
+                # the number of workers whose results are missing from the heartbeat
+                self.missing[msg.name] = msg.missing
+                # the fraction of the events of the heartbeat skipped by the workers
+                self.skipped[msg.name] = msg.skipped
                 # export the heartbeat to epics
                 self.export_heartbeat(msg.name)
                 # export data for viewing in the AMI GUI
                 self.export_view(msg.name, keys=msg.payload.keys())
 
-            self.event_counter.labels(self.hutch, 'Heartbeat', self.name).inc()
-            self.event_time.labels(self.hutch, 'Heartbeat', self.name).set(time.time() - datagram_start)
+            self.metrics.count('Heartbeat')
+            self.metrics.time('Heartbeat', time.time() - datagram_start)
+            self.metrics.flush()
         elif (msg.mtype == MsgTypes.Transition) and (msg.payload.ttype == Transitions.Configure):
             changed = (msg.payload.payload != self.partition)
             self.partition = msg.payload.payload
@@ -155,7 +163,7 @@ class Manager(Collector):
 
     @property
     def compiler_args(self):
-        return {'num_workers': self.num_workers, 'num_local_collectors': self.num_nodes}
+        return {'num_workers': self.num_workers, 'num_local_collectors': self.num_nodes, 'fan_in': self.fan_in}
 
     def exists(self, name):
         return all(name in val for val in [self.feature_stores, self.graphs, self.versions, self.heartbeats])
@@ -168,6 +176,8 @@ class Manager(Collector):
             self.graphs[name] = None
             self.versions[name] = 0
             self.heartbeats[name] = None
+            self.missing[name] = 0
+            self.skipped[name] = 0.0
             # notify export of the new graph
             self.export_create(name)
             # remove the graph name from the purged list if there
@@ -180,6 +190,8 @@ class Manager(Collector):
             del self.graphs[name]
             del self.versions[name]
             del self.heartbeats[name]
+            del self.missing[name]
+            del self.skipped[name]
             # notify export of the removed graph
             self.export_destroy(name)
             # add the graph name to the purged list
@@ -249,6 +261,12 @@ class Manager(Collector):
     def cmd_get_heartbeat(self, name):
         self.comm.send_pyobj(self.heartbeats[name])
 
+    def cmd_get_missing(self, name):
+        self.comm.send_pyobj(self.missing[name])
+
+    def cmd_get_skipped(self, name):
+        self.comm.send_pyobj(self.skipped[name])
+
     def cmd_get_versions(self, name):
         self.comm.send_pyobj((self.versions[name], self.feature_stores[name].version))
 
@@ -481,10 +499,13 @@ class Manager(Collector):
         node = self.node_msg_comm.recv_string()
 
         if topic == "profile":
-            # graph = self.node_msg_comm.recv_string()
-            # payload = self.node_msg_comm.recv_multipart(copy=False)
-            self.node_msg_comm.recv_string()
-            self.node_msg_comm.recv_multipart(copy=False)
+            graph = self.node_msg_comm.recv_string()
+            payload = self.node_msg_comm.recv_multipart(copy=False)
+            # forward the profile data to any subscribed profilers
+            self.profile_comm.send_string(graph, zmq.SNDMORE)
+            self.profile_comm.send_string(node, zmq.SNDMORE)
+            self.profile_comm.send_string(topic, zmq.SNDMORE)
+            self.profile_comm.send_multipart(payload, copy=False)
         elif topic == "purge":
             name = dill.loads(self.node_msg_comm.recv(copy=False))
             if self.exists(name):
@@ -529,7 +550,7 @@ class Manager(Collector):
                 size += self.publish_view("view:%s:%s" % (name, key),
                                           self.heartbeats[name],
                                           value)
-        self.event_size.labels(self.hutch, self.name).set(size)
+        self.metrics.set_size(size)
 
     def export_request(self):
         request = self.export.recv_string()
@@ -635,7 +656,8 @@ def run_manager(num_workers,
                 view_addr,
                 profile_addr,
                 prometheus_dir,
-                hutch):
+                hutch,
+                fan_in=None):
     logger.info('Starting manager, controlling %d workers on %d nodes PID: %d',
                 num_workers, num_nodes, os.getpid())
     with Manager(
@@ -650,7 +672,8 @@ def run_manager(num_workers,
             view_addr,
             profile_addr,
             prometheus_dir,
-            hutch) as manager:
+            hutch,
+            fan_in) as manager:
         manager.start_prometheus()
         return manager.run()
 
@@ -766,6 +789,14 @@ def main():
         default=None
     )
 
+    parser.add_argument(
+        '--fan-in',
+        type=int,
+        nargs='+',
+        help='number of contributors of the collectors of each level of intermediate collectors between the nodes '
+             'and the global collector (default: no intermediate collectors)'
+    )
+
     args = parser.parse_args()
 
     results_addr = "tcp://%s:%d" % (args.host, args.results)
@@ -795,7 +826,8 @@ def main():
                            view_addr,
                            profile_addr,
                            args.prometheus_dir,
-                           args.hutch)
+                           args.hutch,
+                           args.fan_in)
     except KeyboardInterrupt:
         logger.info("Manager killed by user...")
         return 0
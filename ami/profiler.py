@@ -38,17 +38,17 @@ class HeartbeatData(object):
         self.heartbeat_times = collections.defaultdict(list)
 
     def add_worker_data(self, worker, data):
-        self.num_events[worker] = len(data)
+        self.num_events[worker] = data['events']
         node_time_per_heartbeat = collections.defaultdict(lambda: 0)
 
-        heartbeat_time = data[-1][1] - data[0][0]
+        heartbeat_time = data['stop'] - data['start']
         self.heartbeat_times['worker'].append(heartbeat_time)
 
-        for event in data:
-            start, stop, event = event
-            for node, time in event.items():
-                parent = self.metadata[node]['parent']
-                node_time_per_heartbeat[parent] += time
+        # scale the sampled times up to the total number of events
+        scale = data['events'] / data['sampled']
+        for node, time in data['sums'].items():
+            parent = self.metadata[node]['parent']
+            node_time_per_heartbeat[parent] += time * scale
 
         for node, time in node_time_per_heartbeat.items():
             self.worker_average[node].append(time)
@@ -267,7 +267,7 @@ class Profiler(QtCore.QObject):
                 heartbeat_data = self.heartbeat_data[heartbeat]
 
                 if name.startswith('worker'):
-                    heartbeat_data.add_worker_data(name, data['times'])
+                    heartbeat_data.add_worker_data(name, data)
                 elif name.startswith('localCollector'):
                     heartbeat_data.add_local_collector_data(name, data['times'])
                 elif name.startswith('globalCollector'):
@@ -3,6 +3,7 @@ import sys
 import zmq
 import time
 import shutil
+import pickle
 import logging
 import tempfile
 import argparse
@@ -25,7 +26,12 @@ class SimSync:
     This is primarily useful when the simulated data sources provided by AMI on
     a cluster of machines. Each time the simulated data source generates an
     event it can request a timestamp for that event from the timestamp sync
-    service via zeromq.
+    service via zeromq. Alternatively the data source can lease a contiguous
+    block of timestamps at once, which it then hands out locally.
+
+    The timestamp request socket is a ROUTER socket, so requests from many data
+    sources are queued and answered as they arrive instead of being handled in
+    lockstep as with a REP socket.
 
     Args:
         addr (str): the zmq address of the timestamp request socket
@@ -49,7 +55,7 @@ class SimSync:
             self.owner = False
         self.comm = self.ctx.socket(zmq.REP)
         self.comm.bind(comm_addr)
-        self.sock = self.ctx.socket(zmq.REP)
+        self.sock = self.ctx.socket(zmq.ROUTER)
         self.sock.bind(addr)
         self.poller = zmq.Poller()
         self.poller.register(self.sock, zmq.POLLIN)
@@ -61,6 +67,13 @@ class SimSync:
         self.ts = start
         self.tlast = None
         self.interval = interval
+        self.clients = set()
+        # the heartbeat period of the leases, the timestamps leased by each client in each heartbeat, and the
+        # next free timestamp of the heartbeat after the current one, which clients with their share of the
+        # current heartbeat lease from
+        self.period = None
+        self.leased = {}
+        self.ahead = None
 
     def comm_request(self):
         """
@@ -74,25 +87,106 @@ class SimSync:
         else:
             self.comm.send_pyobj(1)
 
+    def lease(self, client, count, period):
+        """
+        Leases a contiguous block of timestamps to a client. The block never
+        crosses a heartbeat boundary, and each client gets at most its share
+        of each heartbeat between all of the clients that have leased
+        timestamps, so that a fast client cannot take the timestamps of the
+        others. A client which has had its share of the current heartbeat
+        leases from the next one instead. When it has had its share of that
+        one too, the rest of the current heartbeat is given up.
+
+        Args:
+            client (bytes): the identity of the client.
+            count (int): the number of timestamps requested by the client.
+            period (int): the heartbeat period (in units of timestamps) of the
+                client.
+
+        Returns:
+            A tuple of the first timestamp of the block and its size.
+        """
+        if period != self.period:
+            # start over from the end of all the leased timestamps
+            if self.ahead is not None:
+                self.ts = self.ahead
+            self.period = period
+            self.leased = {}
+            self.ahead = None
+        self.clients.add(client)
+        share = -(-period // len(self.clients))
+        leased = self.leased.setdefault(client, {})
+
+        while True:
+            current = self.ts // period
+            if leased.get(current, 0) < share:
+                heartbeat, start = current, self.ts
+                break
+            if leased.get(current + 1, 0) < share:
+                heartbeat, start = current + 1, (current + 1) * period if self.ahead is None else self.ahead
+                if start < (current + 2) * period:
+                    break
+            # skip the rest of the current heartbeat
+            self.allocate((current + 1) * period - self.ts)
+
+        count = max(1, min(count, share - leased.get(heartbeat, 0), (heartbeat + 1) * period - start))
+        # forget the heartbeats that have been used up
+        self.leased[client] = {hb: num for hb, num in leased.items() if hb >= current}
+        self.leased[client][heartbeat] = leased.get(heartbeat, 0) + count
+        if heartbeat == current:
+            return self.allocate(count), count
+        else:
+            self.ahead = start + count
+            return start, count
+
+    def allocate(self, count):
+        """
+        Allocates the next timestamps and logs statistics each time the
+        reporting interval is crossed. The timestamps already leased from the
+        next heartbeat are skipped when the current one is used up.
+
+        Args:
+            count (int): the number of timestamps to allocate.
+
+        Returns:
+            The first of the allocated timestamps.
+        """
+        start = self.ts
+        self.ts += count
+        if self.ahead is not None and self.ts == (self.ts // self.period) * self.period:
+            self.ts = self.ahead
+            self.ahead = None
+        if self.ts // self.interval > start // self.interval:
+            tcurrent = time.time()
+            if self.tlast is not None:
+                tdelta = tcurrent - self.tlast
+                logger.info("Processing %f events per second", (self.interval/tdelta))
+            self.tlast = tcurrent
+        return start
+
     def timestamp_request(self):
         """
         Called whenever data is available on the the timestamp request socket.
-        The only request it can handle is 'ts'. If a 'ts' request is made the
-        reply is the next sequential timestamp value. If an invalid request is
-        made then None is the reply.
+        All of the queued requests are handled. The requests it can handle are
+        'ts' and 'lease <count> <period>'. If a 'ts' request is made the reply
+        is the next sequential timestamp value. If a 'lease' request is made the
+        reply is a tuple of the first timestamp of the leased block and its
+        size. If an invalid request is made then None is the reply.
         """
-        request = self.sock.recv_string()
-        if request == 'ts':
-            self.sock.send_pyobj(self.ts)
-            self.ts += 1
-            if self.ts % self.interval == 0:
-                tcurrent = time.time()
-                if self.tlast is not None:
-                    tdelta = tcurrent - self.tlast
-                    logger.info("Processing %f events per second", (self.interval/tdelta))
-                self.tlast = tcurrent
-        else:
-            self.sock.send_pyobj(None)
+        while True:
+            try:
+                *envelope, request = self.sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            request = request.decode().split()
+            if request == ['ts']:
+                reply = self.allocate(1)
+            elif len(request) == 3 and request[0] == 'lease' and all(r.isdigit() for r in request[1:]) \
+                    and int(request[2]) > 0:
+                reply = self.lease(envelope[0], int(request[1]), int(request[2]))
+            else:
+                reply = None
+            self.sock.send_multipart(envelope + [pickle.dumps(reply)])
 
     def run(self):
         """
@@ -7,29 +7,206 @@ import json
 import logging
 import argparse
 import time
-import prometheus_client as pc
+import threading
+import collections
+import concurrent.futures
 from ami import LogConfig, Defaults
-from ami.comm import Ports, Colors, ResultStore, Node, AutoExport
-from ami.data import MsgTypes, Source, Message, Transition, Transitions
+from ami.comm import Ports, Colors, ResultStore, Node, AutoExport, Profile, Metrics, SharedMemoryRing
+from ami.data import MsgTypes, Source, Message, Transition, Transitions, Prefetcher, LazyPayload, \
+    Recorder
 from ami.graphkit_wrapper import Graph
 
 
 logger = logging.getLogger(__name__)
 
 
+class GraphScheduler:
+    """Class for executing graphs concurrently on a shared thread pool.
+
+    Work submitted for different graphs can run concurrently, while work
+    submitted for the same graph is always run serially in the order it was
+    submitted, since graphs contain stateful nodes.
+
+    Args:
+        num_threads (int): the number of threads in the pool.
+    """
+
+    def __init__(self, num_threads):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='graph')
+        self.lock = threading.Lock()
+        self.queued = collections.defaultdict(collections.deque)
+        self.running = set()
+
+    def submit(self, name, func, *args):
+        """
+        Schedules func to be called with the passed args once all the work
+        previously submitted for the same graph has finished.
+
+        Args:
+            name (str): the name of the graph the work is for.
+            func (function): the function to call.
+            args: the arguments to pass to func.
+
+        Returns:
+            A `concurrent.futures.Future` for the result of the call.
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.queued[name].append((future, func, args))
+            if name in self.running:
+                return future
+            self.running.add(name)
+        self.pool.submit(self._run, name)
+        return future
+
+    def _run(self, name):
+        with self.lock:
+            future, func, args = self.queued[name].popleft()
+
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        with self.lock:
+            if not self.queued[name]:
+                self.running.discard(name)
+                return
+        # requeue to let work for the other graphs have a turn
+        self.pool.submit(self._run, name)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+class Prescaler:
+    """Adaptive prescaler for shedding load when the graphs are too expensive.
+
+    The average cost of executing the graphs on an event is tracked from
+    heartbeat to heartbeat, and is used to pick the fraction of the events of
+    the next heartbeat that can be executed within the time budget. The
+    executed events are spread evenly over the heartbeat, and at least one
+    event is executed per heartbeat so the cost estimate keeps updating.
+
+    Args:
+        budget (float): the time budget for processing a heartbeat in seconds.
+        smoothing (float): the weight of the latest heartbeat in the moving
+            average of the per event cost.
+    """
+
+    def __init__(self, budget, smoothing=0.5):
+        self.budget = budget
+        self.smoothing = smoothing
+        self.cost = None
+        self.fraction = 1.0
+        self.credit = 0.0
+        self.events = 0
+        self.skipped = 0
+
+    def skip(self):
+        """
+        Counts an event and checks if the graphs should be skipped for it.
+
+        Returns:
+            True if the event should be skipped, False otherwise.
+        """
+        self.events += 1
+        self.credit += self.fraction
+        # allow for rounding errors accumulating in the credit
+        if self.credit >= 1.0 - 1e-9:
+            self.credit -= 1.0
+            return False
+        self.skipped += 1
+        return True
+
+    def update(self, elapsed):
+        """
+        Updates the fraction of events to execute at the end of a heartbeat.
+
+        Args:
+            elapsed (float): the time spent processing the heartbeat in seconds.
+
+        Returns:
+            The fraction of the events of the heartbeat that were skipped.
+        """
+        executed = self.events - self.skipped
+        skipped = self.skipped / self.events if self.events else 0.0
+
+        if executed > 0:
+            cost = elapsed / executed
+            if self.cost is None:
+                self.cost = cost
+            else:
+                self.cost = self.smoothing * cost + (1 - self.smoothing) * self.cost
+
+        if self.cost and self.events:
+            self.fraction = min(1.0, max(self.budget / (self.cost * self.events), 1.0 / self.events))
+
+        self.events = 0
+        self.skipped = 0
+        return skipped
+
+
 class Worker(Node):
-    def __init__(self, node, src, collector_addr, graph_addr, msg_addr, export_addr, prometheus_dir, hutch):
+    def __init__(self, node, src, collector_addr, graph_addr, msg_addr, export_addr, prometheus_dir, hutch,
+                 batch_size=1, prefetch=0, graph_threads=0, node_threads=0, profile_sample=1,
+                 time_budget=0, shmem_size=0, record=None, compression=None):
         """
         node : int
             a unique integer identifying this worker
         src : object
             object with an events() method that is an iterable (like psana.DataSource)
+        batch_size : int
+            the maximum number of datagrams to buffer before executing the graphs over
+            them at once. The buffer is also flushed at heartbeat boundaries.
+        prefetch : int
+            the number of messages to prefetch from the source in a background
+            thread. A value of zero disables prefetching.
+        graph_threads : int
+            the number of threads to use for executing different graphs
+            concurrently. A value of zero executes the graphs serially.
+        node_threads : int
+            the number of threads each graph uses for executing its independent
+            nodes concurrently. A value of zero executes the nodes serially.
+        profile_sample : int
+            time one in every N executions of each graph for profiling. A value
+            of zero disables profiling.
+        time_budget : float
+            the time budget for processing a heartbeat in seconds. When the graphs
+            take longer than this the worker skips executing them on a fraction of
+            the events. A value of zero disables skipping events.
+        shmem_size : int
+            the size in MB of the shared memory ring used for sending large arrays to
+            the local collector. A value of zero sends all the data over zmq.
+        record : str
+            the path of a file to record the messages from the source to, which can be
+            replayed using the replay source. The id of the worker is appended to the
+            path. A value of None disables recording.
+        compression : str
+            the compression of the large arrays sent to the local collector, as
+            'codec[:level]', e.g. 'zlib' or 'zstd:3'. A value of None disables compression.
         """
         super().__init__(node, graph_addr, msg_addr, export_addr, prometheus_dir=prometheus_dir, hutch=hutch)
 
         self.src = src
         self.pending_src = False
-        self.store = ResultStore(collector_addr, self.ctx)
+        self.batch_size = batch_size
+        self.batch = []
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.scheduler = GraphScheduler(graph_threads) if graph_threads > 0 else None
+        self.pending = collections.defaultdict(collections.deque)
+        self.node_threads = node_threads
+        self.profile_sample = profile_sample
+        self.profiles = {}
+        self.prescaler = Prescaler(time_budget) if time_budget > 0 else None
+        if shmem_size > 0:
+            ring = SharedMemoryRing('ami_%d_%s' % (os.getpid(), self.name), shmem_size * 1024 * 1024)
+        else:
+            ring = None
+        self.store = ResultStore(collector_addr, self.ctx, ring, compression)
+        self.recorder = Recorder('%s.%03d' % (record, self.node)) if record else None
 
         self.graph_comm.add_command("config", self.send_configure)
         self.graph_comm.add_handler("update_sources", self.update_sources)
@@ -47,6 +224,12 @@ class Worker(Node):
         return "worker%03d" % self.node
 
     def close(self):
+        if self.scheduler is not None:
+            self.scheduler.shutdown()
+        if self.store.ring is not None:
+            self.store.ring.close()
+        if self.recorder is not None:
+            self.recorder.close()
         self.ctx.destroy()
 
     def send_configure(self):
@@ -65,8 +248,8 @@ class Worker(Node):
             self.graphs[name] = None
         if name in self.store:
             self.store.clear(name)
-        if name in self.times:
-            del self.times[name]
+        if name in self.profiles:
+            del self.profiles[name]
         self.update_requests()
 
     def update_requests(self):
@@ -74,11 +257,15 @@ class Worker(Node):
         for graph in self.graphs.values():
             if graph is not None:
                 requests.update(graph.sources)
-        self.src.request(requests)
+        # the source can only be changed by the prefetch thread while it is running
+        if self.prefetcher is not None:
+            self.prefetcher.request(requests)
+        else:
+            self.src.request(requests)
 
     def update_graph(self, name, version, args):
         if self.graphs[name]:
-            self.graphs[name].compile(**args)
+            self.graphs[name].compile(num_threads=self.node_threads, **args)
         self.update_requests()
         self.store.configure(name, version)
 
@@ -102,8 +289,8 @@ class Worker(Node):
             del self.graphs[name]
         if name in self.store:
             self.store.remove(name)
-        if name is self.times:
-            del self.times[name]
+        if name in self.profiles:
+            del self.profiles[name]
         self.update_requests()
 
     def recv_graph_exception(self, name, version, exception):
@@ -134,18 +321,16 @@ class Worker(Node):
             self.report("error", e)
             logger.error("%s: Error configuring source", self.name)
 
-    def collect(self, heartbeat):
+    def collect(self, heartbeat, skipped=0.0):
         # send the data from the store to collector
-        size = self.store.collect(self.node, heartbeat)
+        size = self.store.collect(self.node, heartbeat, skipped)
 
-        # update the profiler data
-        # if self.times:
-        #     for name, exec_times in self.times.items():
-        #         self.report("profile", {'graph': name,
-        #                                 'heartbeat': heartbeat,
-        #                                 'times': exec_times,
-        #                                 'version': self.store.version(name)})
-        #     self.times = {}
+        # send the profiler data for this heartbeat and reset it
+        for name, profile in self.profiles.items():
+            data = profile.collect()
+            if data is not None and name in self.store:
+                data.update(graph=name, heartbeat=heartbeat, version=self.store.version(name))
+                self.report("profile", data)
 
         if self.event_rate:
             self.event_rate['num_events'] = self.num_events
@@ -156,8 +341,116 @@ class Worker(Node):
         self.store.clear()
         return size
 
+    def execute_graph(self, graph, events):
+        """
+        Executes a single graph over a list of datagrams.
+
+        Args:
+            graph (Graph): the graph to execute.
+            events (list): the payloads of the datagrams.
+
+        Returns:
+            A tuple of the graph result, the start and stop times of the
+            execution, the per node execution times and the number of events.
+        """
+        start = time.time()
+        if self.batch_size > 1:
+            graph_result = graph.batch(events, color=Colors.Worker)
+        else:
+            graph_result = graph(events[0], color=Colors.Worker)
+        stop = time.time()
+
+        return graph_result, start, stop, graph.times(), len(events)
+
+    def update_results(self, name, graph_result, start, stop, exec_times, num_events=1):
+        self.store.update(name, graph_result)
+
+        if name not in self.event_rate:
+            self.event_rate[name] = []
+
+        # the event rate is the number of entries over their time span, so a
+        # batch gets one entry for each of its events
+        self.event_rate[name].extend([(start, stop)] * num_events)
+
+        if self.profile_sample > 0:
+            if name not in self.profiles:
+                self.profiles[name] = Profile(self.profile_sample)
+
+            profile = self.profiles[name]
+            if profile.sampling():
+                profile.update(start, stop, exec_times)
+
+    def graph_failure(self, name, exception):
+        logger.exception("%s: Failure encountered while executing graph (%s, v%d):",
+                         self.name, name, self.store.version(name))
+        self.report("error", exception)
+        logger.error("%s: Purging graph (%s v%d)", self.name, name, self.store.version(name))
+        self.clear_graph(name)
+        self.report("purge", name)
+
+    def execute(self):
+        """
+        Executes the graphs over the buffered datagrams and updates the result
+        store. When batching is disabled the graphs are called on the single
+        buffered datagram, otherwise they are executed once over the batch.
+
+        When a graph scheduler is used the graphs are instead submitted to run
+        concurrently and their results are merged into the store later by
+        `drain`.
+        """
+        if not self.batch:
+            return
+
+        events = self.batch
+        self.batch = []
+
+        for name, graph in self.graphs.items():
+            try:
+                if graph:
+                    if self.scheduler is not None:
+                        # the data each graph needs is read here, since the source
+                        # may have moved on by the time the graph runs, into a copy
+                        # of the events since executing a graph modifies them
+                        graph_events = [dict(graph.load(event, Colors.Worker), **self.exports.get(name, {}))
+                                        for event in events]
+                        self.pending[name].append(self.scheduler.submit(name, self.execute_graph,
+                                                                        graph, graph_events))
+                        continue
+
+                    if name in self.exports:
+                        for event in events:
+                            event.update(self.exports[name])
+
+                    self.update_results(name, *self.execute_graph(graph, events))
+
+            except Exception as e:
+                self.graph_failure(name, e)
+
+        self.drain()
+
+    def drain(self, wait=False):
+        """
+        Merges the results of graph executions submitted to the graph
+        scheduler into the result store. The results are always merged in
+        the order the graph executions were submitted.
+
+        Args:
+            wait (bool): if True wait for all the submitted graph executions
+                to finish, otherwise only merge the already finished ones.
+        """
+        for name, futures in self.pending.items():
+            while futures and (wait or futures[0].done()):
+                try:
+                    self.update_results(name, *futures.popleft().result())
+                except Exception as e:
+                    # discard the remaining executions of the failed graph
+                    for future in futures:
+                        future.cancel()
+                    concurrent.futures.wait(futures)
+                    futures.clear()
+                    self.graph_failure(name, e)
+
     def run(self):
-        self.times = {}
         self.event_rate = {}
         self.num_events = 1
         self.start_prometheus()
@@ -166,23 +459,41 @@ class Worker(Node):
             logger.info("%s: Waiting for source configuration", self.name)
             self.graph_comm.recv(True)
 
-        event_counter = pc.Counter('ami_event_count', 'Event Counter', ['hutch', 'type', 'process'])
-        event_time = pc.Gauge('ami_event_time_secs', 'Event Time', ['hutch', 'type', 'process'])
-        event_size = pc.Gauge('ami_event_size_bytes', 'Event Size', ['hutch', 'process'])
+        metrics = Metrics(self.hutch, self.name)
+        metrics.add_gauge('Prefetch Depth', 'ami_prefetch_depth', 'Prefetch Queue Depth')
+        metrics.add_gauge('Skipped Fraction', 'ami_skipped_fraction', 'Fraction of Events Skipped')
+        if self.store.compression is not None:
+            metrics.add_gauge('Compression Ratio', 'ami_compression_ratio', 'Compression Ratio of Sent Data')
+            metrics.add_gauge('Compression Time', 'ami_compression_time_secs', 'Compression Time')
 
         idle_start = time.time()
         idle_stop = time.time()
         heartbeat_time = 0
 
         while True:
-            for msg in self.src.events():
+            if self.prefetch > 0:
+                reader = self.prefetcher = Prefetcher(self.src, self.prefetch)
+            else:
+                reader = self.src
+
+            for msg in reader.events():
                 idle_stop = time.time()
-                event_time.labels(self.hutch, 'Idle', self.name).set(idle_stop - idle_start)
+                metrics.time('Idle', idle_stop - idle_start)
+
+                if self.recorder is not None:
+                    self.recorder.write(msg, reader.heartbeat)
 
                 # check to see if the graph has been reconfigured after update
                 if msg.mtype == MsgTypes.Heartbeat:
                     heartbeat_start = time.time()
-                    size = self.collect(msg.payload)
+                    # execute the graphs on any datagrams still buffered from this heartbeat
+                    self.execute()
+                    self.drain(wait=True)
+                    skipped = 0.0
+                    if self.prescaler is not None:
+                        skipped = self.prescaler.update(heartbeat_time + time.time() - heartbeat_start)
+                        metrics.set('Skipped Fraction', skipped)
+                    size = self.collect(msg.payload, skipped)
 
                     for name, graph in self.graphs.items():
                         if graph:
@@ -203,77 +514,75 @@ class Worker(Node):
                         except zmq.Again:
                             break
 
-                    event_counter.labels(self.hutch, 'Heartbeat', self.name).inc()
+                    metrics.count('Heartbeat')
+
+                    if self.prefetch > 0:
+                        prefetch_empty, prefetch_full = reader.stats()
+                        metrics.set('Prefetch Depth', reader.qsize)
+                        metrics.count('Prefetch Empty', prefetch_empty)
+                        metrics.count('Prefetch Full', prefetch_full)
 
                     if self.pending_src:
                         break
 
                     heartbeat_stop = time.time()
                     heartbeat_time += heartbeat_stop - heartbeat_start
-                    event_time.labels(self.hutch, 'Heartbeat', self.name).set(heartbeat_time)
-                    event_size.labels(self.hutch, self.name).set(size)
+                    metrics.time('Heartbeat', heartbeat_time)
+                    metrics.set_size(size)
+                    if self.store.compression is not None:
+                        stats = self.store.compression.stats()
+                        if stats is not None:
+                            metrics.set('Compression Ratio', stats[0])
+                            metrics.set('Compression Time', stats[1])
+                    metrics.flush()
                     heartbeat_time = 0
 
                 elif msg.mtype == MsgTypes.Datagram:
                     datagram_start = time.time()
 
-                    if any(v is None for k, v in msg.payload.items()):
-                        event_counter.labels(self.hutch, 'Partial', self.name).inc()
-
-                    for name, graph in self.graphs.items():
-                        try:
-                            if graph:
-                                if name in self.exports:
-                                    msg.payload.update(self.exports[name])
-
-                                start = time.time()
-                                graph_result = graph(msg.payload, color=Colors.Worker)
-                                stop = time.time()
-
-                                self.store.update(name, graph_result)
-
-                                if name not in self.event_rate:
-                                    self.event_rate[name] = []
-
-                                self.event_rate[name].append((start, stop))
-
-                                if name not in self.times:
-                                    self.times[name] = []
-
-                                self.times[name].append((start, stop, graph.times()))
+                    # checking lazy payloads for missing data would read all of it
+                    if not isinstance(msg.payload, LazyPayload) and any(v is None for v in msg.payload.values()):
+                        metrics.count('Partial')
 
-                        except Exception as e:
-                            logger.exception("%s: Failure encountered while executing graph (%s, v%d):",
-                                             self.name, name, self.store.version(name))
-                            self.report("error", e)
-                            logger.error("%s: Purging graph (%s v%d)", self.name, name, self.store.version(name))
-                            self.clear_graph(name)
-                            self.report("purge", name)
+                    if self.prescaler is not None and self.prescaler.skip():
+                        metrics.count('Skipped')
+                    else:
+                        self.batch.append(msg.payload)
+                        if len(self.batch) >= self.batch_size:
+                            self.execute()
 
                     self.num_events += 1
-                    event_counter.labels(self.hutch, 'Datagram', self.name).inc()
+                    metrics.count('Datagram')
                     datagram_duration = time.time() - datagram_start
-                    event_time.labels(self.hutch, 'Datagram', self.name).set(datagram_duration)
+                    metrics.time('Datagram', datagram_duration)
                     heartbeat_time += datagram_duration
 
                 elif msg.mtype == MsgTypes.Transition:
+                    self.execute()
+                    self.drain(wait=True)
                     if msg.payload.ttype == Transitions.Configure:
                         for name, graph in self.graphs.items():
                             if graph:
                                 graph.reset()
                     elif msg.payload.ttype == Transitions.Unconfigure:
-                        if self.src.heartbeat is not None:
-                            self.collect(self.src.heartbeat)
+                        if reader.heartbeat is not None:
+                            self.collect(reader.heartbeat)
 
                     # forward the transition
                     self.store.send(msg)
-                    event_counter.labels(self.hutch, 'Transition', self.name).inc()
+                    metrics.count('Transition')
+                    metrics.flush()
                 else:
                     self.store.send(msg)
-                    event_counter.labels(self.hutch, 'Other', self.name).inc()
+                    metrics.count('Other')
 
                 idle_start = time.time()
 
+            if self.prefetch > 0:
+                # stop prefetching from the source and drop any unused messages
+                reader.cancel()
+                self.prefetcher = None
+
             if self.pending_src:
                 msg = self.src.unconfigure()
                 self.store.send(msg)
@@ -282,7 +591,8 @@ class Worker(Node):
 
 
 def run_worker(num, num_workers, hb_period, source, collector_addr, graph_addr, msg_addr, export_addr,
-               flags=None, prometheus_dir=None, hutch=None):
+               flags=None, prometheus_dir=None, hutch=None, batch_size=1, prefetch=0, graph_threads=0,
+               node_threads=0, profile_sample=1, time_budget=0, shmem_size=0, record=None, compression=None):
 
     logger.info('Starting worker # %d, sending to collector at %s PID: %d', num, collector_addr, os.getpid())
 
@@ -307,6 +617,8 @@ def run_worker(num, num_workers, hb_period, source, collector_addr, graph_addr,
             for c in cfg:
                 k, v = c.split('=')
                 src_cfg[k] = v
+        elif src_type == 'replay':
+            src_cfg = {'file': source[1]}
 
         src_cls = Source.find_source(src_type)
         if src_cls is not None:
@@ -319,7 +631,9 @@ def run_worker(num, num_workers, hb_period, source, collector_addr, graph_addr,
             logger.critical("worker%03d: unknown data source type: %s", num, source[0])
             return 1
 
-    with Worker(num, src, collector_addr, graph_addr, msg_addr, export_addr, prometheus_dir, hutch) as worker:
+    with Worker(num, src, collector_addr, graph_addr, msg_addr, export_addr, prometheus_dir, hutch,
+                batch_size, prefetch, graph_threads, node_threads, profile_sample, time_budget,
+                shmem_size, record, compression) as worker:
         return worker.run()
 
 
@@ -419,6 +733,68 @@ def main():
         help='extra flags as key=value pairs that are passed to the data source'
     )
 
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        help='the max number of events to buffer and execute the graph over at once (default: 1)'
+    )
+
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=0,
+        help='the number of messages to prefetch from the data source in the background (default: 0)'
+    )
+
+    parser.add_argument(
+        '--graph-threads',
+        type=int,
+        default=0,
+        help='the number of threads to use for executing different graphs concurrently (default: 0)'
+    )
+
+    parser.add_argument(
+        '--node-threads',
+        type=int,
+        default=0,
+        help='the number of threads each graph uses for executing independent nodes concurrently (default: 0)'
+    )
+
+    parser.add_argument(
+        '--profile-sample',
+        type=int,
+        default=1,
+        help='profile one in every N graph executions, zero disables profiling (default: 1)'
+    )
+
+    parser.add_argument(
+        '--time-budget',
+        type=float,
+        default=0,
+        help='time budget in seconds for processing a heartbeat, beyond which events are skipped, '
+             'zero disables skipping (default: 0)'
+    )
+
+    parser.add_argument(
+        '--shmem-size',
+        type=int,
+        default=0,
+        help='size in MB of the shared memory ring for sending large arrays to the local collector, '
+             'zero disables it (default: 0)'
+    )
+
+    parser.add_argument(
+        '--record',
+        help='record the messages from the data source to this file for replaying them with the replay source'
+    )
+
+    parser.add_argument(
+        '--compression',
+        help='compress the large arrays sent to the collector with this codec, as codec[:level] where codec is one '
+             'of zlib, lzma, lz4 or zstd (default: no compression)'
+    )
+
     parser.add_argument(
         '--log-level',
         default=LogConfig.Level,
@@ -446,7 +822,8 @@ def main():
         'source',
         nargs='?',
         metavar='SOURCE',
-        help='data source configuration (exampes: static://test.json, random://test.json, psana://exp=xcsdaq13:run=14)'
+        help='data source configuration (exampes: static://test.json, random://test.json, psana://exp=xcsdaq13:run=14, '
+             'replay://test.rec)'
     )
 
     args = parser.parse_args()
@@ -474,7 +851,16 @@ def main():
                           export_addr,
                           flags,
                           args.prometheus_dir,
-                          args.hutch)
+                          args.hutch,
+                          args.batch_size,
+                          args.prefetch,
+                          args.graph_threads,
+                          args.node_threads,
+                          args.profile_sample,
+                          args.time_budget,
+                          args.shmem_size,
+                          args.record,
+                          args.compression)
     except KeyboardInterrupt:
         logger.info("Worker killed by user...")
         return 0
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import sys
+import time
+import random
+import argparse
+import zmq
+import numpy as np
+from ami.comm import Colors, EventBuilder
+from ami.data import Heartbeat
+
+
+parser = argparse.ArgumentParser(description='Benchmark the EventBuilder of a collector with out-of-order arrivals.')
+parser.add_argument('--contribs', type=int, default=100, help='Number of contributors.')
+parser.add_argument('--graphs', type=int, default=4, help='Number of graphs.')
+parser.add_argument('--heartbeats', type=int, default=500, help='Number of heartbeats.')
+parser.add_argument('--depth', type=int, default=10, help='Number of pending heartbeats kept by the builder.')
+parser.add_argument('--jitter', type=float, default=5, help='Max delay in heartbeats of the contributions.')
+parser.add_argument('--missing', type=float, default=0.001, help='Fraction of the contributions which never arrive.')
+parser.add_argument('--seed', type=int, default=0, help='Seed of the random arrival order.')
+
+
+def arrivals(args):
+    """
+    Generates the contributions of each heartbeat, each one delayed by a
+    random amount so the contributions of different heartbeats interleave.
+    """
+    rng = random.Random(args.seed)
+    contribs = []
+    for hb in range(args.heartbeats):
+        heartbeat = Heartbeat(hb, float(hb))
+        for eb_id in range(args.contribs):
+            if rng.random() >= args.missing:
+                contribs.append((hb + rng.uniform(0, args.jitter), heartbeat, eb_id))
+    contribs.sort(key=lambda contrib: contrib[0])
+    return [(heartbeat, eb_id) for _, heartbeat, eb_id in contribs]
+
+
+def main():
+    args = parser.parse_args()
+
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PULL)
+    sock.bind('inproc://bench_event_builder')
+    builder = EventBuilder(args.contribs, args.depth, Colors.LocalCollector, 'inproc://bench_event_builder', ctx)
+    names = ['graph%02d' % i for i in range(args.graphs)]
+    for name in names:
+        builder.create(name)
+
+    contribs = arrivals(args)
+    times = np.zeros(len(contribs) * len(names))
+    completed = 0
+    pruned = 0
+    idx = 0
+    for heartbeat, eb_id in contribs:
+        for name in names:
+            # the same sequence of calls as GraphCollector.process_msg
+            start = time.perf_counter()
+            builder.update(name, heartbeat, eb_id, 0, {})
+            if builder.ready(name, heartbeat):
+                builder.prune(name, 0, heartbeat)
+                builder.complete(name, heartbeat, 0)
+                completed += 1
+            else:
+                _, size = builder.prune(name, 0)
+                if size:
+                    pruned += 1
+            times[idx] = time.perf_counter() - start
+            idx += 1
+
+            while True:
+                try:
+                    sock.recv_multipart(zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+
+    print("%d contributions to %d graphs: %d completed, %d pruned heartbeats" %
+          (len(contribs), len(names), completed, pruned))
+    print("Time per contribution: mean %.2f us, median %.2f us, total %.3f s" %
+          (1e6 * times.mean(), 1e6 * np.median(times), times.sum()))
+
+    sock.close(linger=0)
+    ctx.destroy()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
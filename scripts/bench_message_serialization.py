@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+import sys
+import time
+import argparse
+import dataclasses
+import numpy as np
+from ami.data import MsgTypes, Message, CollectorMessage, Transition, Transitions, Heartbeat, \
+    SerializationProtocols, Serializer, Deserializer
+
+
+parser = argparse.ArgumentParser(description='Benchmark the serialization of AMI messages with large image payloads.')
+parser.add_argument('--size', type=float, default=4, help='Size in MB of the image in each message.')
+parser.add_argument('--images', type=int, default=1, help='Number of images in each message.')
+parser.add_argument('--iterations', type=int, default=200, help='Number of times each message is serialized.')
+
+
+def timeit(func, msg, iterations):
+    times = np.zeros(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(msg)
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def roundtrip(protocol):
+    serializer = Serializer(protocol)
+    deserializer = Deserializer(protocol)
+
+    def func(msg):
+        return deserializer(serializer(msg))
+
+    return func
+
+
+def main():
+    args = parser.parse_args()
+
+    side = int(np.sqrt(args.size * 1024 * 1024 / 4))
+    payload = {'image%02d' % i: np.ones((side, side), dtype=np.float32) for i in range(args.images)}
+    messages = {
+        'Message': Message(MsgTypes.Datagram, 0, payload, 1),
+        'CollectorMessage': CollectorMessage(mtype=MsgTypes.Datagram, identity=0, heartbeat=Heartbeat(1, 1.0),
+                                             name='graph', version=1, payload=payload),
+        'Transition': Message(MsgTypes.Transition, 0, Transition(Transitions.Configure, payload)),
+    }
+    print("Payload of %d images of %dx%d float32 (%.1f MB)" %
+          (args.images, side, side, sum(img.nbytes for img in payload.values()) / 1024**2))
+
+    methods = [('asdict', dataclasses.asdict), ('_serialize', lambda msg: msg._serialize())]
+    for protocol in SerializationProtocols:
+        if protocol is None:
+            continue
+        try:
+            roundtrip(protocol)(messages['Message'])
+        except Exception:
+            # skip protocols which are not available in this environment
+            continue
+        methods.append(('%s roundtrip' % protocol, roundtrip(protocol)))
+
+    print("%-20s %-18s %12s %12s" % ('Method', 'Message', 'Mean (us)', 'Median (us)'))
+    for method, func in methods:
+        for name, msg in messages.items():
+            times = timeit(func, msg, args.iterations)
+            print("%-20s %-18s %12.1f %12.1f" % (method, name, 1e6 * times.mean(), 1e6 * np.median(times)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
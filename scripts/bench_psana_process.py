@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import sys
+import time
+import types
+import argparse
+import numpy as np
+import ami.data
+
+
+parser = argparse.ArgumentParser(description='Benchmark PsanaSource event processing on synthetic detectors.')
+parser.add_argument('--epics', type=int, default=150, help='Number of requested EPICS variables.')
+parser.add_argument('--dets', type=int, default=10, help='Number of area detectors.')
+parser.add_argument('--attrs', type=int, default=5, help='Number of requested attributes per area detector.')
+parser.add_argument('--events', type=int, default=2000, help='Number of events to process.')
+parser.add_argument('--lazy', action='store_true', help='Use lazy payloads and read all their data.')
+
+
+class Interface:
+    def __init__(self, attrs):
+        for attr in attrs:
+            setattr(self, attr, self._make_attr(attr))
+
+    @staticmethod
+    def _make_attr(attr):
+        def read(evt):
+            return evt
+        read.__name__ = attr
+        return read
+
+
+class Detector:
+    def __init__(self, name, xface, attrs, is_env):
+        self._dettype = 'epics' if is_env else 'area'
+        self.dtype = float
+        if not is_env:
+            setattr(self, xface, Interface(attrs))
+
+    def __call__(self, evt):
+        return evt
+
+
+class Run:
+    def __init__(self, num_epics, num_dets, num_attrs):
+        attrs = ['attr%02d' % i for i in range(num_attrs)]
+        self.detinfo = {('det%02d' % i, 'raw'): attrs for i in range(num_dets)}
+        self.epicsinfo = {('EPICS:VAR:%03d' % i, 'epics'): 'value' for i in range(num_epics)}
+        self.stepinfo = {}
+        self.scaninfo = {}
+
+    def Detector(self, name):
+        for (detname, xface), attrs in self.detinfo.items():
+            if detname == name:
+                return Detector(name, xface, attrs, False)
+        return Detector(name, None, [], True)
+
+
+def main():
+    args = parser.parse_args()
+
+    if ami.data.psana is None:
+        # only synthetic detectors are used, so psana itself is not needed
+        ami.data.psana = types.ModuleType('psana')
+
+    cfg = {'type': 'psana', 'interval': 0, 'init_time': 0, 'lazy': args.lazy}
+    src = ami.data.PsanaSource(0, 1, 10, cfg)
+    run = Run(args.epics, args.dets, args.attrs)
+    src._update(run)
+
+    src.request(src.names)
+    print("Requested %d fields" % len(src.requested_data))
+
+    times = np.zeros(args.events)
+    for i in range(args.events):
+        start = time.perf_counter()
+        event = src._process(i)
+        if args.lazy:
+            event = dict(event)
+        times[i] = time.perf_counter() - start
+
+    print("Processing time per event: mean %.1f us, median %.1f us" % (1e6 * times.mean(), 1e6 * np.median(times)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -53,13 +53,15 @@ setup(
             'ami-worker = ami.worker:main',
             'ami-manager = ami.manager:main',
             'ami-node = ami.collector:node_main',
+            'ami-intermediate = ami.collector:intermediate_main',
             'ami-global = ami.collector:global_main',
             'ami-client = ami.client:main',
             'ami-console = ami.console:main',
             'ami-local = ami.local:main',
             'ami-export = ami.export:main',
             'ami-syncer = ami.sync:main',
-            'ami-profiler = ami.profiler:main'
+            'ami-profiler = ami.profiler:main',
+            'ami-benchmark = ami.benchmark:main'
         ]
     },
     classifiers=[
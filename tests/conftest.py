@@ -43,7 +43,8 @@ psanatest = pytest.mark.skipif(psana is None, reason="psana not avaliable")
 epicstest = pytest.mark.skipif(p4p is None, reason="p4p not avaliable")
 
 
-pyarrowtest = pytest.mark.skipif(pa is None, reason="pyarrow not avaliable")
+pyarrowtest = pytest.mark.skipif(pa is None or not hasattr(pa, 'serialize'),
+                                 reason="pyarrow serialization not avaliable")
 
 
 hdf5test = pytest.mark.skipif(h5py is None, reason="h5py not avaliable")
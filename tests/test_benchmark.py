@@ -0,0 +1,18 @@
+import pytest
+from ami.benchmark import Payloads, Transports, run_benchmark, format_table
+
+
+@pytest.mark.parametrize('transport', Transports)
+def test_benchmark(transport):
+    results = run_benchmark(['pickle5'], [transport], list(Payloads), 2)
+
+    assert [res['payload'] for res in results] == list(Payloads)
+    for res in results:
+        assert res['protocol'] == 'pickle5'
+        assert res['transport'] == transport
+        assert res['size'] > 0
+        assert res['latency_us'] > 0
+        assert res['msgs_per_sec'] > 0
+
+    table = format_table(results).splitlines()
+    assert len(table) == len(Payloads) + 1
@@ -1,5 +1,5 @@
 from qtpy import QtCore
-from ami.flowchart.library.Numpy import Projection, Binning
+from ami.flowchart.library.Numpy import Projection, Binning, Average1D
 from ami.flowchart.library.Accumulators import PickN
 from ami.flowchart.library.Display import ScatterPlot, ScalarPlot
 import ami.graph_nodes as gn
@@ -83,6 +83,36 @@ def test_binning(qtbot):
     assert len(op) == 2
     assert type(op[0]) == gn.Map
     assert type(op[1]) == gn.Accumulator
+    assert op[1].inplace
+
+    bins, counts = op[0].func(np.arange(100))
+    op[1](bins, counts)
+    res = op[1](bins, counts)
+    assert res[1] is not counts
+    np.testing.assert_equal(res[1], 2*counts)
+
+
+def test_average1d(qtbot):
+
+    node = Average1D('average')
+    widget = node.ctrlWidget()
+    qtbot.addWidget(widget)
+    node.values['infinite'] = True
+
+    op = node.to_operation(inputs={"In": node.name()})
+    assert type(op[0]) is gn.Accumulator
+
+    # integer waveforms are summed exactly
+    res = None
+    for _ in range(3):
+        res = op[0](np.full(4, 30000, dtype=np.int16))
+    assert res[0].dtype == np.int64
+    np.testing.assert_equal(op[1].func(res), np.full(4, 30000))
+
+    # float data is summed in double precision
+    op = node.to_operation(inputs={"In": node.name()})
+    res = op[0](np.full(4, 0.1, dtype=np.float32))
+    assert res[0].dtype == np.float64
 
 
 def test_scatterplot(qtbot):
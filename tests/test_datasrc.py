@@ -1,4 +1,6 @@
+import time
 import pytest
+import threading
 import typing
 import numpy as np
 import amitypes as at
@@ -12,7 +14,8 @@ except ImportError:
     h5py = None
 
 from conftest import psanatest, hdf5test
-from ami.data import MsgTypes, Source, Transition, Transitions
+from ami.data import MsgTypes, Source, Transition, Transitions, Prefetcher, RateLimiter, Recorder, \
+    selection_name
 
 
 @pytest.fixture(scope='function')
@@ -118,6 +121,166 @@ def test_hdf5_source(hdf5writer):
     assert evt.mtype == MsgTypes.Transition and evt.payload.ttype == Transitions.Unconfigure
 
 
+@hdf5test
+@pytest.mark.parametrize('block_size, expected',
+                         [
+                            (3, [[0, 1, 2, 6, 7, 8], [3, 4, 5, 9]]),
+                            (4, [[0, 1, 2, 3, 8, 9], [4, 5, 6, 7]]),
+                            (16, [list(range(10)), []]),
+                         ])
+def test_hdf5_blocks(hdf5writer, block_size, expected):
+    src_cls = Source.find_source('hdf5')
+    num_workers = 2
+    heartbeat_period = 5
+    src_cfg = {
+        'type': 'hdf5',
+        'interval':  0,
+        'init_time':  0,
+        'files': [str(hdf5writer)],
+        'blocks': True,
+        'block_size': block_size,
+    }
+
+    for idnum in range(num_workers):
+        source = src_cls(idnum, num_workers, heartbeat_period, src_cfg)
+        source.request({'ec', 'camera', 'camera:image'})
+
+        # each worker should get contiguous blocks of events
+        indices = []
+        for evt in source.events():
+            if evt.mtype == MsgTypes.Datagram:
+                index = evt.payload['ec']
+                np.testing.assert_array_equal(evt.payload['camera:image'], np.arange(16).reshape((4, 4)) + 16 * index)
+                np.testing.assert_array_equal(evt.payload['camera']['image'], evt.payload['camera:image'])
+                indices.append(index)
+
+        assert indices == expected[idnum]
+
+
+@hdf5test
+def test_hdf5_block_reads(tmp_path):
+    fname = tmp_path / 'chunked.h5'
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset("ec", data=np.arange(20), chunks=(8,))
+        f.create_dataset("camera/image", data=np.arange(320).reshape((20, 4, 4)), chunks=(4, 4, 4))
+
+    src_cls = Source.find_source('hdf5')
+    src_cfg = {
+        'type': 'hdf5',
+        'interval':  0,
+        'init_time':  0,
+        'files': [str(fname)],
+        'blocks': True,
+        'block_bytes': 2 * 16 * np.dtype(np.int64).itemsize,
+    }
+
+    source = src_cls(0, 1, 5, src_cfg)
+    source.request({'ec', 'camera:image'})
+
+    # each dataset is read in pieces sized by its own chunks and the byte budget
+    reads = {}
+    for evt in source.events():
+        if evt.mtype == MsgTypes.Datagram:
+            index = evt.payload['ec']
+            np.testing.assert_array_equal(evt.payload['camera:image'], np.arange(16).reshape((4, 4)) + 16 * index)
+            for name, (start, block) in source.blocks.items():
+                reads.setdefault(name, set()).add((start, len(block)))
+
+    assert source.block_size == 8
+    assert reads['/ec'] == {(0, 8), (8, 8), (16, 4)}
+    assert reads['/camera/image'] == {(start, 2) for start in range(0, 20, 2)}
+
+
+@hdf5test
+@pytest.mark.parametrize('shard, num_files, expected',
+                         [
+                            ('files', 3, [list(range(10)) * 2, list(range(10))]),
+                            ('ranges', 1, [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9]]),
+                            ('ranges', 2, [[0, 1, 2, 3, 4] * 2, [5, 6, 7, 8, 9] * 2]),
+                         ])
+@pytest.mark.parametrize('blocks', [False, True])
+def test_hdf5_shards(hdf5writer, shard, num_files, expected, blocks):
+    src_cls = Source.find_source('hdf5')
+    num_workers = 2
+    heartbeat_period = 5
+    src_cfg = {
+        'type': 'hdf5',
+        'interval':  0,
+        'init_time':  0,
+        'files': [str(hdf5writer)] * num_files,
+        'shard': shard,
+        'blocks': blocks,
+        'block_size': 4,
+    }
+
+    transitions = []
+    for idnum in range(num_workers):
+        source = src_cls(idnum, num_workers, heartbeat_period, dict(src_cfg))
+        source.request({'ec', 'camera:image'})
+
+        # each worker should read its shard of the events sequentially
+        indices = []
+        ttypes = []
+        for evt in source.events():
+            if evt.mtype == MsgTypes.Datagram:
+                index = evt.payload['ec']
+                np.testing.assert_array_equal(evt.payload['camera:image'], np.arange(16).reshape((4, 4)) + 16 * index)
+                indices.append(index)
+            elif evt.mtype == MsgTypes.Transition:
+                ttypes.append(evt.payload.ttype)
+
+        assert indices == expected[idnum]
+        transitions.append(ttypes)
+
+    # all the workers should emit the same transitions for each run
+    num_runs = -(-num_files // num_workers) if shard == 'files' else num_files
+    assert transitions[0] == transitions[1]
+    assert transitions[0] == [Transitions.Configure, Transitions.Unconfigure] * num_runs
+
+
+@hdf5test
+@pytest.mark.parametrize('full', [False, True])
+@pytest.mark.parametrize('blocks', [False, True])
+@pytest.mark.parametrize('lazy', [False, True])
+def test_hdf5_selection(hdf5writer, full, blocks, lazy):
+    src_cls = Source.find_source('hdf5')
+    src_cfg = {
+        'type': 'hdf5',
+        'interval':  0,
+        'init_time':  0,
+        'files': [str(hdf5writer)],
+        'blocks': blocks,
+        'lazy': lazy,
+    }
+    selection = selection_name('camera:image', (slice(1, 3), slice(None, 2)))
+    requested = {'ec', selection, 'camera:raw[2:4]'}
+    if full:
+        requested.add('camera:image')
+
+    source = src_cls(0, 1, 5, src_cfg)
+    source.request(requested)
+
+    count = 0
+    for evt in source.events():
+        if evt.mtype == MsgTypes.Datagram:
+            payload = dict(evt.payload)
+            image = np.arange(16).reshape((4, 4)) + 16 * payload['ec']
+            raw = np.arange(16).reshape((4, 2, 2)) + 16 * payload['ec']
+            # the full data is only included if it was requested
+            assert set(payload) == requested
+            np.testing.assert_array_equal(payload[selection], image[1:3, :2])
+            np.testing.assert_array_equal(payload['camera:raw[2:4]'], raw[2:4])
+            if full:
+                np.testing.assert_array_equal(payload['camera:image'], image)
+            count += 1
+
+    assert count == 10
+    assert source.requested_selections == {
+        selection: ('camera:image', (slice(1, 3), slice(None, 2))),
+        'camera:raw[2:4]': ('camera:raw', (slice(2, 4),)),
+    }
+
+
 @psanatest
 def test_psana_source(xtcwriter):
     psana_src_cls = Source.find_source('psana')
@@ -370,6 +533,99 @@ def test_random_source(sim_src_cfg):
             break
 
 
+@pytest.mark.parametrize('src_type', ['random', 'static'])
+def test_sim_source_pool(sim_src_cfg, src_type):
+    src_cls = Source.find_source(src_type)
+    sim_src_cfg['pool'] = 3
+    sim_src_cfg['block'] = 4
+
+    source = src_cls(0, 1, 10, sim_src_cfg)
+    source.request({'cspad', 'acq', 'delta_t'})
+
+    events = []
+    for msg in source.events():
+        if msg.mtype == MsgTypes.Datagram:
+            events.append(msg.payload)
+            if len(events) == 2 * sim_src_cfg['pool']:
+                break
+
+    for idx, event in enumerate(events):
+        assert type(event['delta_t']) is int
+        assert 0 <= event['delta_t'] < 10
+        for name in ['cspad', 'acq']:
+            # the arrays from the pool should be read-only and reused
+            assert not event[name].flags.writeable
+            np.testing.assert_array_equal(event[name], events[idx % sim_src_cfg['pool']][name])
+
+
+def test_record_replay(tmp_path, sim_src_cfg):
+    path = str(tmp_path / 'test.rec')
+    num_workers = 2
+
+    source = Source.find_source('random')(0, 1, 2, sim_src_cfg)
+    source.request({'cspad', 'acq', 'delta_t'})
+
+    recorded = []
+    with Recorder(path) as recorder:
+        for msg in source.events():
+            recorder.write(msg, source.heartbeat)
+            recorded.append(msg)
+            if len(recorded) == 10:
+                break
+    datagrams = [msg for msg in recorded if msg.mtype == MsgTypes.Datagram]
+
+    replayed = []
+    for idnum in range(num_workers):
+        replay = Source.find_source('replay')(idnum, num_workers, 2, {'file': path, 'timing': 'fast'})
+        assert replay.types['cspad'] == at.Array2d
+        replay.request({'cspad', 'delta_t', 'timestamp'})
+        msgs = list(replay.events())
+        # every worker replays all of the transitions and heartbeats
+        assert [msg.mtype for msg in msgs if msg.mtype != MsgTypes.Datagram] == \
+            [msg.mtype for msg in recorded if msg.mtype != MsgTypes.Datagram]
+        assert all(msg.identity == idnum for msg in msgs)
+        replayed.extend(msg for msg in msgs if msg.mtype == MsgTypes.Datagram)
+
+    # the datagrams are split between the workers
+    replayed.sort(key=lambda msg: msg.timestamp)
+    assert len(replayed) == len(datagrams)
+    for orig, msg in zip(datagrams, replayed):
+        assert msg.timestamp == orig.timestamp
+        assert set(msg.payload) == {'cspad', 'delta_t', 'timestamp'}
+        assert msg.payload['delta_t'] == orig.payload['delta_t']
+        # arrays are read-only views of the recording
+        assert not msg.payload['cspad'].flags.writeable
+        np.testing.assert_array_equal(msg.payload['cspad'], orig.payload['cspad'])
+
+
+def test_source_selection(sim_src_cfg):
+    source = Source.find_source('static')(0, 1, 10, sim_src_cfg)
+    source.request({'cspad[10:20,0:5]', 'acq[:100]', 'missing[0:1]', 'delta_t'})
+
+    # only names of available data can be selected
+    assert set(source.requested_selections) == {'cspad[10:20,0:5]', 'acq[:100]'}
+
+    for msg in source.events():
+        if msg.mtype == MsgTypes.Datagram:
+            # the data is cropped by the source and the full data is dropped
+            assert set(msg.payload) == {'cspad[10:20,0:5]', 'acq[:100]', 'delta_t'}
+            assert msg.payload['cspad[10:20,0:5]'].shape == (10, 5)
+            assert msg.payload['acq[:100]'].shape == (100,)
+
+
+def test_rate_limiter():
+    rate = 1000
+    limiter = RateLimiter(rate, burst=10)
+
+    start = time.monotonic()
+    for _ in range(200):
+        limiter.wait()
+    elapsed = time.monotonic() - start
+
+    # the first burst of events is not paced
+    assert elapsed >= (200 - 10) / rate
+
+
 def test_source_heartbeat(sim_src_cfg):
     src_cls = Source.find_source('static')
     assert src_cls is not None
@@ -394,6 +650,88 @@ def test_source_heartbeat(sim_src_cfg):
             assert msg.payload == ((count - 1) // heartbeat_period)
 
 
+def test_prefetch_source(sim_src_cfg):
+    src_cls = Source.find_source('static')
+    assert src_cls is not None
+
+    sim_src_cfg['bound'] = 10
+
+    idnum = 0
+    num_workers = 1
+    heartbeat_period = 3
+
+    source = src_cls(idnum, num_workers, heartbeat_period, sim_src_cfg)
+    source.request(['cspad', 'delta_t', 'timestamp'])
+    expected = list(source.events())
+
+    source = src_cls(idnum, num_workers, heartbeat_period, sim_src_cfg)
+    source.request(['cspad', 'delta_t', 'timestamp'])
+    prefetcher = Prefetcher(source, 2)
+
+    # check that the prefetched messages match the ones from the source
+    count = 0
+    for msg, expected_msg in zip(prefetcher.events(), expected):
+        assert msg.mtype == expected_msg.mtype
+        if msg.mtype == MsgTypes.Datagram:
+            assert msg.payload['timestamp'] == expected_msg.payload['timestamp']
+            assert prefetcher.heartbeat == msg.payload['timestamp'] // heartbeat_period
+            count += 1
+        assert prefetcher.qsize <= 2
+    assert count == sim_src_cfg['bound']
+
+    # check that prefetching can be cancelled part of the way through
+    sim_src_cfg['bound'] = np.inf
+    source = src_cls(idnum, num_workers, heartbeat_period, sim_src_cfg)
+    prefetcher = Prefetcher(source, 2)
+    for count, msg in enumerate(prefetcher.events()):
+        if count > 5:
+            break
+    prefetcher.cancel()
+    assert prefetcher.thread is None
+    assert prefetcher.qsize == 0
+
+
+def test_prefetch_request(sim_src_cfg):
+    src_cls = Source.find_source('static')
+    sim_src_cfg['bound'] = np.inf
+    depth = 2
+
+    source = src_cls(0, 1, 3, sim_src_cfg)
+    source.request(['cspad'])
+    requests = []
+    request = source.request
+
+    def record(names):
+        requests.append(threading.current_thread().name)
+        request(names)
+
+    source.request = record
+    prefetcher = Prefetcher(source, depth)
+
+    names = []
+    for msg in prefetcher.events():
+        if msg.mtype == MsgTypes.Datagram:
+            names.append(set(msg.payload))
+            if len(names) == 3:
+                prefetcher.request(['delta_t'])
+            elif len(names) > 3 + depth + 1:
+                break
+    prefetcher.cancel()
+
+    # the request is applied by the prefetch thread before it reads the next event
+    assert set(requests) == {'prefetch'}
+    assert names[:3] == [{'cspad'}] * 3
+    switch = names.index({'delta_t'})
+    assert switch <= 3 + depth + 1
+    assert names[3:switch] == [{'cspad'}] * (switch - 3)
+    assert names[switch:] == [{'delta_t'}] * (len(names) - switch)
+
+    # without the prefetch thread the request goes straight to the source
+    prefetcher.request(['cspad'])
+    assert requests[-1] == threading.current_thread().name
+    assert source.requested_names == {'cspad'}
+
+
 def test_source_request(sim_src_cfg):
     src_cls = Source.find_source('static')
     assert src_cls is not None
@@ -1,3 +1,4 @@
+import time
 import pytest
 import zmq
 import dill
@@ -5,7 +6,7 @@ import dill
 from ami.data import MsgTypes, Transitions, Message, CollectorMessage, Deserializer, Heartbeat
 from ami.comm import Colors, ContributionBuilder, TransitionBuilder, EventBuilder
 from ami.graphkit_wrapper import Graph
-from ami.graph_nodes import PickN
+from ami.graph_nodes import PickN, Accumulator
 
 
 class FakeBuilder(ContributionBuilder):
@@ -332,3 +333,179 @@ def test_pending_graph(event_builder, eb_graph):
         for nv in range(ver+1, graph_versions):
             assert nv in event_builder.pending_graphs(graph_name)
             assert event_builder.version(graph_name) == ver
+
+
+@pytest.mark.parametrize('event_builder', [(2, 3)], indirect=True)
+def test_eb_out_of_order(event_builder):
+    sock = event_builder.ctx.socket(zmq.PULL)
+    sock.bind("inproc://eb_test")
+    deserializer = Deserializer()
+
+    name = 'test'
+    depth = event_builder.depth
+    event_builder.create(name)
+
+    pending = set()
+    for hb in [5, 2, 7, 1, 9, 3, 8, 4, 6, 10]:
+        event_builder.update(name, Heartbeat(hb, 0), 0, 0, {})
+        event_builder.prune(name, 0)
+        pending.add(hb)
+        pruned = sorted(pending)[:-depth]
+        pending.difference_update(pruned)
+        # check that the oldest heartbeats are pruned first
+        for expected in pruned:
+            msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+            assert msg.heartbeat == expected
+        assert set(event_builder.pending(name)) == pending
+
+    # complete a heartbeat which is not the oldest one
+    newest = max(pending)
+    event_builder.update(name, Heartbeat(newest, 0), 1, 0, {})
+    assert event_builder.ready(name, newest)
+    event_builder.complete(name, newest, 0)
+    assert sock.recv_serialized(deserializer, zmq.NOBLOCK).heartbeat == newest
+    pending.remove(newest)
+
+    # flushing completes the remaining heartbeats in order
+    event_builder.flush(0)
+    for expected in sorted(pending):
+        assert sock.recv_serialized(deserializer, zmq.NOBLOCK).heartbeat == expected
+    assert not event_builder.pending(name)
+    assert not event_builder.builders[name].order
+
+
+@pytest.mark.parametrize('event_builder', [(3, 5)], indirect=True)
+def test_eb_deadline(event_builder):
+    sock = event_builder.ctx.socket(zmq.PULL)
+    sock.bind("inproc://eb_test")
+    deserializer = Deserializer()
+
+    name = 'test'
+    event_builder.deadline = 1.0
+    event_builder.create(name)
+
+    # heartbeat 2 is missing one worker and heartbeat 1 is missing two workers
+    # including the ones reported missing by a contributor
+    event_builder.update(name, Heartbeat(2, 0), 0, 0, {})
+    event_builder.update(name, Heartbeat(2, 0), 1, 0, {})
+    event_builder.update(name, Heartbeat(1, 0), 0, 0, {}, missing=1)
+    event_builder.update(name, Heartbeat(1, 0), 2, 0, {})
+
+    # nothing is completed before the deadline
+    assert event_builder.expire(name, 0) == ([], 0)
+    assert set(event_builder.pending(name)) == {1, 2}
+
+    _, size = event_builder.expire(name, 0, now=time.monotonic() + 2.0)
+    assert size > 0
+    assert not event_builder.pending(name)
+    for heartbeat, missing in [(1, 2), (2, 1)]:
+        msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+        assert msg.heartbeat == heartbeat
+        assert msg.missing == missing
+
+    # late contributions to the expired heartbeats are dropped
+    event_builder.update(name, Heartbeat(2, 0), 2, 0, {})
+    event_builder.update(name, Heartbeat(1, 0), 1, 0, {})
+    assert not event_builder.pending(name)
+    assert not event_builder.contribs(name)
+
+    # complete heartbeats do not report missing workers
+    for i in range(event_builder.num_contribs):
+        event_builder.update(name, Heartbeat(3, 0), i, 0, {})
+    assert event_builder.ready(name, Heartbeat(3, 0))
+    event_builder.complete(name, Heartbeat(3, 0), 0)
+    msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+    assert msg.heartbeat == 3
+    assert msg.missing == 0
+
+
+@pytest.mark.parametrize('event_builder', [(3, 5)], indirect=True)
+def test_eb_skipped(event_builder):
+    sock = event_builder.ctx.socket(zmq.PULL)
+    sock.bind("inproc://eb_test")
+    deserializer = Deserializer()
+
+    name = 'test'
+    event_builder.deadline = 1.0
+    event_builder.create(name)
+
+    # the skipped fraction is averaged over the contributions received
+    event_builder.update(name, Heartbeat(1, 0), 0, 0, {}, skipped=0.5)
+    event_builder.update(name, Heartbeat(1, 0), 1, 0, {})
+    event_builder.update(name, Heartbeat(1, 0), 2, 0, {}, skipped=0.25)
+    event_builder.update(name, Heartbeat(2, 0), 0, 0, {}, skipped=0.5)
+
+    event_builder.complete(name, Heartbeat(1, 0), 0)
+    msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+    assert msg.heartbeat == 1
+    assert msg.skipped == 0.25
+
+    event_builder.expire(name, 0, now=time.monotonic() + 2.0)
+    msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+    assert msg.heartbeat == 2
+    assert msg.skipped == 0.5
+    assert msg.missing == 2
+    assert not event_builder.builders[name].skipped
+
+
+@pytest.mark.parametrize('event_builder', [(2, 5)], indirect=True)
+def test_eb_streaming(event_builder, eb_graph):
+    sock = event_builder.ctx.socket(zmq.PULL)
+    sock.bind("inproc://eb_test")
+    deserializer = Deserializer()
+
+    name = 'test'
+    graph = Graph(name='graph')
+    graph.add(Accumulator(name='Total', inputs=['value'], outputs=['total'], reduction=lambda r, v: r + v))
+    graph_args = {'num_workers': event_builder.num_contribs, 'num_local_collectors': 1}
+    event_builder.set_graph(name, 0, graph_args, graph)
+    builder = event_builder.builders[name]
+    value = 'total_%s' % Colors.Worker
+    output = 'total_%s' % Colors.LocalCollector
+
+    # the first contribution to a heartbeat arrives before any to the previous one
+    event_builder.update(name, Heartbeat(6, 0), 1, 0, {value: 60})
+    event_builder.update(name, Heartbeat(5, 0), 0, 0, {value: 50})
+    event_builder.prune(name, 0)
+    event_builder.update(name, Heartbeat(6, 0), 0, 0, {value: 61})
+    event_builder.prune(name, 0)
+
+    # each heartbeat is reduced with its own state as its contributions arrive
+    assert not builder.buffered
+    assert event_builder.pending(name)[5].get(output) == 50
+    assert event_builder.pending(name)[6].get(output) == 121
+    assert event_builder.ready(name, 6)
+    assert not event_builder.ready(name, 5)
+
+    # nothing is sent until the oldest heartbeat is complete
+    with pytest.raises(zmq.Again):
+        sock.recv_serialized(deserializer, zmq.NOBLOCK)
+
+    event_builder.update(name, Heartbeat(5, 0), 1, 0, {value: 51})
+    assert event_builder.ready(name, 5)
+    event_builder.prune(name, 0, Heartbeat(5, 0))
+    event_builder.complete(name, Heartbeat(5, 0), 0)
+    event_builder.prune(name, 0, Heartbeat(6, 0))
+    event_builder.complete(name, Heartbeat(6, 0), 0)
+    for heartbeat, total in [(5, 101), (6, 121)]:
+        msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+        assert msg.heartbeat == heartbeat
+        assert msg.payload.get(output) == total
+    with pytest.raises(zmq.Again):
+        sock.recv_serialized(deserializer, zmq.NOBLOCK)
+    assert builder.active is None
+    assert not builder.states
+
+    # the state of the PickN carries over between heartbeats, so the contributions are buffered and
+    # reduced in order as the heartbeats are completed
+    event_builder.set_graph(name, 1, graph_args, dill.loads(eb_graph))
+    output = 'value_%s' % Colors.LocalCollector
+    event_builder.update(name, Heartbeat(8, 0), 1, 1, {'value_%s' % Colors.Worker: 2})
+    event_builder.update(name, Heartbeat(7, 0), 0, 1, {'value_%s' % Colors.Worker: 1})
+    assert set(builder.buffered) == {7, 8}
+    assert output not in event_builder.pending(name)[7]
+    event_builder.flush(0)
+    for heartbeat, picked in [(7, 1), (8, 2)]:
+        msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+        assert msg.heartbeat == heartbeat
+        assert msg.payload.get(output) == picked
@@ -1,6 +1,10 @@
+import time
 import dill
+import pytest
 import numpy as np
-from ami.graph_nodes import PickN
+from ami.graphkit_wrapper import Graph, collector_tree
+from ami.graph_nodes import Map, FilterOn, FilterOff, PickN, Accumulator
+from ami.data import LazyPayload
 
 
 def test_filter_on(complex_graph):
@@ -66,3 +70,223 @@ def test_dill(complex_graph):
     assert localCollector == {'BinningOn_reduce_count_localCollector': {3: (20000.0, 2), 8: (20000.0, 2)}}
     np.testing.assert_equal(globalCollector['BinningOn.Bins'], np.array([3, 8]))
     np.testing.assert_equal(globalCollector['BinningOn.Counts'], np.array([10000., 10000.]))
+
+
+def test_parallel(complex_graph):
+    complex_graph.compile(num_workers=4, num_local_collectors=2, num_threads=4)
+    complex_graph({'cspad': np.ones((200, 200)), 'laser': True, 'delta_t': 8}, color='worker')
+    worker = complex_graph({'cspad': np.ones((200, 200)), 'laser': True, 'delta_t': 3}, color='worker')
+    complex_graph(worker, color='localCollector')
+    localCollector = complex_graph(worker, color='localCollector')
+    globalCollector = complex_graph(localCollector, color='globalCollector')
+
+    assert worker == {'BinningOn_reduce_count_worker': {8: (10000.0, 1), 3: (10000.0, 1)}}
+    assert localCollector == {'BinningOn_reduce_count_localCollector': {8: (20000.0, 2), 3: (20000.0, 2)}}
+    np.testing.assert_equal(globalCollector['BinningOn.Bins'], np.array([3, 8]))
+    np.testing.assert_equal(globalCollector['BinningOn.Counts'], np.array([10000., 10000.]))
+    assert 'BinningOn_reduce_globalCollector' in complex_graph.times()
+
+    # check that the graph can still be serialized after using the thread pool
+    complex_graph = dill.loads(dill.dumps(complex_graph))
+    assert complex_graph.executor is None
+
+
+def test_batch(complex_graph):
+    complex_graph.compile(num_workers=4, num_local_collectors=2)
+
+    events = [
+        {'cspad': np.ones((200, 200)), 'laser': True, 'delta_t': 8},
+        {'cspad': np.ones((200, 200)), 'laser': False, 'delta_t': 5},
+        {'cspad': np.ones((200, 200)), 'laser': True, 'delta_t': 3},
+    ]
+    worker = complex_graph.batch(events, color='worker')
+
+    assert worker == {'BinningOn_reduce_count_worker': {8: (10000.0, 1), 3: (10000.0, 1)},
+                      'BinningOff_reduce_count_worker': {5: (10000.0, 1)}}
+    assert set(complex_graph.times()) == {node.name for node in complex_graph.graph.nodes
+                                          if type(node) is not str and node.color == 'worker'}
+
+
+def test_batch_aware():
+    graph = Graph(name='graph')
+    graph.add(Map(name='Double', inputs=['cspad'], outputs=['double'], func=lambda a: a*2, is_batch_aware=True))
+    graph.add(Map(name='Sum', inputs=['double'], outputs=['sum'], func=np.sum))
+    graph.add(FilterOn(name='FilterOn', condition_needs=['laser'], outputs=['laseron']))
+    graph.add(Map(name='Offset', inputs=['sum'], outputs=['offset'], condition_needs=['laseron'],
+                  func=lambda s: s + 1))
+    graph.add(Accumulator(name='Total', inputs=['offset'], outputs=['total'], reduction=lambda r, v: r + v))
+    graph.compile(num_workers=1, num_local_collectors=1)
+
+    events = [{'cspad': np.full((2, 2), i), 'laser': i % 2 == 0} for i in range(4)]
+    events.append({'cspad': None, 'laser': True})
+    worker = graph.batch(events, color='worker')
+
+    assert worker == {'total_worker': 18}
+
+
+@pytest.mark.parametrize('laser, expected', [(True, 30), (False, 20)])
+def test_parallel_merge(laser, expected):
+    def slow(v):
+        time.sleep(0.1)
+        return v * 3
+
+    graph = Graph(name='graph')
+    graph.add(FilterOn(name='LaserOn', condition_needs=['laser'], outputs=['laseron']))
+    graph.add(FilterOff(name='LaserOff', condition_needs=['laser'], outputs=['laseroff']))
+    graph.add(Map(name='A', inputs=['value'], outputs=['val'], condition_needs=['laseron'], func=slow))
+    graph.add(Map(name='B', inputs=['value'], outputs=['val'], condition_needs=['laseroff'], func=lambda v: v + 1))
+    graph.add(Map(name='C', inputs=['val'], outputs=['out'], func=lambda v: v * 10))
+    graph.add(Accumulator(name='Total', inputs=['out'], outputs=['total'], reduction=lambda r, v: r + v))
+    graph.compile(num_workers=1, num_local_collectors=1, num_threads=2)
+
+    # the node reading the merged output waits for the slow branch
+    assert graph({'laser': laser, 'value': 1}, color='worker') == {'total_worker': expected}
+
+
+@pytest.mark.parametrize('beam, expected', [(True, ['beam', 'cspad', 'scale']), (False, ['beam', 'scale'])])
+def test_lazy_load(beam, expected):
+    reads = []
+
+    def loader(name, value):
+        def read():
+            reads.append(name)
+            return value
+        return read
+
+    graph = Graph(name='graph')
+    graph.add(FilterOn(name='BeamOn', condition_needs=['beam'], outputs=['beamon']))
+    graph.add(Map(name='Sum', inputs=['cspad'], outputs=['sum'], condition_needs=['beamon'], func=np.sum))
+    graph.add(Map(name='Scale', inputs=['scale'], outputs=['scaled'], func=lambda s: s * 2))
+    graph.compile()
+
+    event = LazyPayload({'beam': loader('beam', beam),
+                         'cspad': loader('cspad', np.ones(4)),
+                         'scale': loader('scale', 1)})
+
+    # the detector data is only read when the beam filter passes
+    data = graph.load(event, 'worker')
+    assert sorted(reads) == sorted(expected)
+    assert sorted(data) == sorted(expected)
+
+
+@pytest.mark.parametrize('laser, expected', [(True, 16.0), (False, 8.0)])
+def test_lazy_load_merge(laser, expected):
+    reads = []
+
+    def loader(name, value):
+        def read():
+            reads.append(name)
+            return value
+        return read
+
+    graph = Graph(name='graph')
+    graph.add(FilterOn(name='LaserOn', condition_needs=['laser'], outputs=['laseron']))
+    graph.add(FilterOff(name='LaserOff', condition_needs=['laser'], outputs=['laseroff']))
+    graph.add(Map(name='A', inputs=['scale'], outputs=['y'], condition_needs=['laseron'], func=lambda s: s * 2))
+    graph.add(Map(name='B', inputs=['scale'], outputs=['y'], condition_needs=['laseroff'], func=lambda s: s))
+    graph.add(Map(name='C', inputs=['y', 'cspad'], outputs=['z'], func=lambda y, img: y * np.sum(img)))
+    graph.add(Accumulator(name='Total', inputs=['z'], outputs=['total'], reduction=lambda r, v: r + v))
+    graph.compile(num_workers=1, num_local_collectors=1)
+
+    event = LazyPayload({'laser': loader('laser', laser),
+                         'cspad': loader('cspad', np.ones(4)),
+                         'scale': loader('scale', 2)})
+
+    # one of the branches always produces the input of the merging node
+    assert graph(event, color='worker') == {'total_worker': expected}
+    assert sorted(reads) == ['cspad', 'laser', 'scale']
+
+
+@pytest.mark.parametrize('full', [False, True])
+def test_selection_push_down(full):
+    graph = Graph(name='graph')
+    graph.add(Map(name='Roi', inputs=['cspad'], outputs=['roi'], func=lambda img: img[0:2, 1:3],
+                  selection=(slice(0, 2), slice(1, 3))))
+    graph.add(Map(name='Sum', inputs=['roi'], outputs=['sum'], func=np.sum))
+    graph.add(Accumulator(name='Total', inputs=['sum'], outputs=['total'], reduction=lambda r, v: r + v))
+    if full:
+        graph.add(Map(name='Max', inputs=['cspad'], outputs=['max'], func=np.max))
+    graph.compile(num_workers=1, num_local_collectors=1)
+    # compiling again should not change the selection
+    graph.compile(num_workers=1, num_local_collectors=1)
+
+    # the full data is only requested if another node needs it
+    if full:
+        assert graph.sources == {'cspad', 'cspad[0:2,1:3]'}
+    else:
+        assert graph.sources == {'cspad[0:2,1:3]'}
+
+    img = np.arange(16).reshape((4, 4))
+    worker = graph({'cspad': img, 'cspad[0:2,1:3]': img[0:2, 1:3]}, color='worker')
+
+    assert worker == {'total_worker': 14}
+
+
+def test_accumulator_inplace():
+    def reduction(res, *rest):
+        # the collectors are given the results of their contributors
+        total = rest[0][0] if type(rest[0]) is list else rest[0]
+        if res[0] is None:
+            res[0] = np.array(total)
+        else:
+            np.add(res[0], total, out=res[0])
+        return res
+
+    graph = Graph(name='graph')
+    graph.add(Accumulator(name='Total', inputs=['cspad'], outputs=['total'], res_factory=lambda: [None],
+                          reduction=reduction, inplace=True))
+    graph.compile(num_workers=1, num_local_collectors=1)
+
+    img = np.ones((4, 4))
+    graph({'cspad': img}, color='worker')
+    worker = graph({'cspad': img}, color='worker')
+    buf = worker['total_worker'][0]
+    graph({'cspad': img}, color='worker')
+
+    # the events are summed into the same buffer without touching the inputs
+    assert worker['total_worker'][0] is buf
+    np.testing.assert_equal(buf, np.full((4, 4), 3))
+    np.testing.assert_equal(img, np.ones((4, 4)))
+
+    # the buffer sent at the end of the heartbeat is not reused by the next one
+    graph.heartbeat_finished()
+    worker = graph({'cspad': img}, color='worker')
+    assert worker['total_worker'][0] is not buf
+    np.testing.assert_equal(buf, np.full((4, 4), 3))
+
+    globalCollector = graph({'total_localCollector': [buf]}, color='globalCollector')
+    sent = globalCollector['total'][0]
+    graph.heartbeat_finished()
+    globalCollector = graph({'total_localCollector': [buf]}, color='globalCollector')
+    np.testing.assert_equal(sent, np.full((4, 4), 3))
+    np.testing.assert_equal(globalCollector['total'][0], np.full((4, 4), 6))
+
+
+def test_collector_tree():
+    assert collector_tree(8, 2) == [('worker', 8), ('localCollector', 2), ('globalCollector', 1)]
+    assert collector_tree(64, 10, [4, 2]) == [('worker', 64), ('localCollector', 10), ('intermediateCollector1', 3),
+                                              ('intermediateCollector2', 2), ('globalCollector', 1)]
+    with pytest.raises(ValueError):
+        collector_tree(8, 2, [0])
+
+
+def test_expand_intermediate():
+    graph = Graph(name='graph')
+    graph.add(Accumulator(name='Total', inputs=['cspad'], outputs=['total'], reduction=lambda r, v: r + v))
+    graph.compile(num_workers=8, num_local_collectors=4, fan_in=[2])
+
+    # the internally generated names of the intermediate collectors are not user-defined names
+    assert graph.names == {'cspad', 'total'}
+    assert not graph.name_is_valid('total_intermediateCollector1')
+    assert graph.inputs['intermediateCollector1'] == {'total_localCollector'}
+    assert graph.outputs['intermediateCollector1'] == {'total_intermediateCollector1'}
+    assert graph.inputs['globalCollector'] == {'total_intermediateCollector1'}
+
+    worker = graph({'cspad': 1}, color='worker')
+    localCollector = graph(worker, color='localCollector')
+    intermediateCollector = graph(localCollector, color='intermediateCollector1')
+    globalCollector = graph(intermediateCollector, color='globalCollector')
+
+    assert worker == {'total_worker': 1}
+    assert intermediateCollector == {'total_intermediateCollector1': 1}
+    assert globalCollector == {'total': 1}
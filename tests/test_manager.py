@@ -118,8 +118,9 @@ class ResultsInjector(Node, ZmqHandler):
         else:
             return self.mark
 
-    def data(self, hb, payload, wait=False):
-        self.collector_message(self.node, Heartbeat(hb, 0), self.name, self.version, payload)
+    def data(self, hb, payload, wait=False, missing=0, skipped=0.0):
+        self.collector_message(self.node, Heartbeat(hb, 0), self.name, self.version, payload,
+                               skipped=skipped, missing=missing)
         if wait:
             self.wait_for(hb)
         else:
@@ -643,10 +644,12 @@ def test_manager_store(manager_ctrl, result_data):
 
     # inject data into the manager
     injector.version = 1
-    injector.data(hb, result_data, wait=True)
+    injector.data(hb, result_data, wait=True, missing=2, skipped=0.25)
 
     # test the data returned by features
     assert comm.heartbeat == hb
+    assert comm.missing == 2
+    assert comm.skipped == 0.25
     assert comm.featuresVersion == injector.version
     features = comm.features
     assert features
@@ -33,6 +33,31 @@ def test_pickn(pickN_graph):
     assert globalCollector == {'ncspads': [1, 2, 3, 4, 1, 2, 3, 4]}
 
 
+def test_pickn_intermediate():
+    graph = Graph(name='graph')
+    graph.add(PickN(name='cspad_pickN', N=8,
+                    inputs=['cspad'],
+                    outputs=['ncspads']))
+    graph.compile(num_workers=4, num_local_collectors=2, fan_in=[2])
+
+    graph({'cspad': 1}, color='worker')
+    worker1 = graph({'cspad': 2}, color='worker')
+    graph({'cspad': 3}, color='worker')
+    worker2 = graph({'cspad': 4}, color='worker')
+
+    graph(worker1, color='localCollector')
+    localCollector1 = graph(worker2, color='localCollector')
+
+    graph(localCollector1, color='intermediateCollector1')
+    intermediateCollector1 = graph(localCollector1, color='intermediateCollector1')
+
+    globalCollector = graph(intermediateCollector1, color='globalCollector')
+
+    assert localCollector1 == {'ncspads_localCollector': [1, 2, 3, 4]}
+    assert intermediateCollector1 == {'ncspads_intermediateCollector1': [1, 2, 3, 4, 1, 2, 3, 4]}
+    assert globalCollector == {'ncspads': [1, 2, 3, 4, 1, 2, 3, 4]}
+
+
 @pytest.fixture(scope='function')
 def pickMultiple_graph():
     graph = Graph(name='graph')
@@ -1,7 +1,11 @@
+import zmq
 import pytest
 import numpy as np
+import amitypes as at
 from conftest import pyarrowtest
-from ami.data import MsgTypes, CollectorMessage, Serializer, Deserializer
+import ami.data
+from ami.data import MsgTypes, Message, CollectorMessage, Transition, Transitions, Heartbeat, Serializer, \
+    Deserializer, Compressor, parse_compression
 
 
 @pytest.fixture(scope='module')
@@ -16,7 +20,7 @@ def collector_msg():
 
 
 @pytest.mark.parametrize("serializer",
-                         [None, pytest.param('arrow', marks=pyarrowtest), 'dill', 'pickle'],
+                         [None, pytest.param('arrow', marks=pyarrowtest), 'dill', 'pickle', 'pickle5'],
                          indirect=True)
 @pytest.mark.parametrize("obj", [5, "test", np.arange(10)])
 def test_default_serializer(serializer, obj):
@@ -28,8 +32,174 @@ def test_default_serializer(serializer, obj):
 
 
 @pytest.mark.parametrize("serializer",
-                         [None, pytest.param('arrow', marks=pyarrowtest), 'dill', 'pickle'],
+                         [None, pytest.param('arrow', marks=pyarrowtest), 'dill', 'pickle', 'pickle5'],
                          indirect=True)
 def test_default_serializer_message(serializer, collector_msg):
     serializer, deserializer = serializer
     assert deserializer(serializer(collector_msg)) == collector_msg
+
+
+@pytest.mark.parametrize("serializer", ['pickle5'], indirect=True)
+@pytest.mark.parametrize("msg", [
+    Message(MsgTypes.Transition, 1, Transition(Transitions.Configure, {'cspad': at.dumps(at.Array2d)})),
+    Message(MsgTypes.Heartbeat, 2, Heartbeat(7, 1.5)),
+    CollectorMessage(mtype=MsgTypes.Datagram, identity=3, heartbeat=Heartbeat(7, 1.5), name="fake", version=1,
+                     payload={'cspad': np.arange(16384.).reshape((128, 128)),
+                              'group': at.Group('camera', 'hdf5', 'Group', {'image': np.ones((128, 128))}),
+                              'small': np.ones((2, 2)),
+                              'source': at.DataSource({'type': 'hdf5'}, key=2)}),
+])
+def test_pickle5_zero_copy(serializer, msg):
+    serializer, deserializer = serializer
+
+    ctx = zmq.Context()
+    push = ctx.socket(zmq.PUSH)
+    pull = ctx.socket(zmq.PULL)
+    pull.bind('inproc://pickle5')
+    push.connect('inproc://pickle5')
+    try:
+        frames = serializer(msg)
+        push.send_multipart(frames, copy=False)
+        result = pull.recv_serialized(deserializer, copy=False)
+    finally:
+        push.close()
+        pull.close()
+        ctx.term()
+
+    assert type(result) is type(msg)
+    assert result.mtype == msg.mtype
+    assert result.identity == msg.identity
+    if msg.mtype == MsgTypes.Datagram:
+        # each large contiguous array buffer is sent as its own frame
+        assert len(frames) == 3
+        np.testing.assert_array_equal(result.payload['small'], msg.payload['small'])
+        assert result.heartbeat == msg.heartbeat
+        np.testing.assert_array_equal(result.payload['cspad'], msg.payload['cspad'])
+        # the arrays are views of the received frames
+        assert not result.payload['cspad'].flags.owndata
+        np.testing.assert_array_equal(result.payload['group']['image'], msg.payload['group']['image'])
+        assert result.payload['source'] == msg.payload['source']
+    else:
+        assert len(frames) == 1
+        assert result == msg
+
+
+@pytest.mark.parametrize("serializer", ['pickle5'], indirect=True)
+def test_pickle5_fallback(serializer):
+    serializer, deserializer = serializer
+
+    msg = Message(MsgTypes.Datagram, 0, {'func': lambda x: x + 1, 'value': np.arange(4)})
+    result = deserializer(serializer(msg))
+
+    assert result.payload['func'](1) == 2
+    np.testing.assert_array_equal(result.payload['value'], msg.payload['value'])
+
+
+@pytest.mark.parametrize("msg", [
+    Message(MsgTypes.Datagram, 0, {'cspad': np.ones((4, 4))}),
+    Message(MsgTypes.Transition, 0, Transition(Transitions.Configure, {'cspad': np.ones((4, 4))})),
+    CollectorMessage(mtype=MsgTypes.Datagram, identity=0, heartbeat=Heartbeat(1, 1.0), name="fake", version=1,
+                     payload={'cspad': np.ones((4, 4))}),
+])
+def test_shallow_serialize(msg):
+    data = msg._serialize()
+
+    # the payload is passed on without being copied
+    assert data['payload'] is msg.payload
+    if isinstance(msg.payload, Transition):
+        assert msg.payload._serialize()['payload'] is msg.payload.payload
+    assert type(msg)._deserialize(dict(data)) == msg
+
+
+@pytest.mark.parametrize("codec", [
+    'zlib',
+    'lzma',
+    pytest.param('lz4', marks=pytest.mark.skipif(ami.data.lz4 is None, reason="requires lz4")),
+    pytest.param('zstd', marks=pytest.mark.skipif(ami.data.zstandard is None, reason="requires zstandard")),
+])
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_pickle5_compression(codec, shuffle):
+    compressor = Compressor(codec, shuffle=shuffle)
+    serializer = Serializer('pickle5', compressor)
+    deserializer = Deserializer('pickle5')
+
+    msg = CollectorMessage(mtype=MsgTypes.Datagram, identity=3, heartbeat=Heartbeat(7, 1.5), name="fake", version=1,
+                           payload={'sum': np.arange(65536.).reshape((256, 256)),
+                                    'hist': np.ones(65536, dtype=np.int32),
+                                    'noise': np.frombuffer(np.random.bytes(131072), dtype=np.uint8),
+                                    'small': np.ones((2, 2))})
+    frames = serializer(msg)
+    result = deserializer(frames)
+
+    # a header frame is added in front of the pickled data and the three large buffers
+    assert len(frames) == 5
+    assert serializer.sizeof(frames) < Serializer('pickle5').sizeof(Serializer('pickle5')(msg))
+    for name in msg.payload:
+        np.testing.assert_array_equal(result.payload[name], msg.payload[name])
+        assert result.payload[name].dtype == msg.payload[name].dtype
+    # the decompressed arrays are writable like uncompressed ones
+    assert result.payload['sum'].flags.writeable
+
+    ratio, elapsed = compressor.stats()
+    assert ratio > 1
+    assert elapsed > 0
+    assert compressor.stats() is None
+
+
+def test_default_compression(monkeypatch):
+    # compression selects the pickle5 protocol even when arrow is the default one
+    monkeypatch.setitem(ami.data.SerializationProtocols, None, ami.data.SerializationProtocols['arrow'])
+    serializer = Serializer(None, Compressor('zlib'))
+    assert isinstance(serializer, ami.data.Pickle5Serializer)
+
+    msg = Message(MsgTypes.Datagram, 0, {'sum': np.zeros(65536)})
+    frames = serializer(msg)
+    assert Compressor.compressed(frames)
+    np.testing.assert_array_equal(Deserializer('pickle5')(frames).payload['sum'], msg.payload['sum'])
+
+
+@pyarrowtest
+def test_arrow_reads_pickle5():
+    # the arrow deserializer also reads the messages of links with compression
+    serializer = Serializer('pickle5', Compressor('zlib'))
+    deserializer = Deserializer('arrow')
+
+    for msg in [Message(MsgTypes.Heartbeat, 2, Heartbeat(7, 1.5)),
+                Message(MsgTypes.Datagram, 0, {'sum': np.zeros(65536)})]:
+        result = deserializer(serializer(msg))
+        assert result.mtype == msg.mtype
+        assert result.identity == msg.identity
+    np.testing.assert_array_equal(result.payload['sum'], msg.payload['sum'])
+
+    msg = Message(MsgTypes.Datagram, 0, {'sum': np.zeros(65536)})
+    result = deserializer(Serializer('arrow')(msg))
+    np.testing.assert_array_equal(result.payload['sum'], msg.payload['sum'])
+
+
+def test_pickle5_compression_skipped():
+    serializer = Serializer('pickle5', Compressor('zlib'))
+    deserializer = Deserializer('pickle5')
+
+    # messages without any large compressible frames are sent as is
+    for msg in [Message(MsgTypes.Heartbeat, 2, Heartbeat(7, 1.5)),
+                Message(MsgTypes.Datagram, 0, {'noise': np.frombuffer(np.random.bytes(131072), dtype=np.uint8)})]:
+        frames = serializer(msg)
+        assert not Compressor.compressed(frames)
+        assert type(frames[0]) is bytes
+        result = deserializer(frames)
+        assert result.mtype == msg.mtype
+        assert type(result.payload) is type(msg.payload)
+
+
+def test_parse_compression():
+    assert parse_compression(None) is None
+    compressor = parse_compression('zlib:6')
+    assert compressor.codec.level == 6
+    assert parse_compression('lzma').codec.level == 0
+
+    with pytest.raises(ValueError):
+        parse_compression('zlib:fast')
+    with pytest.raises(ValueError):
+        parse_compression('gzip')
+    with pytest.raises(NotImplementedError):
+        Serializer('pickle', compressor)
@@ -1,9 +1,11 @@
+import os
+import gc
 import pytest
 import zmq
 import numpy as np
 
-from ami.data import MsgTypes, Datagram, CollectorMessage, Deserializer
-from ami.comm import Store, ResultStore
+from ami.data import MsgTypes, Datagram, CollectorMessage, Serializer, Deserializer, SharedArray
+from ami.comm import Store, ResultStore, Profile, SharedMemoryRing, SharedMemoryMapper
 
 
 @pytest.fixture(scope='function')
@@ -328,3 +330,68 @@ def test_store_addremove(obj, expected, store):
     # check that the remove worked
     assert name not in store
     assert not store
+
+
+@pytest.mark.parametrize('sample, expected', [(1, 4), (2, 2), (3, 2)])
+def test_profile(sample, expected):
+    profile = Profile(sample, edges=[0.1, 1.0])
+
+    # nothing has been timed yet
+    assert not profile
+    assert profile.collect() is None
+
+    for i in range(4):
+        if profile.sampling():
+            profile.update(i, i + 0.5, {'node': 0.05, 'other': 2.0})
+
+    data = profile.collect()
+    assert data['events'] == 4
+    assert data['sampled'] == expected
+    assert data['total'] == [0, expected, 0]
+    assert data['nodes'] == {'node': [expected, 0, 0], 'other': [0, 0, expected]}
+    assert data['sums']['node'] == pytest.approx(0.05 * expected)
+
+    # the histograms are reset after being collected
+    assert not profile
+    assert profile.collect() is None
+
+
+@pytest.mark.parametrize('protocol', ['pickle', 'dill'])
+def test_shared_memory_ring(protocol):
+    ring = SharedMemoryRing('ami_test_%d' % os.getpid(), 4 * 1024, threshold=1024)
+    mapper = SharedMemoryMapper()
+    try:
+        image = np.arange(256, dtype=np.float64)
+        payload = ring.export({'image': image, 'small': np.zeros(4), 'picks': [image, 5]})
+        assert isinstance(payload['image'], SharedArray)
+        assert isinstance(payload['picks'][0], SharedArray)
+        assert isinstance(payload['small'], np.ndarray)
+
+        # the ring is full so the array is sent inline
+        assert isinstance(ring.put(image), np.ndarray)
+
+        # only the descriptors are serialized
+        serializer = Serializer(protocol)
+        deserializer = Deserializer(protocol)
+        msg = CollectorMessage(mtype=MsgTypes.Datagram, identity=0, payload=payload)
+        payload = deserializer(serializer(msg)).payload
+        assert isinstance(payload['image'], SharedArray)
+
+        mapped = mapper.map(payload)
+        np.testing.assert_array_equal(mapped['image'], image)
+        np.testing.assert_array_equal(mapped['picks'][0], image)
+        assert mapped['picks'][1] == 5
+
+        # views of the mapped arrays keep the allocations alive
+        view = mapped['image'][:10]
+        del mapped
+        gc.collect()
+        assert ring.released[0] == 0
+        assert isinstance(ring.put(image), np.ndarray)
+        del view
+        gc.collect()
+        # both allocations are released once all the views are gone
+        assert ring.released[0] == 2
+        assert isinstance(ring.put(image), SharedArray)
+    finally:
+        ring.close()
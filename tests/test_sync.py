@@ -110,3 +110,78 @@ def test_badrequests(sync_proc):
     # check the returned timestamp
     assert isinstance(ts, int)
     assert ts == expected
+
+
+@pytest.mark.parametrize('sync_proc', [1, 3, (2, 45)], indirect=True)
+def test_leases(sync_proc):
+    syncs, start = sync_proc
+    nclients = len(syncs)
+    period = 12
+
+    expected = start
+    for i in range(4):
+        for c, sync in enumerate(syncs):
+            sync.send_string('lease 1000 %d' % period)
+            first, count = sync.recv_pyobj()
+
+            # check the returned lease
+            assert isinstance(first, int)
+            assert first == expected
+            assert count > 0
+            # leases never cross heartbeat boundaries
+            assert first // period == (first + count - 1) // period
+            # once all the clients have leased the heartbeat is shared between them
+            if i > 0:
+                assert count <= period // nclients
+            expected += count
+
+    # single timestamps are handed out after the leased blocks
+    syncs[0].send_string('ts')
+    assert syncs[0].recv_pyobj() == expected
+
+
+@pytest.mark.parametrize('sync_proc', [1], indirect=True)
+def test_bad_leases(sync_proc):
+    syncs, expected = sync_proc
+    sync = syncs[0]
+
+    for request in ['lease', 'lease 10', 'lease 10 0', 'lease a 10']:
+        sync.send_string(request)
+        assert sync.recv_pyobj() is None
+
+    # check that the bad requests did not use any timestamps
+    sync.send_string('lease 5 10')
+    assert sync.recv_pyobj() == (expected, 5)
+
+
+@pytest.mark.parametrize('sync_proc', [2, (2, 45)], indirect=True)
+def test_leases_unequal_rates(sync_proc):
+    syncs, start = sync_proc
+    fast, slow = syncs
+    period = 12
+    share = period // len(syncs)
+
+    # the syncer shares the heartbeats between the clients once they have all leased
+    timestamps = {}
+    for sync in syncs:
+        sync.send_string('lease 1 %d' % period)
+        first, count = sync.recv_pyobj()
+        timestamps[sync] = [first]
+
+    for i in range(4):
+        # the fast client leases three times for every lease of the slow one
+        for sync in [fast, fast, fast, slow]:
+            sync.send_string('lease 1000 %d' % period)
+            first, count = sync.recv_pyobj()
+            assert first // period == (first + count - 1) // period
+            timestamps[sync].extend(range(first, first + count))
+
+        # the slow client always gets its full share
+        assert count == share
+
+    # no timestamp is handed out twice and each client gets at most its share of each heartbeat
+    assert not set(timestamps[fast]) & set(timestamps[slow])
+    for values in timestamps.values():
+        assert values == sorted(values)
+        heartbeats = [ts // period for ts in values]
+        assert max(heartbeats.count(hb) for hb in set(heartbeats)) <= share
@@ -0,0 +1,177 @@
+import time
+import threading
+import zmq
+import pytest
+
+from ami.data import LazyPayload
+from ami.graphkit_wrapper import Graph
+from ami.graph_nodes import Map, FilterOn, PickN
+from ami.worker import GraphScheduler, Prescaler, Worker
+
+
+class RequestSource:
+
+    def __init__(self):
+        self.requests = set()
+
+    def request(self, names):
+        self.requests = set(names)
+
+
+def run_heartbeat(prescaler, num_events, cost):
+    executed = sum(not prescaler.skip() for _ in range(num_events))
+    return executed, prescaler.update(executed * cost)
+
+
+@pytest.mark.parametrize('budget, cost, expected',
+                         [
+                            (1.0, 0.001, 100),  # within the budget
+                            (0.05, 0.001, 50),  # twice over the budget
+                            (0.01, 0.001, 10),  # ten times over the budget
+                            (1e-6, 0.001, 1),   # always execute one event
+                         ])
+def test_prescaler(budget, cost, expected):
+    prescaler = Prescaler(budget)
+
+    # the first heartbeat executes everything to measure the cost
+    executed, skipped = run_heartbeat(prescaler, 100, cost)
+    assert executed == 100
+    assert skipped == 0.0
+
+    for _ in range(3):
+        executed, skipped = run_heartbeat(prescaler, 100, cost)
+        assert executed == expected
+        assert skipped == pytest.approx(1 - expected / 100)
+
+    # the graphs are cheap again so the prescaler should recover
+    for _ in range(20):
+        executed, skipped = run_heartbeat(prescaler, 100, cost * budget / 100)
+    assert executed == 100
+    assert skipped == 0.0
+
+
+def test_graph_scheduler():
+    scheduler = GraphScheduler(2)
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+    running = set()
+
+    def work(name, index):
+        # the work for the same graph should never overlap
+        assert name not in running
+        running.add(name)
+        if index == 0:
+            # the first work for both graphs has to run at the same time to pass
+            barrier.wait()
+        time.sleep(0.01)
+        order.append((name, index))
+        running.discard(name)
+        return index
+
+    futures = {name: [scheduler.submit(name, work, name, i) for i in range(4)] for name in ['a', 'b']}
+    try:
+        for name, graph_futures in futures.items():
+            assert [future.result(timeout=5) for future in graph_futures] == list(range(4))
+    finally:
+        scheduler.shutdown()
+
+    # the work for each graph ran in the order it was submitted
+    for name in futures:
+        assert [index for graph, index in order if graph == name] == list(range(4))
+
+
+@pytest.fixture(scope='function')
+def worker():
+    ctx = zmq.Context()
+    collector = ctx.socket(zmq.PULL)
+    collector_port = collector.bind_to_random_port('tcp://127.0.0.1')
+    msgs = ctx.socket(zmq.PULL)
+    msg_port = msgs.bind_to_random_port('tcp://127.0.0.1')
+
+    with Worker(0, RequestSource(), 'tcp://127.0.0.1:%d' % collector_port, 'inproc://graph',
+                'tcp://127.0.0.1:%d' % msg_port, None, None, None, graph_threads=2) as worker:
+        worker.event_rate = {}
+        yield worker, msgs
+        worker.graph_comm.close()
+
+    collector.close(linger=0)
+    msgs.close(linger=0)
+    ctx.destroy()
+
+
+def add_graph(worker, name, graph):
+    graph.compile(num_workers=1, num_local_collectors=1)
+    worker.graphs[name] = graph
+    worker.store.configure(name, 0)
+    worker.update_requests()
+
+
+def test_worker_graph_failure(worker):
+    worker, msgs = worker
+    reads = []
+
+    def loader(name, value):
+        def read():
+            reads.append((name, value))
+            return value
+        return read
+
+    def check(value):
+        if value > 1:
+            raise ValueError("bad value: %d" % value)
+        return value
+
+    good = Graph(name='good')
+    good.add(FilterOn(name='Positive', condition_needs=['value'], outputs=['positive'],
+                      condition=lambda v: v > 0))
+    good.add(Map(name='Scale', inputs=['cspad'], outputs=['scaled'], condition_needs=['positive'],
+                 func=lambda img: img * 2))
+    good.add(PickN(name='Pick', inputs=['scaled'], outputs=['picked'], N=3))
+    add_graph(worker, 'good', good)
+
+    bad = Graph(name='bad')
+    bad.add(Map(name='Check', inputs=['value'], outputs=['checked'], func=check))
+    bad.add(PickN(name='Pick', inputs=['checked'], outputs=['picked'], N=4))
+    add_graph(worker, 'bad', bad)
+
+    assert worker.src.requests == {'value', 'cspad'}
+
+    for value in range(4):
+        worker.batch.append(LazyPayload({'value': loader('value', value), 'cspad': loader('cspad', value * 10)}))
+        worker.execute()
+        # the events are read before the graphs are handed to the scheduler
+        assert ('value', value) in reads
+        assert (('cspad', value * 10) in reads) == (value > 0)
+    worker.drain(wait=True)
+
+    # the failed graph is purged and the executions after the failure are discarded
+    assert worker.graphs['bad'] is None
+    assert not worker.pending['bad']
+    assert worker.src.requests == {'value', 'cspad'}
+    assert msgs.recv_string() == 'error'
+    assert msgs.recv_string() == worker.name
+    msgs.recv()
+    assert msgs.recv_string() == 'purge'
+
+    # the other graph keeps running
+    assert worker.graphs['good'] is not None
+    assert worker.store.stores['good'].namespace == {'picked_worker': [20, 40, 60]}
+
+
+def test_worker_event_rate(worker):
+    worker, msgs = worker
+    worker.batch_size = 2
+
+    graph = Graph(name='graph')
+    graph.add(Map(name='Scale', inputs=['value'], outputs=['scaled'], func=lambda v: v * 2))
+    graph.add(PickN(name='Pick', inputs=['scaled'], outputs=['picked'], N=4))
+    add_graph(worker, 'graph', graph)
+
+    for batch in range(2):
+        worker.batch = [{'value': batch * 2 + i} for i in range(worker.batch_size)]
+        worker.execute()
+    worker.drain(wait=True)
+
+    # every event of a batch is counted in the event rate
+    assert worker.store.stores['graph'].namespace == {'picked_worker': [0, 2, 4, 6]}
+    assert len(worker.event_rate['graph']) == 4